@@ -0,0 +1,186 @@
+"""
+@author Benjamin Görler <ben@greenflare.io>
+
+@section LICENSE
+
+Greenflare SEO Web Crawler (https://greenflare.io)
+Copyright (C) 2020-2021 Benjamin Görler. This file is part of
+Greenflare, an open-source project dedicated to delivering
+high quality SEO insights and analysis solutions to the world.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from contextlib import redirect_stdout
+from copy import deepcopy
+from threading import Lock
+from time import time, sleep
+import multiprocessing
+import argparse
+import platform
+import tempfile
+import json
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from greenflare.core.defaults import Defaults
+from synthetic_site import add_site_arguments, site_from_args
+
+# Peak RSS is not available on Windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+scenarios = {
+    'spider': {'MODE': 'Spider'},
+    'spider-async': {'MODE': 'Spider', 'FETCH_ENGINE': 'asyncio'},
+    'list': {'MODE': 'List'},
+}
+
+
+def get_peak_rss() -> float:
+    """Peak resident set size of this process in MB."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def get_db_size(db_file: str) -> float:
+    """Size of the crawl database including its WAL in MB."""
+    size = sum(os.path.getsize(f) for f in (db_file, db_file + '-wal') if os.path.isfile(f))
+    return round(size / (1024 * 1024), 2)
+
+
+def run_crawl(name: str, settings: dict, start_url: str, urls: list, db_file: str, results) -> None:
+    """Runs a single crawl, meant to be run as a process of its own so its peak RSS can be measured."""
+    from greenflare.core.gflarecrawler import GFlareCrawler
+
+    crawler = GFlareCrawler(settings=deepcopy(Defaults.settings), gui_mode=False, lock=Lock())
+    crawler.settings.update(settings)
+    crawler.db_file = db_file
+
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        if crawler.settings['MODE'] == 'List':
+            crawler.list_mode_urls = urls
+        else:
+            crawler.settings['STARTING_URL'] = crawler.gf.sanitise_url(start_url, base_url='')
+
+        started = time()
+        crawler.reset_crawl()
+        crawler.start_crawl()
+        while not crawler.crawl_running.is_set():
+            sleep(0.05)
+        crawler.end_crawl_gracefully()
+        if crawler.consumer_thread:
+            crawler.consumer_thread.join()
+        seconds = time() - started
+
+    results.put({
+        'scenario': name,
+        'completed': crawler.crawl_completed.is_set(),
+        'urls': crawler.urls_crawled,
+        'seconds': round(seconds, 3),
+        'urls_per_second': round(crawler.urls_crawled / seconds, 1) if seconds else 0,
+        'peak_rss_mb': get_peak_rss(),
+        'db_size_mb': get_db_size(db_file),
+    })
+
+
+def run_scenario(name: str, settings: dict, start_url: str, urls: list, directory: str) -> dict:
+    # spawn gives every crawl a fresh interpreter, so peak RSS is not inherited from earlier runs
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    db_file = os.path.join(directory, f'{name}{Defaults.file_extension}')
+    process = context.Process(target=run_crawl, args=(name, settings, start_url, urls, db_file, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def compare(results: list, baseline_file: str) -> None:
+    with open(baseline_file) as f:
+        baseline = {r['scenario']: r for r in json.load(f)['results']}
+    print(f'{"scenario":<15} {"URL/s":>10} {"change":>8} {"peak RSS MB":>12} {"change":>8}', file=sys.stderr)
+    for r in results:
+        b = baseline.get(r['scenario'])
+        if not b:
+            continue
+        speed = (r['urls_per_second'] / b['urls_per_second'] - 1) * 100 if b['urls_per_second'] else 0
+        rss = (r['peak_rss_mb'] / b['peak_rss_mb'] - 1) * 100 if r['peak_rss_mb'] and b['peak_rss_mb'] else 0
+        print(f'{r["scenario"]:<15} {r["urls_per_second"]:>10} {speed:>+7.1f}% {r["peak_rss_mb"]:>12} {rss:>+7.1f}%',
+              file=sys.stderr)
+
+
+def parse_value(value: str):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Crawls a local synthetic site and reports URLs/s, peak RSS, database size and time as JSON.')
+    parser.add_argument('--scenarios', default=','.join(scenarios), help=f'comma separated scenarios (default: {",".join(scenarios)})')
+    parser.add_argument('--threads', type=int, default=10, help='crawl threads (default: 10)')
+    parser.add_argument('--set', metavar='KEY=VALUE', action='append', default=[], help='override a crawl setting')
+    parser.add_argument('-o', '--output', help='write the results to this file instead of stdout')
+    parser.add_argument('--compare', metavar='JSON', help='print the changes against earlier results')
+    add_site_arguments(parser)
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in names if name not in scenarios]
+    if unknown:
+        raise SystemExit(f'Unknown scenarios: {", ".join(unknown)}')
+
+    overrides = {'THREADS': args.threads}
+    for item in args.set:
+        key, _, value = item.partition('=')
+        overrides[key.strip().upper()] = parse_value(value.strip())
+
+    site = site_from_args(args)
+    base_url = site.start()
+    urls = [base_url + path for path in site.get_urls()]
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for name in names:
+            print(f'Running {name} ...', file=sys.stderr, flush=True)
+            results.append(run_scenario(name, {**scenarios[name], **overrides}, base_url + '/', urls, directory))
+    site.stop()
+
+    report = {
+        'version': Defaults.version,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'site': site.get_config(),
+        'settings': overrides,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+"""
+@author Benjamin Görler <ben@greenflare.io>
+
+@section LICENSE
+
+Greenflare SEO Web Crawler (https://greenflare.io)
+Copyright (C) 2020-2021 Benjamin Görler. This file is part of
+Greenflare, an open-source project dedicated to delivering
+high quality SEO insights and analysis solutions to the world.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from contextlib import redirect_stdout
+from copy import deepcopy
+from threading import Lock
+from time import perf_counter
+import argparse
+import platform
+import tempfile
+import queue
+import json
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from greenflare.core.defaults import Defaults
+from greenflare.core.gflarecrawler import GFlareCrawler
+from greenflare.core.gflareparser import GFlareParser
+from greenflare.core.gflarereplay import GFlareFixtures, open_replay_source
+from greenflare.core.gflareprofiler import profiler
+from crawl_benchmark import run_scenario, parse_value
+from synthetic_site import add_site_arguments, site_from_args
+
+stages = ('parse', 'consumer', 'replay')
+
+
+def record(args, directory: str) -> str:
+    """Crawls the synthetic site once with STORE_RESPONSES. Returns the crawl database."""
+    site = site_from_args(args)
+    base_url = site.start()
+    print('Recording the synthetic site ...', file=sys.stderr, flush=True)
+    run_scenario('record', {'MODE': 'Spider', 'THREADS': args.threads, 'STORE_RESPONSES': 1}, base_url + '/', [], directory)
+    site.stop()
+    return os.path.join(directory, f'record{Defaults.file_extension}')
+
+
+def load_responses(source) -> list:
+    return [(url, source.get(url)) for url in source.get_urls()]
+
+
+def new_crawler(settings: dict, db_file: str, responses: list) -> GFlareCrawler:
+    """Sets up a crawler like start_crawl does, without fetching anything. The recorded robots.txt is applied."""
+    crawler = GFlareCrawler(settings=deepcopy(Defaults.settings), gui_mode=False, lock=Lock(), stats=False)
+    crawler.settings.update(settings)
+    crawler.db_file = db_file
+    crawler.init_crawl_headers()
+    crawler.init_session()
+
+    db = crawler._connect_to_db()
+    db.create()
+    db.insert_config(crawler.settings)
+    crawler.columns = crawler.gf.all_items = db.get_columns()
+    db.close()
+
+    for url, response in responses:
+        if crawler.gf.is_robots_txt(url):
+            crawler.response_to_data(response)
+            break
+    return crawler
+
+
+def result(stage: str, items: int, seconds: float, size=None) -> dict:
+    r = {'stage': stage, 'items': items, 'seconds': round(seconds, 3), 'per_second': round(items / seconds, 1) if seconds else 0}
+    if size is not None:
+        r['mb_per_second'] = round(size / (1024 * 1024) / seconds, 2) if seconds else 0
+    return r
+
+
+def bench_parse(settings: dict, responses: list, directory: str, repeat: int) -> tuple:
+    """Parses all responses on a single thread, the work the consumer does in the inline parse mode. Best of repeat."""
+    crawler = new_crawler(settings, os.path.join(directory, f'parse{Defaults.file_extension}'), responses)
+    size = sum(len(response.content) for _, response in responses)
+    best = None
+    for _ in range(repeat):
+        parser = GFlareParser(crawler.settings, crawler.columns, robots_txt=getattr(crawler.gf, 'robots_txt', ''))
+        started = perf_counter()
+        parsed = [parser.parse(response) for _, response in responses]
+        seconds = perf_counter() - started
+        best = seconds if best is None else min(best, seconds)
+    return result('parse', len(responses), best, size=size), parsed
+
+
+def bench_consumer(settings: dict, responses: list, parsed: list, directory: str, repeat: int) -> dict:
+    """Runs the consumer on already parsed responses into a fresh database: rows, links and commits. Best of repeat."""
+    best = None
+    for i in range(repeat):
+        db_file = os.path.join(directory, f'consumer{i}{Defaults.file_extension}')
+        crawler = new_crawler(settings, db_file, responses)
+        crawler.init_parser()
+        crawler.data_queue = queue.Queue()
+        crawler.tracker.add(len(parsed))
+        for data in parsed:
+            crawler.data_queue.put(data)
+        crawler.data_queue.put('END')
+
+        started = perf_counter()
+        crawler.consumer_worker()
+        seconds = perf_counter() - started
+        best = seconds if best is None else min(best, seconds)
+    return result('consumer', len(parsed), best)
+
+
+def bench_replay(settings: dict, source: str, start_url: str, directory: str) -> dict:
+    """Crawls the recorded responses end to end through the replay transport."""
+    run = run_scenario('replay', {**settings, 'REPLAY_FROM': source}, start_url, [], directory)
+    return {'stage': 'replay', 'items': run['urls'], 'seconds': run['seconds'], 'per_second': run['urls_per_second'],
+            'peak_rss_mb': run['peak_rss_mb']}
+
+
+def compare(results: list, baseline_file: str) -> None:
+    with open(baseline_file) as f:
+        baseline = {r['stage']: r for r in json.load(f)['results']}
+    print(f'{"stage":<10} {"per second":>12} {"change":>8}', file=sys.stderr)
+    for r in results:
+        b = baseline.get(r['stage'])
+        if not b:
+            continue
+        change = (r['per_second'] / b['per_second'] - 1) * 100 if b['per_second'] else 0
+        print(f'{r["stage"]:<10} {r["per_second"]:>12} {change:>+7.1f}%', file=sys.stderr)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Measures parse, consumer and replayed crawl throughput on recorded responses, without any network.')
+    parser.add_argument('--source', help='recorded responses (fixture directory, response store or crawl database), '
+                                         'by default the synthetic site is crawled and recorded first')
+    parser.add_argument('--start-url', help='starting URL of the replayed crawl (default: the first recorded URL)')
+    parser.add_argument('--stages', default=','.join(stages), help=f'comma separated stages (default: {",".join(stages)})')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of the parse and consumer stages, the best counts (default: 3)')
+    parser.add_argument('--latency', type=float, default=0, help='artificial latency per replayed request in seconds (default: 0)')
+    parser.add_argument('--threads', type=int, default=10, help='crawl threads (default: 10)')
+    parser.add_argument('--set', metavar='KEY=VALUE', action='append', default=[], help='override a crawl setting')
+    parser.add_argument('--save-fixtures', metavar='DIR', help='also write the recorded responses to a fixture directory')
+    parser.add_argument('--profile', action='store_true', help='print the timings of the profiled functions of the parse and consumer stages')
+    parser.add_argument('-o', '--output', help='write the results to this file instead of stdout')
+    parser.add_argument('--compare', metavar='JSON', help='print the changes against earlier results')
+    add_site_arguments(parser)
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.stages.split(',') if name.strip()]
+    unknown = [name for name in names if name not in stages]
+    if unknown:
+        raise SystemExit(f'Unknown stages: {", ".join(unknown)}')
+
+    settings = {'MODE': 'Spider', 'THREADS': args.threads, 'REPLAY_LATENCY': args.latency}
+    for item in args.set:
+        key, _, value = item.partition('=')
+        settings[key.strip().upper()] = parse_value(value.strip())
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        source_file = os.path.abspath(args.source) if args.source else record(args, directory)
+        source = open_replay_source(source_file)
+        responses = load_responses(source)
+        source.close()
+        if not responses:
+            raise SystemExit(f'No recorded responses found at {source_file}')
+        start_url = args.start_url or responses[0][0]
+        settings['STARTING_URL'] = start_url
+        if args.save_fixtures:
+            fixtures = GFlareFixtures(args.save_fixtures)
+            for url, response in responses:
+                fixtures.add(url, response)
+            fixtures.save()
+
+        if args.profile:
+            profiler.enable()
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            if 'parse' in names or 'consumer' in names:
+                print('Parsing ...', file=sys.stderr, flush=True)
+                parse, parsed = bench_parse(settings, responses, directory, max(args.repeat, 1))
+                if 'parse' in names:
+                    results.append(parse)
+            if 'consumer' in names:
+                print('Running the consumer ...', file=sys.stderr, flush=True)
+                results.append(bench_consumer(settings, responses, parsed, directory, max(args.repeat, 1)))
+        profiler.disable()
+        if 'replay' in names:
+            print('Replaying the crawl ...', file=sys.stderr, flush=True)
+            results.append(bench_replay(settings, source_file, start_url, directory))
+
+    if args.profile:
+        print(profiler.format_report(), file=sys.stderr)
+
+    report = {
+        'version': Defaults.version,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'source': args.source or {'site': site_from_args(args).get_config()},
+        'responses': len(responses),
+        'settings': settings,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
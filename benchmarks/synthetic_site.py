@@ -0,0 +1,219 @@
+"""
+@author Benjamin Görler <ben@greenflare.io>
+
+@section LICENSE
+
+Greenflare SEO Web Crawler (https://greenflare.io)
+Copyright (C) 2020-2021 Benjamin Görler. This file is part of
+Greenflare, an open-source project dedicated to delivering
+high quality SEO insights and analysis solutions to the world.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+from random import Random
+from time import sleep
+import argparse
+import sys
+
+words = ('crawler', 'audit', 'canonical', 'sitemap', 'redirect', 'status', 'header', 'index', 'robots', 'title',
+         'meta', 'description', 'content', 'link', 'anchor', 'page', 'site', 'search', 'engine', 'rank')
+
+
+class SiteServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Crawls open many connections at once
+    request_queue_size = 256
+
+    def handle_error(self, request, client_address):
+        # Crawlers drop connections of bodies they do not want
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class SyntheticSite:
+    """
+    Deterministic site generator. The same parameters always produce the same pages, links and responses:
+        pages: number of HTML pages (/ and /p/1 .. /p/<pages - 1>), all reachable from /
+        fan_out: links per page to other pages
+        redirects: number of redirect chains (/r/<n>/<hop>), each chain_length hops long and ending on a page
+        slow: share of pages answered after slow_delay seconds
+        assets: number of binary assets (/a/<n>.bin) of asset_size bytes, linked from some pages
+        robots_rules: number of Disallow rules in robots.txt, /private/ is always disallowed and linked
+        page_size: approximate size of the page text in bytes
+    """
+
+    def __init__(self, pages=1000, fan_out=20, redirects=50, chain_length=3, slow=0.01, slow_delay=0.5,
+                 assets=20, asset_size=1024 * 1024, robots_rules=100, page_size=4096, seed=1):
+        self.pages = max(int(pages), 1)
+        self.fan_out = int(fan_out)
+        self.redirects = int(redirects)
+        self.chain_length = max(int(chain_length), 1)
+        self.slow = float(slow)
+        self.slow_delay = float(slow_delay)
+        self.assets = int(assets)
+        self.asset_size = int(asset_size)
+        self.robots_rules = int(robots_rules)
+        self.page_size = int(page_size)
+        self.seed = int(seed)
+        self.asset = bytes(range(256)) * (self.asset_size // 256 + 1)
+        self.server = None
+
+    def get_config(self) -> dict:
+        return {k: v for k, v in vars(self).items() if k not in ('asset', 'server')}
+
+    def page_url(self, i: int) -> str:
+        return '/' if i == 0 else f'/p/{i}'
+
+    def get_urls(self) -> list:
+        """Returns the paths of all pages, e.g. for list crawls."""
+        return [self.page_url(i) for i in range(self.pages)]
+
+    def is_slow(self, i: int) -> bool:
+        return Random(self.seed * 7919 + i).random() < self.slow
+
+    def get_robots_txt(self) -> str:
+        rules = ['User-agent: *', 'Disallow: /private/']
+        rules += [f'Disallow: /section-{n}/*?sort=' if n % 2 else f'Disallow: /archive/{n}/' for n in range(self.robots_rules)]
+        return '\n'.join(rules) + '\n'
+
+    def get_page(self, i: int, base_url='') -> str:
+        rng = Random(self.seed * 1000003 + i)
+        links = [self.page_url((i + 1) % self.pages)]
+        links += [self.page_url(rng.randrange(self.pages)) for _ in range(max(self.fan_out - 1, 0))]
+        if self.redirects and rng.random() < 0.2:
+            links.append(f'/r/{rng.randrange(self.redirects)}/{self.chain_length}')
+        if self.assets and rng.random() < 0.1:
+            links.append(f'/a/{rng.randrange(self.assets)}.bin')
+        if rng.random() < 0.05:
+            links.append(f'/private/{i}')
+
+        text = []
+        size = 0
+        while size < self.page_size:
+            sentence = ' '.join(rng.choice(words) for _ in range(12)) + '.'
+            text.append(f'<p>{sentence}</p>')
+            size += len(sentence) + 7
+        title = ' '.join(rng.choice(words) for _ in range(5))
+        anchors = ''.join(f'<li><a href="{link}">{rng.choice(words)}</a></li>' for link in links)
+        return (f'<!DOCTYPE html><html><head><title>{title}</title>'
+                f'<meta name="description" content="{title} {i}">'
+                f'<link rel="canonical" href="{base_url}{self.page_url(i)}"></head>'
+                f'<body><h1>{title}</h1><h2>{i}</h2><ul>{anchors}</ul>{"".join(text)}</body></html>')
+
+    def resolve(self, path: str, base_url='') -> tuple:
+        """Returns (status, headers, body, delay) for path. Canonical tags point to base_url."""
+        path = path.split('?')[0]
+        if path == '/robots.txt':
+            return 200, {'Content-Type': 'text/plain'}, self.get_robots_txt().encode(), 0
+
+        parts = path.strip('/').split('/')
+        if path == '/' or parts[0] == 'p' and len(parts) == 2 and parts[1].isdigit() and 0 < int(parts[1]) < self.pages:
+            i = int(parts[1]) if path != '/' else 0
+            delay = self.slow_delay if self.is_slow(i) else 0
+            return 200, {'Content-Type': 'text/html; charset=utf-8'}, self.get_page(i, base_url).encode(), delay
+
+        if parts[0] == 'r' and len(parts) == 3 and parts[1].isdigit() and parts[2].isdigit() and int(parts[1]) < self.redirects:
+            n, hop = int(parts[1]), int(parts[2])
+            location = f'/r/{n}/{hop - 1}' if hop > 1 else self.page_url(Random(self.seed + n).randrange(self.pages))
+            return 301, {'Location': location}, b'', 0
+
+        if parts[0] == 'a' and len(parts) == 2 and parts[1].endswith('.bin'):
+            return 200, {'Content-Type': 'application/octet-stream'}, self.asset[:self.asset_size], 0
+
+        if parts[0] == 'private':
+            return 200, {'Content-Type': 'text/html'}, b'<html><head><title>private</title></head></html>', 0
+
+        return 404, {'Content-Type': 'text/html'}, b'<html><head><title>Not found</title></head></html>', 0
+
+    def start(self, host='127.0.0.1', port=0) -> str:
+        """Serves the site from a background thread. Returns its base URL."""
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def respond(self, with_body: bool):
+                status, headers, body, delay = site.resolve(self.path, f'http://{self.headers.get("Host", "")}')
+                if delay:
+                    sleep(delay)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if with_body:
+                    self.wfile.write(body)
+
+            def do_GET(self):
+                self.respond(True)
+
+            def do_HEAD(self):
+                self.respond(False)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = SiteServer((host, port), Handler)
+        Thread(target=self.server.serve_forever, name='synthetic-site', daemon=True).start()
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def stop(self) -> None:
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def add_site_arguments(parser) -> None:
+    parser.add_argument('--pages', type=int, default=1000, help='number of pages (default: 1000)')
+    parser.add_argument('--fan-out', type=int, default=20, help='links per page (default: 20)')
+    parser.add_argument('--redirects', type=int, default=50, help='number of redirect chains (default: 50)')
+    parser.add_argument('--chain-length', type=int, default=3, help='hops per redirect chain (default: 3)')
+    parser.add_argument('--slow', type=float, default=0.01, help='share of slow pages (default: 0.01)')
+    parser.add_argument('--slow-delay', type=float, default=0.5, help='delay of slow pages in seconds (default: 0.5)')
+    parser.add_argument('--assets', type=int, default=20, help='number of large assets (default: 20)')
+    parser.add_argument('--asset-size', type=int, default=1024 * 1024, help='asset size in bytes (default: 1 MB)')
+    parser.add_argument('--robots-rules', type=int, default=100, help='Disallow rules in robots.txt (default: 100)')
+    parser.add_argument('--page-size', type=int, default=4096, help='text per page in bytes (default: 4096)')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the generated site (default: 1)')
+
+
+def site_from_args(args) -> SyntheticSite:
+    return SyntheticSite(pages=args.pages, fan_out=args.fan_out, redirects=args.redirects,
+                         chain_length=args.chain_length, slow=args.slow, slow_delay=args.slow_delay,
+                         assets=args.assets, asset_size=args.asset_size, robots_rules=args.robots_rules,
+                         page_size=args.page_size, seed=args.seed)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Serve a deterministic synthetic site for crawl benchmarks.')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on (default: 8000)')
+    add_site_arguments(parser)
+    args = parser.parse_args()
+
+    site = site_from_args(args)
+    print(f'Serving {site.pages} pages at {site.start(port=args.port)}', flush=True)
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        site.stop()
+
+
+if __name__ == '__main__':
+    main()
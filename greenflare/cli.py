@@ -0,0 +1,407 @@
+"""
+@author Benjamin Görler <ben@greenflare.io>
+
+@section LICENSE
+
+Greenflare SEO Web Crawler (https://greenflare.io)
+Copyright (C) 2020-2021 Benjamin Görler. This file is part of
+Greenflare, an open-source project dedicated to delivering
+high quality SEO insights and analysis solutions to the world.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# Headless entry point. Never imports tkinter, the crawler (and with it
+# requests and lxml) is only imported once a crawl is actually started.
+from greenflare.core.defaults import Defaults
+from urllib.parse import urlsplit, urlunsplit
+from copy import deepcopy
+from threading import Lock
+from time import sleep, time
+from os import path, remove, environ
+import argparse
+import json
+import sys
+
+
+def load_settings_file(file_path: str) -> dict:
+    """Reads settings from a JSON or TOML file. Keys are the same as in Defaults.settings."""
+    if file_path.endswith('.toml'):
+        try:
+            import tomllib
+        except ImportError:
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise SystemExit('Reading TOML settings requires Python 3.11+ or the tomli package')
+        with open(file_path, 'rb') as f:
+            return tomllib.load(f)
+
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def parse_value(key: str, value: str):
+    """
+    Converts a --set value into a JSON array or object, a list (comma separated, only for settings that
+    default to a list), number or string.
+    """
+    if value[:1] in ('[', '{'):
+        try:
+            return json.loads(value)
+        except ValueError:
+            pass
+    if isinstance(Defaults.settings.get(key), (list, tuple)):
+        return [v.strip() for v in value.split(',') if v.strip()]
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+    return value
+
+
+def read_urls(file_path: str) -> list:
+    """Reads one URL per line, keeps valid and unique URLs in their original order."""
+    source = sys.stdin if file_path == '-' else open(file_path, 'r', encoding='utf-8')
+    urls = []
+    with source:
+        for line in source:
+            url = line.strip()
+            try:
+                components = urlsplit(url)
+            except ValueError:
+                continue
+            if components.scheme and components.netloc:
+                urls.append(url)
+    return list(dict.fromkeys(urls))
+
+
+def normalise_starting_url(url: str) -> str:
+    components = urlsplit(url.strip())
+    if components.scheme == '':
+        components = urlsplit('http://' + url.strip())
+    if components.netloc == '' or ' ' in components.netloc:
+        raise SystemExit(f'Invalid URL: {url}')
+    return urlunsplit(components)
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog='greenflare-cli', description='Greenflare SEO Web Crawler (headless)')
+    parser.add_argument('url', nargs='?', help='starting URL (spider mode)')
+    parser.add_argument('-o', '--output', help=f'crawl database to write ({Defaults.file_extension})')
+    parser.add_argument('-l', '--list', metavar='FILE', help='crawl the URLs in FILE (one per line, - for stdin) in list mode')
+    parser.add_argument('-r', '--resume', metavar='DB', help='resume the crawl stored in DB')
+    parser.add_argument('--recrawl', metavar='DB', help='crawl the site of DB again, unchanged pages are taken over from DB')
+    parser.add_argument('--store-responses', action='store_true', help='keep the raw responses (compressed) next to the output database')
+    parser.add_argument('--warc', action='store_true', help='archive all requests and responses in WARC files next to the output database')
+    parser.add_argument('--reextract', metavar='DB', help='crawl the responses stored with DB instead of the network, e.g. with new extractions')
+    parser.add_argument('--replay', metavar='SOURCE', help='answer all requests with the responses recorded in SOURCE (fixture directory, response store or crawl database)')
+    parser.add_argument('-s', '--settings', metavar='FILE', help='JSON or TOML file with settings')
+    parser.add_argument('--set', metavar='KEY=VALUE', action='append', default=[],
+                        help='override a single setting, e.g. --set MAX_DEPTH=3 (repeatable), lists and objects as JSON')
+    parser.add_argument('-t', '--threads', type=int, help='number of crawl threads')
+    parser.add_argument('--urls-per-second', type=float, help='request limit for the crawled site (0 = unlimited)')
+    parser.add_argument('--max-depth', type=int, help='maximum crawl depth (0 = unlimited)')
+    parser.add_argument('--max-urls', type=int, help='maximum number of URLs (0 = unlimited)')
+    parser.add_argument('--adaptive', action='store_true', help='adapt the number of concurrent requests to the latency and errors of the site')
+    parser.add_argument('--metrics', metavar='[HOST:]PORT', help='serve live metrics in the Prometheus text format (shards use consecutive ports)')
+    parser.add_argument('--profile', action='store_true', help='time the hot paths and write a report next to the output database')
+    parser.add_argument('--profile-consumer', action='store_true', help='run the consumer under cProfile and write its stats next to the output database')
+    parser.add_argument('--engine', choices=list(Defaults.fetch_engines.values()), help='fetch engine')
+    parser.add_argument('--parse-mode', choices=['inline', 'threads', 'processes'], help='where responses are parsed')
+    parser.add_argument('--shards', type=int, help='crawl with N processes, each owning a partition of the URLs (new crawls only)')
+    parser.add_argument('--shard-affinity', choices=['url', 'host'], help='partition URLs by URL hash or keep hosts together (default: url)')
+    parser.add_argument('--serve', metavar='[HOST:]PORT', help='coordinate the crawl for remote workers instead of crawling locally')
+    parser.add_argument('--worker', metavar='COORDINATOR', help='fetch URLs for the coordinator at COORDINATOR (HOST:PORT)')
+    parser.add_argument('--token', default=environ.get('GREENFLARE_TOKEN', ''),
+                        help='shared secret of coordinator and workers, required to serve on other than loopback addresses (default: $GREENFLARE_TOKEN)')
+    parser.add_argument('--user-agent', help='user agent string')
+    parser.add_argument('--overwrite', action='store_true', help='replace an existing output database')
+    parser.add_argument('-i', '--interval', type=float, default=5, help='seconds between progress lines (default: 5)')
+    parser.add_argument('-q', '--quiet', action='store_true', help='only print the summary')
+    parser.add_argument('-V', '--version', action='version', version=f'%(prog)s {Defaults.version}')
+    return parser
+
+
+def get_overrides(args) -> dict:
+    """Settings given as flags, they take precedence over the settings file."""
+    overrides = {}
+    if args.settings:
+        overrides.update(load_settings_file(args.settings))
+
+    flags = {
+        'THREADS': args.threads,
+        'URLS_PER_SECOND': args.urls_per_second,
+        'MAX_DEPTH': args.max_depth,
+        'MAX_URLS': args.max_urls,
+        'FETCH_ENGINE': args.engine,
+        'PARSE_MODE': args.parse_mode,
+        'SHARDS': args.shards,
+        'SHARD_AFFINITY': args.shard_affinity,
+        'USER_AGENT': args.user_agent,
+        'STORE_RESPONSES': 1 if args.store_responses else None,
+        'WARC': 1 if args.warc else None,
+        'ADAPTIVE_CONCURRENCY': 1 if args.adaptive else None,
+        'PROFILE': 1 if args.profile else None,
+        'PROFILE_CONSUMER': 1 if args.profile_consumer else None,
+    }
+    if args.replay:
+        flags['REPLAY_FROM'] = path.abspath(args.replay)
+    if args.metrics:
+        flags['METRICS_HOST'], flags['METRICS_PORT'] = parse_address(args.metrics)
+    overrides.update({k: v for k, v in flags.items() if v is not None})
+
+    for item in args.set:
+        key, sep, value = item.partition('=')
+        if not sep:
+            raise SystemExit(f'Invalid --set {item}, expected KEY=VALUE')
+        key = key.strip().upper()
+        overrides[key] = parse_value(key, value.strip())
+    return overrides
+
+
+def load_previous_crawl(db_file: str) -> tuple:
+    """Returns the settings of the crawl stored in db_file and its URLs if it has been a list crawl."""
+    from greenflare.core.gflaredb import GFlareDB
+
+    if not path.isfile(db_file):
+        raise SystemExit(f'{db_file} does not exist')
+    db = GFlareDB(db_file, read_only=True)
+    settings = db.get_settings()
+    urls = []
+    if settings.get('MODE') == 'List':
+        urls = [url for chunk in db.iter_urls() for url in chunk]
+    db.close()
+    return settings, urls
+
+
+def print_status(started: float, crawled: int, total: int, speed: int, queued: int, concurrency=None) -> None:
+    percentage = int(crawled / total * 100) if total else 0
+    suffix = f', concurrency {concurrency}' if concurrency else ''
+    print(f'[{time() - started:7.1f}s] {crawled:,}/{total:,} URLs crawled ({percentage}%), '
+          f'{speed} URL/s, {queued:,} queued{suffix}', flush=True)
+
+
+def print_progress(crawler, started: float) -> None:
+    with crawler.lock:
+        crawled = crawler.urls_crawled
+        total = crawler.urls_total
+        speed = crawler.current_urls_per_second
+    concurrency = crawler.concurrency.get_limit() if crawler.concurrency else None
+    print_status(started, crawled, total, speed, crawler.url_queue.qsize(), concurrency)
+
+
+def print_concurrency(crawler) -> None:
+    history = crawler.concurrency.get_history()
+    limits = [limit for _, limit, _, _ in history]
+    print(f'Concurrency settled at {limits[-1]} (min {min(limits)}, max {max(limits)}, {len(history) - 1} changes)')
+
+
+def run_sharded(args, settings: dict, db_file: str, list_mode_urls: list) -> int:
+    from greenflare.core.gflareshard import GFlareShardedCrawl
+
+    crawl = GFlareShardedCrawl(settings, db_file, shards=int(settings['SHARDS']),
+                               affinity=settings.get('SHARD_AFFINITY', 'url'), list_mode_urls=list_mode_urls)
+    crawl.start()
+
+    started = time()
+    last_progress = started
+    try:
+        while crawl.is_running():
+            sleep(0.1)
+            if not args.quiet and time() - last_progress >= args.interval:
+                crawled, total, speed = crawl.get_progress()
+                print_status(started, crawled, total, speed, max(total - crawled, 0))
+                last_progress = time()
+    except KeyboardInterrupt:
+        print('Interrupted, stopping crawl ...', flush=True)
+        crawl.stop()
+
+    completed = crawl.join()
+    crawl.merge()
+
+    crawled, total, speed = crawl.get_progress()
+    print_status(started, crawled, total, 0, max(total - crawled, 0))
+    if not completed:
+        print(f'Crawl paused, continue with: greenflare-cli --resume {db_file}')
+        return 130
+    print(f'Crawl completed: {db_file}')
+    return 0
+
+
+def parse_address(address: str) -> tuple:
+    host, sep, port = address.rpartition(':')
+    if not port.isdigit():
+        raise SystemExit(f'Invalid address {address}, expected [HOST:]PORT')
+    return host or '127.0.0.1', int(port)
+
+
+def run_worker(args) -> int:
+    from greenflare.core.gflaredistributed import GFlareRemoteWorker
+
+    worker = GFlareRemoteWorker(args.worker, threads=args.threads, token=args.token)
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        # Leases of this worker expire and are crawled by others
+        return 130
+    return 0
+
+
+def check_coordinator(args, crawler) -> None:
+    if not args.serve:
+        return
+    try:
+        crawler.check_settings()
+    except ValueError as e:
+        crawler.close()
+        raise SystemExit(str(e))
+
+
+def run(args) -> int:
+    if args.worker:
+        return run_worker(args)
+
+    overrides = get_overrides(args)
+    if overrides.get('REPLAY_FROM'):
+        from greenflare.core.gflarestore import get_store_file
+        source = overrides['REPLAY_FROM']
+        if source.endswith(Defaults.file_extension):
+            source = get_store_file(source)
+        if not path.exists(source):
+            raise SystemExit(f'No recorded responses found at {source}')
+    if args.serve:
+        from greenflare.core.gflaredistributed import GFlareCoordinator
+        crawler = GFlareCoordinator(settings=deepcopy(Defaults.settings), address=parse_address(args.serve), lock=Lock(),
+                                    token=args.token)
+        try:
+            crawler.listen()
+        except ValueError as e:
+            raise SystemExit(f'{e}, set one with --token')
+        print(f'Waiting for workers on {crawler.address[0]}:{crawler.address[1]}', flush=True)
+    elif args.reextract:
+        from greenflare.core.gflarereextract import GFlareReextractCrawler
+        from greenflare.core.gflarestore import get_store_file
+        if not path.isfile(get_store_file(args.reextract)):
+            raise SystemExit(f'No responses have been stored with {args.reextract}')
+        crawler = GFlareReextractCrawler(get_store_file(args.reextract), settings=deepcopy(Defaults.settings), lock=Lock())
+    else:
+        from greenflare.core.gflarecrawler import GFlareCrawler
+        crawler = GFlareCrawler(settings=deepcopy(Defaults.settings), gui_mode=False, lock=Lock())
+
+    if args.resume:
+        if not path.isfile(args.resume):
+            raise SystemExit(f'{args.resume} does not exist')
+        crawler.load_crawl(args.resume)
+        crawler.settings.update(overrides)
+        check_coordinator(args, crawler)
+        crawler.resume_crawl()
+    else:
+        if not args.output:
+            raise SystemExit('An output database is required (-o/--output)')
+        previous = args.recrawl or args.reextract
+        if args.url and args.list or not (args.url or args.list or previous):
+            raise SystemExit('Either a starting URL or a URL list (-l/--list) is required')
+
+        db_file = args.output
+        if not db_file.endswith(Defaults.file_extension):
+            db_file += Defaults.file_extension
+
+        previous_urls = []
+        if previous:
+            if path.abspath(previous) == path.abspath(db_file):
+                raise SystemExit(f'The output database needs to differ from {previous}')
+            previous_settings, previous_urls = load_previous_crawl(previous)
+            crawler.settings.update(previous_settings)
+            crawler.settings['RECRAWL_FROM'] = path.abspath(args.recrawl) if args.recrawl else ''
+
+        if path.isfile(db_file):
+            if not args.overwrite:
+                raise SystemExit(f'{db_file} already exists, use --overwrite or --resume')
+            remove(db_file)
+
+        crawler.settings.update(overrides)
+        if args.reextract:
+            # Everything is local, the stored responses are not stored again
+            crawler.settings['STORE_RESPONSES'] = 0
+            crawler.settings['WARC'] = 0
+            crawler.settings['SHARDS'] = 0
+            crawler.settings['ADAPTIVE_CONCURRENCY'] = 0
+            crawler.settings['FETCH_ENGINE'] = 'threads'
+        crawler.db_file = db_file
+        if previous and not (args.url or args.list):
+            crawler.list_mode_urls = previous_urls
+        elif args.list:
+            crawler.settings['MODE'] = 'List'
+            crawler.list_mode_urls = read_urls(args.list)
+            if not crawler.list_mode_urls:
+                raise SystemExit(f'No valid URLs found in {args.list}')
+        else:
+            crawler.settings['MODE'] = 'Spider'
+            crawler.settings['STARTING_URL'] = crawler.gf.sanitise_url(
+                normalise_starting_url(args.url), base_url='')
+        if int(crawler.settings.get('SHARDS', 0)) > 1 and not args.serve:
+            return run_sharded(args, crawler.settings, db_file, crawler.list_mode_urls)
+        check_coordinator(args, crawler)
+        crawler.reset_crawl()
+        crawler.start_crawl()
+
+    started = time()
+    last_progress = started
+    try:
+        while not crawler.crawl_running.is_set():
+            sleep(0.1)
+            if not args.quiet and time() - last_progress >= args.interval:
+                print_progress(crawler, started)
+                last_progress = time()
+    except KeyboardInterrupt:
+        print('Interrupted, stopping crawl ...', flush=True)
+
+    crawler.end_crawl_gracefully()
+    if crawler.consumer_thread:
+        crawler.consumer_thread.join()
+
+    print_progress(crawler, started)
+    if int(crawler.settings.get('PROFILE', 0)):
+        from greenflare.core.gflareprofiler import profiler
+        print(profiler.format_report())
+    if args.reextract:
+        crawler.close()
+    if args.serve:
+        # Give workers the chance to learn that the crawl is done
+        sleep(2)
+        crawler.close()
+    if crawler.crawl_timed_out.is_set():
+        print(f'Crawl failed: {crawler.settings.get("STARTING_URL", "")} could not be reached')
+        return 1
+    if not crawler.crawl_completed.is_set():
+        print(f'Crawl paused, continue with: greenflare-cli --resume {crawler.db_file}')
+        return 130
+    if crawler.concurrency:
+        print_concurrency(crawler)
+    if crawler.settings.get('RECRAWL_FROM', ''):
+        print(f'{crawler.urls_unchanged:,} unchanged pages taken over from {crawler.settings["RECRAWL_FROM"]}')
+    print(f'Crawl completed: {crawler.db_file}')
+    return 0
+
+
+def main() -> None:
+    args = get_parser().parse_args()
+    sys.exit(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -50,6 +50,7 @@ class Defaults:
         'redirect_url',
         'meta_robots',
         'x_robots_tag',
+        'depth',
         'respect_robots_txt',
         'report_on_status',
         'follow_blocked_redirects'
@@ -77,9 +78,47 @@ class Defaults:
         'MODE': 'Spider',
         'THREADS': 5,
         'URLS_PER_SECOND': 0,
+        'EXTERNAL_URLS_PER_SECOND': 0,
+        'MAX_CONNECTIONS_PER_HOST': 0,
+        'MAX_DEPTH': 0,
+        'MAX_URLS': 0,
+        'FRONTIER_PRIORITY': 'depth',
+        'FRONTIER_MEMORY_LIMIT': 100000,
+        'SEEN_FILTER': 'exact',
+        'SEEN_FILTER_CAPACITY': 20000000,
+        'SEEN_FILTER_ERROR_RATE': 0.001,
         'USER_AGENT': user_agents['Greenflare'],
         'UA_SHORT': 'Greenflare',
         'MAX_RETRIES': 3,
+        'RETRY_BACKOFF': 1,
+        'RETRY_MAX_DELAY': 60,
+        'FETCH_ENGINE': 'threads',
+        'ASYNC_CONCURRENCY': 100,
+        'PARSE_MODE': 'inline',
+        'PARSE_WORKERS': 0,
+        'COMMIT_BATCH_SIZE': 500,
+        'COMMIT_INTERVAL': 0.25,
+        'SHARDS': 0,
+        'SHARD_AFFINITY': 'url',
+        'LEASE_TIMEOUT': 60,
+        'STORE_VALIDATORS': 1,
+        'RECRAWL_FROM': '',
+        'STORE_RESPONSES': 0,
+        'RESPONSE_STORE_CODEC': 'zlib',
+        'WARC': 0,
+        'WARC_MAX_SIZE': 1000000000,
+        'MAX_BODY_BYTES': 10485760,
+        'MAX_DOWNLOAD_SECONDS': 60,
+        'ADAPTIVE_CONCURRENCY': 0,
+        'CONCURRENCY_FLOOR': 1,
+        'CONCURRENCY_CEILING': 64,
+        'METRICS_HOST': '127.0.0.1',
+        'METRICS_PORT': 0,
+        'PROFILE': 0,
+        'PROFILE_CONSUMER': 0,
+        'REPLAY_FROM': '',
+        'REPLAY_LATENCY': 0,
+        'REPLAY_JITTER': 0,
         'CRAWL_ITEMS': crawl_items,
         'EXTRACTION_SEPARATOR': ' | '
     }
@@ -116,6 +155,11 @@ class Defaults:
         'Less Than',
         'Less Than Or Equal To']
 
+    fetch_engines = {
+        'Threads': 'threads',
+        'Asyncio': 'asyncio'
+    }
+
     window_title = 'Greenflare SEO Crawler'
 
     file_extension = '.gflaredb'
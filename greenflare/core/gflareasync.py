@@ -0,0 +1,223 @@
+"""
+@author Benjamin Görler <ben@greenflare.io>
+
+@section LICENSE
+
+Greenflare SEO Web Crawler (https://greenflare.io)
+Copyright (C) 2020-2021 Benjamin Görler. This file is part of
+Greenflare, an open-source project dedicated to delivering
+high quality SEO insights and analysis solutions to the world.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from greenflare.core.gflarefetch import GFlareFetchResult
+from time import time
+import asyncio
+import queue
+
+# aiohttp is an optional dependency, the threaded engine is used without it
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class GFlareAsyncEngine:
+    """
+    Fetch engine driving many concurrent requests from a single asyncio event loop.
+    Consumes URLs from the crawler's url_queue and feeds the same data_queue as the crawl_worker threads.
+    """
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.settings = crawler.settings
+        self.concurrency = int(self.settings.get('ASYNC_CONCURRENCY', 100))
+        if crawler.concurrency:
+            # The adaptive controller decides how many of them are used
+            self.concurrency = crawler.concurrency.ceiling
+
+        # timeout (connection, response) mirrors the threaded engine
+        self.timeout = (3, 5)
+        self.queue_timeout = 0.5
+        self.data_queue_timeout = 0.25
+
+    @staticmethod
+    def is_available() -> bool:
+        return aiohttp is not None
+
+    def run(self) -> None:
+        """Runs the event loop until the crawl stops. Meant to be run as a single thread."""
+        asyncio.run(self.dispatch())
+
+    def get_session(self):
+        connect, read = self.timeout
+        timeout = aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+
+        auth = None
+        if self.settings.get('AUTH_USER', ''):
+            auth = aiohttp.BasicAuth(
+                self.settings['AUTH_USER'], self.settings.get('AUTH_PASSWORD', ''))
+
+        # Cookies are cleared before every request in the threaded engine
+        return aiohttp.ClientSession(headers=self.crawler.HEADERS, timeout=timeout, connector=connector, auth=auth, cookie_jar=aiohttp.DummyCookieJar())
+
+    def get_proxy(self, url: str):
+        """Same behaviour as the requests session, only https URLs are proxied."""
+        host = self.settings.get('PROXY_HOST', '')
+        if not host or not url.startswith('https'):
+            return None
+        if self.settings.get('PROXY_USER', ''):
+            return f'http://{self.settings["PROXY_USER"]}:{self.settings["PROXY_PASSWORD"]}@{host}'
+        return f'http://{host}'
+
+    async def get_url(self):
+        """Waits for the next URL the scheduler allows without blocking the event loop. Returns None once the crawl has been stopped."""
+        loop = asyncio.get_event_loop()
+        while not self.crawler.crawl_running.is_set():
+            url = await loop.run_in_executor(None, self.crawler.get_url, self.queue_timeout)
+            if url is not None:
+                return url
+        return None
+
+    async def dispatch(self) -> None:
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+
+        async with self.get_session() as session:
+            while not self.crawler.crawl_running.is_set():
+                await semaphore.acquire()
+                controller = self.crawler.concurrency
+                while controller and tasks and len(tasks) >= controller.get_limit():
+                    await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+
+                url = await self.get_url()
+                if url is None or url == 'END':
+                    semaphore.release()
+                    break
+
+                self.crawler.clock_workers(True)
+                task = asyncio.ensure_future(self.crawl_url(session, url))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda t: semaphore.release())
+
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def crawl_url(self, session, url: str) -> None:
+        try:
+            try:
+                started = time()
+                response = await self.fetch(session, url)
+                self.crawler.record_fetch(url, response, time() - started)
+                response = self.crawler.deal_with_throttling(url, response)
+                if not isinstance(response, str):
+                    response = await self.parse(response)
+            except Exception as e:
+                # The URL still needs to be retried or completed, otherwise the crawl never finishes
+                print(f'{url} failed: {e!r}')
+                response = self.crawler.deal_with_exception(url, 'Unknown Exception')
+            if not isinstance(response, str):
+                await self.add_to_data_queue(response)
+        finally:
+            self.crawler.scheduler.release(url)
+            self.crawler.clock_workers(False)
+
+    async def fetch(self, session, url: str):
+        """Async counterpart of GFlareCrawler.crawl_url using the same exception handling."""
+        proxy = self.get_proxy(url)
+
+        with self.crawler.lock:
+            header_only = self.crawler.gf.is_external(url)
+
+        # Lookups in the previous crawl are SQLite queries, they must not block the event loop
+        loop = asyncio.get_event_loop()
+        previous = self.crawler.previous
+        validators = await loop.run_in_executor(None, previous.get_validators, url) if previous else None
+        headers = previous.get_headers(validators) if validators else None
+
+        try:
+            if header_only or self.crawler.header_only:
+                async with session.head(url, headers=headers, allow_redirects=True, proxy=proxy) as header:
+                    response = GFlareFetchResult.from_aiohttp(header)
+                    await self.archive(url, header, b'')
+            else:
+                async with session.get(url, headers=headers, allow_redirects=True, proxy=proxy) as body:
+                    limit = self.crawler.get_body_limit()
+                    if 'text' in body.headers.get('content-type', ''):
+                        content = await limit.aread(body.content.iter_chunked(limit.chunk_size))
+                        response = GFlareFetchResult.from_aiohttp(body, content=content, truncated=limit.truncated)
+                        await self.archive(url, body, content, limit)
+                    elif self.crawler.warc:
+                        # The archive needs the body anyway
+                        await self.archive(url, body, limit=limit)
+                        response = GFlareFetchResult.from_aiohttp(body)
+                    else:
+                        # Drain small bodies to keep the connection alive, close otherwise
+                        if body.content_length is not None and body.content_length <= self.crawler.drain_limit:
+                            await body.read()
+                        else:
+                            body.close()
+                        response = GFlareFetchResult.from_aiohttp(body)
+                    if limit.truncated:
+                        # Drops the rest of the body, the connection cannot be reused
+                        body.close()
+
+        except aiohttp.TooManyRedirects:
+            return self.crawler.deal_with_exception(url, 'Too Many Redirects')
+
+        except aiohttp.InvalidURL:
+            return self.crawler.deal_with_exception(url, 'Invalid URL')
+
+        except asyncio.TimeoutError:
+            return self.crawler.deal_with_exception(url, 'Read timed out')
+
+        except aiohttp.ClientConnectionError:
+            return self.crawler.deal_with_exception(url, 'Connection Refused')
+
+        except Exception:
+            return self.crawler.deal_with_exception(url, 'Unknown Exception')
+
+        store = self.crawler.response_store
+        if store and not (validators and response.status_code == 304):
+            await loop.run_in_executor(None, store.put, url, response)
+        if validators:
+            return await loop.run_in_executor(None, previous.take_over, url, response, validators)
+        return response
+
+    async def archive(self, url: str, response, content=None, limit=None) -> None:
+        warc = self.crawler.warc
+        if not warc:
+            return
+        records = await warc.write_aiohttp(response, content, limit=limit)
+        with self.crawler.lock:
+            self.crawler.warc_records[url] = records
+
+    async def parse(self, response):
+        """Hands a response to the parse stage, parsing threads run in the default executor to keep the event loop free."""
+        parser = self.crawler.parser
+        if parser.mode == 'threads':
+            return await asyncio.get_event_loop().run_in_executor(None, parser.submit, response)
+        return parser.submit(response)
+
+    async def add_to_data_queue(self, response) -> None:
+        """Puts a response into the data queue without blocking the event loop, gives up if the crawl stops."""
+        while not self.crawler.crawl_running.is_set():
+            try:
+                self.crawler.data_queue.put_nowait(response)
+                return
+            except queue.Full:
+                await asyncio.sleep(self.data_queue_timeout)
@@ -0,0 +1,124 @@
+"""
+@author Benjamin Görler <ben@greenflare.io>
+
+@section LICENSE
+
+Greenflare SEO Web Crawler (https://greenflare.io)
+Copyright (C) 2020-2021 Benjamin Görler. This file is part of
+Greenflare, an open-source project dedicated to delivering
+high quality SEO insights and analysis solutions to the world.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from threading import Condition
+from time import monotonic, time
+
+
+def percentile(values: list, p: float) -> float:
+    """Nearest-rank percentile of values, 0 for no values."""
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+class GFlareConcurrency:
+    """
+    AIMD controller for the number of requests in flight. The limit grows by increase per window while the p95
+    latency stays within latency_factor of the best p95 seen and failures (timeouts, 5xx, 429) stay below
+    max_error_rate. It is cut by decrease as soon as a window turns unhealthy, failures end a window early.
+    Requests started before a decrease are ignored, they reflect the old limit.
+    Every change is kept in history as (unix time, limit, p95 latency, error rate).
+    Thread-safe, fetch workers hold a slot (acquire/release) for every request.
+    """
+
+    def __init__(self, initial: int, floor=1, ceiling=64, increase=1, decrease=0.5, latency_factor=2.0,
+                 max_error_rate=0.05, window=1.0, min_samples=5):
+        self.floor = max(int(floor), 1)
+        self.ceiling = max(int(ceiling), self.floor)
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.max_error_rate = max_error_rate
+        self.window = window
+        self.min_samples = min_samples
+
+        self.limit = min(max(int(initial), self.floor), self.ceiling)
+        self.active = 0
+        self.baseline = None
+        self.latencies = []
+        self.errors = 0
+        self.window_started = monotonic()
+        self.last_decrease = 0
+        self.history = [(time(), self.limit, 0, 0)]
+        self.condition = Condition()
+
+    def acquire(self, timeout=None) -> bool:
+        """Waits for a free slot. Returns False if none became available within timeout."""
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.active < self.limit, timeout):
+                return False
+            self.active += 1
+            return True
+
+    def release(self) -> None:
+        with self.condition:
+            self.active = max(self.active - 1, 0)
+            self.condition.notify()
+
+    def get_limit(self) -> int:
+        with self.condition:
+            return self.limit
+
+    def record(self, latency: float, failed: bool) -> None:
+        """Records a finished request and adjusts the limit once its window is complete."""
+        now = monotonic()
+        with self.condition:
+            if now - latency < self.last_decrease:
+                return
+            self.latencies.append(latency)
+            if failed:
+                self.errors += 1
+
+            samples = len(self.latencies)
+            error_rate = self.errors / samples
+            elapsed = now - self.window_started
+            # Failures are acted on without waiting for the window to end
+            overloaded = self.errors and samples >= self.min_samples and error_rate > self.max_error_rate
+            if not overloaded and (elapsed < self.window or samples < self.min_samples):
+                return
+
+            p95 = percentile(self.latencies, 0.95)
+            if self.baseline is None or p95 < self.baseline:
+                self.baseline = p95
+
+            if overloaded or p95 > self.baseline * self.latency_factor:
+                limit = max(int(self.limit * self.decrease), self.floor)
+                self.last_decrease = now
+            else:
+                limit = min(self.limit + self.increase, self.ceiling)
+
+            if limit != self.limit:
+                self.limit = limit
+                self.history.append((time(), limit, round(p95, 3), round(error_rate, 3)))
+                self.condition.notify_all()
+
+            self.latencies = []
+            self.errors = 0
+            self.window_started = now
+
+    def get_history(self) -> list:
+        with self.condition:
+            return list(self.history)
@@ -23,18 +23,37 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 from threading import Thread, Event, enumerate as tenum
-from greenflare.core.gflaredb import GFlareDB
+from greenflare.core.gflaredb import GFlareDB, GFlareDBPool
 from greenflare.core.gflareresponse import GFlareResponse as gf
+from greenflare.core.gflarescheduler import GFlareScheduler, parse_retry_after
+from greenflare.core.gflarefrontier import GFlareFrontier
+from greenflare.core.gflareseen import GFlareSeenSet
+from greenflare.core.gflareparser import GFlareParser
+from greenflare.core.gflarefetch import GFlareFetchResult, GFlareBodyLimit, abort_requests
+from greenflare.core.gflaretracker import GFlareWorkTracker
+from greenflare.core.gflarerecrawl import GFlarePreviousCrawl
+from greenflare.core.gflarestore import GFlareResponseStore, get_store_file
+from greenflare.core.gflarewarc import GFlareWarcWriter
+from greenflare.core.gflareconcurrency import GFlareConcurrency
+from greenflare.core.gflaremetrics import GFlareMetrics
+from greenflare.core.gflareprofiler import profiler, profiled
+from greenflare.core.gflarereplay import GFlareReplayAdapter, open_replay_source
 from greenflare.core.defaults import Defaults
 from requests import Session, exceptions
 from time import sleep, time
+from os import path
+from random import uniform
+import cProfile
 import queue
 
 
 class GFlareCrawler:
 
     def __init__(self, settings=None, gui_mode=False, lock=None, stats=True):
-        self.url_queue = queue.Queue()
+        self.url_queue = GFlareFrontier()
+        self.seen = GFlareSeenSet()
+        self.tracker = GFlareWorkTracker()
+        self.parser = None
         self.data_queue = queue.Queue(maxsize=25)
         self.gui_url_queue = []
         self.gui_mode = gui_mode
@@ -43,6 +62,8 @@ class GFlareCrawler:
 
         self.list_mode_urls = None
         self.url_attempts = {}
+        # URLs whose attempts have not been written to the database yet
+        self.attempts_changed = set()
         self.retries = 5
 
         self.settings = settings
@@ -52,11 +73,21 @@ class GFlareCrawler:
         self.crawl_timed_out = Event()
         self.active_workers = 0
         self.db_file = None
-
-        self.rate_limit_delay = 0
+        self.readers = None
+        self.previous = None
+        self.response_store = None
+        self.warc = None
+        # WARC record ids of fetched URLs until their data is stored
+        self.warc_records = {}
+        self.concurrency = None
+        self.metrics = GFlareMetrics()
+        self.describe_metrics()
+
+        self.scheduler = GFlareScheduler(host_limits=self.get_host_limits)
         self.current_urls_per_second = 0
         self.urls_crawled = 0
         self.urls_total = 0
+        self.urls_unchanged = 0
         self.HEADERS = ""
         self.robots_txt = ""
         self.columns = None
@@ -64,15 +95,34 @@ class GFlareCrawler:
         self.consumer_thread = None
 
         self.session = None
+        # Recorded responses served instead of the network (REPLAY_FROM)
+        self.replay = None
         self.header_only = False
+        self.drain_limit = 64 * 1024
 
-    def _connect_to_db(self) -> GFlareDB:
+    def _connect_to_db(self, check_same_thread=True, autocommit=True, read_only=False) -> GFlareDB:
         """Connects to the database and returns a GFLareDB object if successful"""
         try:
-            return GFlareDB(self.db_file, crawl_items=self.settings.get("CRAWL_ITEMS"), extractions=self.settings.get('EXTRACTIONS', []))
+            return GFlareDB(self.db_file, crawl_items=self.settings.get("CRAWL_ITEMS"), extractions=self.settings.get('EXTRACTIONS', []), check_same_thread=check_same_thread, autocommit=autocommit, read_only=read_only)
         except Exception as e:
             raise
 
+    def get_readers(self) -> GFlareDBPool:
+        """Returns the pool of read-only connections to the current database, (re)creating it if the database has changed."""
+        with self.lock:
+            if self.readers is None or self.readers.db_name != self.db_file:
+                if self.readers:
+                    self.readers.close()
+                self.readers = GFlareDBPool(self.db_file, crawl_items=self.settings.get("CRAWL_ITEMS"), extractions=self.settings.get('EXTRACTIONS', []))
+            return self.readers
+
+    def close_readers(self) -> None:
+        """Closes all pooled read-only connections, e.g. because the columns of the database have changed."""
+        with self.lock:
+            if self.readers:
+                self.readers.close()
+                self.readers = None
+
     def init_crawl_headers(self) -> None:
         """Initialises headers to be used in the requests session. Uses default settings if no user-agent has been specified."""
         if not self.settings.get('USER_AGENT', ''):
@@ -89,7 +139,7 @@ class GFlareCrawler:
             data (dict): parsed results of a valid response
         """
         robots_txt_url = self.gf.get_robots_txt_url(url)
-        response = self.crawl_url(robots_txt_url)
+        response = self.crawl_url(robots_txt_url, retry=False, conditional=False)
 
         if isinstance(response, str):
             skip_url = response
@@ -106,12 +156,12 @@ class GFlareCrawler:
         print('Crawl started')
         self.init_crawl_headers()
         self.init_session()
+        self.scheduler = GFlareScheduler(host_limits=self.get_host_limits)
+        self.init_frontier()
+        self.init_seen()
+        self.tracker = GFlareWorkTracker()
 
-        # Set speed limit
-        if int(self.settings.get('URLS_PER_SECOND', 0)) > 0:
-            self.parallel_requests_limit = (
-                1 / int(self.settings['URLS_PER_SECOND'])) * int(self.settings['THREADS'])
-
+        self.close_readers()
         db = self._connect_to_db()
         db.create()
         db.insert_config(self.settings)
@@ -120,11 +170,19 @@ class GFlareCrawler:
         self.gf = gf(self.settings, columns=None)
 
         self.columns = self.gf.all_items = db.get_columns()
+        self.init_previous_crawl()
+        self.init_response_store()
+        self.init_warc()
+        self.init_concurrency()
+        self.init_metrics()
+        self.init_profiler()
 
         if self.settings['MODE'] == 'Spider':
             self.settings['ROOT_DOMAIN'] = self.gf.get_domain(
                 self.settings['STARTING_URL'])
-            response = self.crawl_url(self.settings['STARTING_URL'])
+            self.url_queue.set_admitted(1)
+            self.tracker.add(1)
+            response = self.crawl_url(self.settings['STARTING_URL'], conditional=False)
 
             # Check if we are dealing with a reachable host
             if isinstance(response, str):
@@ -134,14 +192,17 @@ class GFlareCrawler:
                 return
 
             self.request_robots_txt(response.url)
+            self.set_crawl_delay(response.url)
             data = self.response_to_data(response)
 
             self.add_to_data_queue(data)
 
         elif self.settings['MODE'] == 'List':
             if len(self.list_mode_urls) > 0:
-                self.add_to_url_queue(self.list_mode_urls)
-                db.insert_new_urls(self.list_mode_urls)
+                self.url_queue.set_admitted(len(self.list_mode_urls))
+                self.seen.add(self.list_mode_urls)
+                self.add_to_url_queue(self.list_mode_urls, depth=0)
+                db.insert_new_urls(self.list_mode_urls, depth=0)
             else:
                 print('ERROR: No urls to list crawl found!')
 
@@ -153,6 +214,7 @@ class GFlareCrawler:
     def load_crawl(self, db_file: str) -> None:
         """Load a database by using the file path as string. Raises Exception if it fails."""
         self.db_file = db_file
+        self.close_readers()
 
         try:
             db = self._connect_to_db()
@@ -173,12 +235,14 @@ class GFlareCrawler:
         # Reset queue
         if self.settings['MODE'] != 'List':
             self.data_queue = queue.Queue(maxsize=25)
-            self.url_queue = queue.Queue()
+            self.url_queue = GFlareFrontier()
             self.gui_url_queue = []
             self.url_attempts = {}
+            self.attempts_changed = set()
 
         self.init_crawl_headers()
         self.init_session()
+        self.scheduler = GFlareScheduler(host_limits=self.get_host_limits)
 
         self.active_workers = 0
 
@@ -190,17 +254,31 @@ class GFlareCrawler:
 
         self.urls_crawled = 0
         self.urls_total = 0
+        self.urls_unchanged = 0
 
     def resume_crawl(self) -> None:
         """Resumes a crawl using the settings from the connected database."""
         print('Resuming crawl ...')
         self.reset_crawl()
+        # Drops stop signals and stale data of the paused crawl (list mode keeps its queues on reset)
+        self.data_queue = queue.Queue(maxsize=25)
         db = self._connect_to_db()
         self.urls_crawled = db.get_urls_crawled()
         self.urls_total = db.get_total_urls()
 
         # Create a new response object with the columns from the loaded databse
         self.gf = gf(self.settings, columns=db.get_columns())
+        self.columns = db.columns.copy()
+        self.init_previous_crawl()
+        self.init_response_store()
+        self.init_warc()
+        self.init_concurrency()
+        self.init_metrics()
+        self.init_profiler()
+        self.init_frontier()
+        self.url_queue.set_admitted(self.urls_total)
+        self.init_seen(db)
+        self.url_attempts = db.get_attempts() or {}
 
         if self.settings['MODE'] != 'List':
             response = self.request_robots_txt(
@@ -210,25 +288,178 @@ class GFlareCrawler:
                 self.crawl_running.set()
                 db.close()
                 return
+            self.set_crawl_delay(self.settings.get('STARTING_URL'))
 
-        # Reinit URL queue
-        self.add_to_url_queue(db.get_url_queue(), count=False)
+        # Page the URL queue from the database instead of loading it at once
+        self.tracker = GFlareWorkTracker()
+        self.tracker.add(db.get_url_queue_size())
+        backlog = self._connect_to_db(check_same_thread=False, read_only=True)
+        self.url_queue.attach_backlog(
+            backlog.get_url_queue_page, db.get_max_id(), close=backlog.close)
 
         db.close()
 
         self.start_consumer()
         Thread(target=self.spawn_threads).start()
 
+    def init_seen(self, db=None) -> None:
+        """Creates the seen URL set from self.settings and fills it with all URLs of db (if any)."""
+        self.seen = GFlareSeenSet(mode=self.settings.get('SEEN_FILTER', 'exact'),
+                                  capacity=int(self.settings.get('SEEN_FILTER_CAPACITY', 20000000)),
+                                  error_rate=float(self.settings.get('SEEN_FILTER_ERROR_RATE', 0.001)))
+        if db:
+            self.seen.rebuild(db.iter_urls())
+
+    def init_previous_crawl(self) -> None:
+        """Opens the crawl set as RECRAWL_FROM (if any) so unchanged pages can be taken over. Needs the columns of the current crawl."""
+        if self.previous:
+            self.previous.close()
+            self.previous = None
+
+        db_file = self.settings.get('RECRAWL_FROM', '')
+        if not db_file:
+            return
+        if not path.isfile(db_file):
+            print(f'WARNING: {db_file} does not exist, crawling all pages')
+            return
+
+        self.previous = GFlarePreviousCrawl(db_file, self.columns, size=max(int(self.settings.get('THREADS', 5)), 1))
+        if not self.previous.has_validators():
+            print(f'WARNING: {db_file} has no validators, crawling all pages')
+            self.previous.close()
+            self.previous = None
+
+    def init_response_store(self) -> None:
+        """Opens the raw response store of the current crawl if STORE_RESPONSES is enabled."""
+        if self.response_store:
+            self.response_store.close()
+            self.response_store = None
+        if int(self.settings.get('STORE_RESPONSES', 0)) and self.db_file:
+            self.response_store = GFlareResponseStore(get_store_file(self.db_file),
+                                                      codec=self.settings.get('RESPONSE_STORE_CODEC', 'zlib'))
+
+    def init_warc(self) -> None:
+        """Starts archiving all requests into WARC files next to the database if WARC is enabled."""
+        if self.warc:
+            self.warc.close()
+            self.warc = None
+        self.warc_records = {}
+        if int(self.settings.get('WARC', 0)) and self.db_file:
+            # example.gflaredb -> example-<timestamp>-00000.warc.gz (shards: example.shard0-...)
+            self.warc = GFlareWarcWriter(self.get_file_prefix(), max_size=int(self.settings.get('WARC_MAX_SIZE', 1000000000)))
+
+    def get_file_prefix(self) -> str:
+        """Returns the path of the database without its extension, files belonging to the crawl start with it."""
+        return ''.join(self.db_file.rsplit(Defaults.file_extension, 1))
+
+    def init_concurrency(self) -> None:
+        """Sets up the adaptive concurrency controller if ADAPTIVE_CONCURRENCY is enabled. THREADS (ASYNC_CONCURRENCY) is its starting point."""
+        self.concurrency = None
+        if not int(self.settings.get('ADAPTIVE_CONCURRENCY', 0)):
+            return
+        if self.settings.get('FETCH_ENGINE', 'threads') == 'asyncio':
+            initial = self.settings.get('ASYNC_CONCURRENCY', 100)
+        else:
+            initial = self.settings.get('THREADS', 5)
+        self.concurrency = GFlareConcurrency(int(initial), floor=int(self.settings.get('CONCURRENCY_FLOOR', 1)),
+                                             ceiling=int(self.settings.get('CONCURRENCY_CEILING', 64)))
+
+    def describe_metrics(self) -> None:
+        m = self.metrics
+        m.describe('greenflare_fetch_seconds', 'histogram', 'Time to fetch a URL including redirects and the body')
+        m.describe('greenflare_responses_total', 'counter', 'Fetched URLs by status code (error: failed requests)')
+        m.describe('greenflare_response_bytes_total', 'counter', 'Body bytes downloaded (text content only)')
+        m.describe('greenflare_retries_total', 'counter', 'Retries scheduled by reason')
+        m.describe('greenflare_parse_seconds', 'histogram', 'Time to parse a response')
+        m.describe('greenflare_db_write_seconds', 'histogram', 'Time spent writing to the crawl database by operation')
+        m.gauge('greenflare_urls_crawled', 'URLs crawled so far', lambda: self.urls_crawled)
+        m.gauge('greenflare_urls_total', 'URLs discovered so far', lambda: self.urls_total)
+        m.gauge('greenflare_url_queue_size', 'URLs waiting in the URL queue', lambda: self.url_queue.qsize())
+        m.gauge('greenflare_data_queue_size', 'Responses waiting for the consumer', lambda: self.data_queue.qsize())
+        m.gauge('greenflare_deferred_urls', 'Failed URLs waiting to be retried', lambda: self.scheduler.pending())
+        m.gauge('greenflare_active_workers', 'Fetch workers busy with a URL', lambda: self.active_workers)
+        m.gauge('greenflare_concurrency', 'Concurrency limit of the adaptive controller (0: disabled)',
+                lambda: self.concurrency.get_limit() if self.concurrency else 0)
+
+    def init_metrics(self) -> None:
+        """Serves the metrics in the Prometheus text format on METRICS_HOST:METRICS_PORT if METRICS_PORT is set."""
+        port = int(self.settings.get('METRICS_PORT', 0))
+        if not port or self.metrics.server:
+            return
+        try:
+            host, port = self.metrics.serve((self.settings.get('METRICS_HOST', '127.0.0.1'), port))[:2]
+            print(f'Metrics available at http://{host}:{port}/metrics')
+        except OSError as e:
+            print(f'WARNING: metrics cannot be served on port {port}: {e}')
+
+    def init_profiler(self) -> None:
+        """Records the timings of all profiled functions during this crawl if PROFILE is enabled."""
+        profiler.reset()
+        if int(self.settings.get('PROFILE', 0)):
+            profiler.enable()
+        else:
+            profiler.disable()
+
+    def write_profile(self) -> None:
+        """Writes the aggregated timings of the crawl next to the database."""
+        file_name = self.get_file_prefix() + '.profile.json'
+        profiler.dump(file_name)
+        print(f'Profile written to {file_name}')
+
+    def profile_consumer(self) -> None:
+        """Runs the consumer under cProfile and writes its stats next to the database (python -m pstats <file>)."""
+        consumer = cProfile.Profile()
+        consumer.runcall(self.consumer_worker)
+        file_name = self.get_file_prefix() + '.consumer.prof'
+        consumer.dump_stats(file_name)
+        print(f'Consumer profile written to {file_name}')
+
+    def archive(self, url: str, response, content=None, limit=None) -> None:
+        """Archives the exchange(s) of url if WARC is enabled. The body is streamed from response (within limit) if content is None."""
+        if not self.warc:
+            return
+        records = self.warc.write_requests(response, content, limit=limit)
+        with self.lock:
+            self.warc_records[url] = records
+
+    def init_frontier(self) -> None:
+        """Applies priorities and depth/URL budgets from self.settings to the URL queue."""
+        self.url_queue.configure(priority=self.settings.get('FRONTIER_PRIORITY', 'depth'),
+                                 max_depth=self.settings.get('MAX_DEPTH', 0),
+                                 max_urls=self.settings.get('MAX_URLS', 0),
+                                 is_external=self.gf.is_external,
+                                 memory_limit=self.settings.get('FRONTIER_MEMORY_LIMIT', 0),
+                                 spill_dir=path.dirname(path.abspath(self.db_file)) if self.db_file else None)
+
     def start_consumer(self) -> None:
         """Starts a single thread responsible for storing crawl data in the database."""
+        self.init_parser()
+        target = self.consumer_worker
+        if int(self.settings.get('PROFILE_CONSUMER', 0)):
+            target = self.profile_consumer
         self.consumer_thread = Thread(
-            target=self.consumer_worker, name='consumer')
+            target=target, name='consumer')
         self.consumer_thread.start()
 
+    def init_parser(self) -> None:
+        """Sets up the parse stage as defined in self.settings. Needs to be called after the robots.txt has been requested."""
+        if self.parser:
+            self.parser.close()
+        self.parser = GFlareParser(self.settings, self.gf.all_items, robots_txt=getattr(self.gf, 'robots_txt', ''),
+                                   mode=self.settings.get('PARSE_MODE', 'inline'),
+                                   workers=int(self.settings.get('PARSE_WORKERS', 0)), metrics=self.metrics)
+
     def spawn_threads(self) -> None:
-        """Starts n crawl worker threads as defined in self.settings"""
-        if self.crawl_running.is_set() == False:
+        """Starts n crawl worker threads as defined in self.settings or a single thread running the asyncio engine"""
+        if self.crawl_running.is_set() == False and self.use_async_engine():
+            from greenflare.core.gflareasync import GFlareAsyncEngine
+            engine = GFlareAsyncEngine(self)
+            Thread(target=engine.run, name='worker-async').start()
+        elif self.crawl_running.is_set() == False:
             threads = int(self.settings['THREADS'])
+            if self.concurrency:
+                # Idle workers wait for a slot of the controller
+                threads = self.concurrency.ceiling
             for i in range(threads):
                 tname = f'worker-{i}'
                 t = Thread(target=self.crawl_worker, name=tname, args=(tname,))
@@ -236,6 +467,20 @@ class GFlareCrawler:
         if self.stats:
             Thread(target=self.urls_per_second_stats, name='stats').start()
 
+    def use_async_engine(self) -> bool:
+        """Returns True if the asyncio fetch engine has been selected and aiohttp is installed."""
+        if self.settings.get('FETCH_ENGINE', 'threads') != 'asyncio':
+            return False
+        if self.settings.get('REPLAY_FROM', ''):
+            print('WARNING: responses are replayed through the requests session, falling back to threads')
+            return False
+        # Imported on demand, aiohttp takes a while to load
+        from greenflare.core.gflareasync import GFlareAsyncEngine
+        if not GFlareAsyncEngine.is_available():
+            print('WARNING: aiohttp is not installed, falling back to threads')
+            return False
+        return True
+
     def wait_for_workers(self) -> None:
         """Waits for all worker threads to join/finish."""
         for t in tenum():
@@ -244,16 +489,8 @@ class GFlareCrawler:
         print('All workers joined ...')
 
     def urls_per_second_stats(self) -> None:
-        """Thread-safe: Sets crawl statistics. Meant to be run as single tread. Controls URL limit."""
+        """Thread-safe: Sets crawl statistics. Meant to be run as single tread. URL limits are enforced by the scheduler."""
 
-        url_limit = int(self.settings.get('URLS_PER_SECOND', 0))
-        step = 0.1
-
-        # Set initial limit depending on the number of threads
-        # FIXME: Move the url_limit control to a dedicated function
-        if url_limit > 0:
-            self.rate_limit_delay = 1 / url_limit * \
-                int(self.settings.get('THREADS', 1)) * step
         while self.crawl_running.is_set() == False:
             with self.lock:
                 old = self.urls_crawled
@@ -263,17 +500,51 @@ class GFlareCrawler:
 
             with self.lock:
                 self.current_urls_per_second = self.urls_crawled - old
+            self.scheduler.update_rates()
 
-                if url_limit > 0 and self.current_urls_per_second > url_limit:
-                    self.rate_limit_delay += step
-                elif url_limit > 0 and self.current_urls_per_second <= url_limit:
-                    if self.rate_limit_delay - step > 0:
-                        self.rate_limit_delay -= step
-                    else:
-                        self.rate_limit_delay = 0
         with self.lock:
             self.current_urls_per_second = 0
 
+    def get_host_limits(self, url: str) -> tuple:
+        """Returns (requests per second, max connections) for the host of url. The URL limit only applies to the crawled site, external hosts have their own limit."""
+        max_connections = int(self.settings.get('MAX_CONNECTIONS_PER_HOST', 0))
+        if self.gf.is_external(url):
+            return float(self.settings.get('EXTERNAL_URLS_PER_SECOND', 0)), max_connections
+        return float(self.settings.get('URLS_PER_SECOND', 0)), max_connections
+
+    def set_crawl_delay(self, url: str) -> None:
+        """Applies the Crawl-delay of the parsed robots.txt to the host of url."""
+        if 'respect_robots_txt' in self.settings.get('CRAWL_ITEMS', ''):
+            self.scheduler.set_crawl_delay(url, self.gf.gfrobots.crawl_delay)
+
+    def get_host_rates(self) -> dict:
+        """Returns the achieved URLs per second for every requested host."""
+        return self.scheduler.get_host_rates()
+
+    def get_url(self, timeout=1):
+        """
+        Returns the next URL the scheduler allows to be requested now, its host slot is already reserved.
+        URLs of throttled hosts stay in the frontier so other hosts can be crawled meanwhile.
+        Returns None if no URL became available within timeout.
+        """
+        deadline = time() + timeout
+
+        while True:
+            url, wait = self.scheduler.pop_ready()
+            if url:
+                return url
+
+            remaining = deadline - time()
+            if remaining <= 0:
+                return None
+            if wait is not None:
+                remaining = min(remaining, wait)
+
+            try:
+                return self.url_queue.get(timeout=remaining, acquire=self.scheduler.acquire)
+            except queue.Empty:
+                continue
+
     def init_session(self):
         """
         All worker threads share the same session object.
@@ -284,7 +555,7 @@ class GFlareCrawler:
         self.session.headers.update(self.HEADERS)
         status_forcelist = (500, 502, 504)
         retries = self.settings.get('MAX_RETRIES', 0)
-        self.header_only = False
+        self.header_only = 'header_only' in self.settings.get('CRAWL_ITEMS', '')
 
         if self.settings.get('PROXY_HOST', '') != '':
             if self.settings.get('PROXY_USER', '') == '':
@@ -296,13 +567,30 @@ class GFlareCrawler:
             self.session.auth = (
                 self.settings['AUTH_USER'], self.settings['AUTH_PASSWORD'])
 
+        if self.settings.get('REPLAY_FROM', ''):
+            self.init_replay()
+
+    def init_replay(self) -> None:
+        """Answers all requests of the session with the responses recorded at REPLAY_FROM, delayed by REPLAY_LATENCY (+ up to REPLAY_JITTER) seconds."""
+        if self.replay is None:
+            self.replay = open_replay_source(self.settings['REPLAY_FROM'])
+        adapter = GFlareReplayAdapter(self.replay, latency=float(self.settings.get('REPLAY_LATENCY', 0)),
+                                      jitter=float(self.settings.get('REPLAY_JITTER', 0)))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
     def response_to_data(self, response) -> dict:
         """Function to parse a requests object into a gflare resposne dict."""
         self.gf.set_response(response)
         return self.gf.get_data()
 
-    def crawl_url(self, url, header_only=False) -> dict:
-        """Crawl any given URL."""
+    @profiled
+    def crawl_url(self, url, header_only=False, retry=True, conditional=True) -> dict:
+        """
+        Crawl any given URL. Failed requests are retried later unless retry is False.
+        During incremental recrawls (and unless conditional is False) requests are conditional and
+        unchanged pages are returned as the crawl data of the previous crawl.
+        """
 
         header = None
         body = None
@@ -317,59 +605,170 @@ class GFlareCrawler:
             if self.gf.is_external(url):
                 header_only = True
 
+        validators = None
+        headers = None
+        if conditional and self.previous:
+            validators = self.previous.get_validators(url)
+            if validators:
+                headers = self.previous.get_headers(validators)
+
         try:
-            if header_only:
+            if header_only or self.header_only:
                 header = self.session.head(
-                    url, allow_redirects=True, timeout=timeout)
-                return header
-
-            header = self.session.head(
-                url, allow_redirects=True, timeout=timeout)
-
-            content_type = header.headers.get('content-type', '')
-            if 'text' in content_type:
+                    url, headers=headers, allow_redirects=True, timeout=timeout)
+                response = GFlareFetchResult.from_requests(header, content=b'')
+                self.archive(url, header, content=b'')
+            else:
+                # Single round trip: status and headers are read first, the body
+                # is only downloaded for text content
                 body = self.session.get(
-                    url, allow_redirects=True, timeout=timeout)
-                return body
-
-            return header
+                    url, headers=headers, allow_redirects=True, timeout=timeout, stream=True)
+
+                content_type = body.headers.get('content-type', '')
+                limit = self.get_body_limit(lambda: abort_requests(body))
+                if 'text' in content_type:
+                    content = limit.read(body.iter_content(chunk_size=limit.chunk_size))
+                    response = GFlareFetchResult.from_requests(body, content=content, truncated=limit.truncated)
+                    self.archive(url, body, content=content, limit=limit)
+                    if limit.truncated:
+                        # Drops the rest of the body, the connection cannot be reused
+                        body.close()
+                elif self.warc:
+                    # The archive needs the body anyway
+                    self.archive(url, body, limit=limit)
+                    response = GFlareFetchResult.from_requests(body, content=b'')
+                    if limit.truncated:
+                        body.close()
+                else:
+                    self.discard_body(body)
+                    response = GFlareFetchResult.from_requests(body, content=b'')
         except exceptions.TooManyRedirects:
-            return self.deal_with_exception(url, 'Too Many Redirects')
+            return self.deal_with_exception(url, 'Too Many Redirects', retry=retry)
 
         except exceptions.ConnectionError:
-            return self.deal_with_exception(url, 'Connection Refused')
+            return self.deal_with_exception(url, 'Connection Refused', retry=retry)
 
         except exceptions.ReadTimeout:
-            return self.deal_with_exception(url, 'Read timed out')
+            return self.deal_with_exception(url, 'Read timed out', retry=retry)
 
         except exceptions.InvalidURL:
-            return self.deal_with_exception(url, 'Invalid URL')
+            return self.deal_with_exception(url, 'Invalid URL', retry=retry)
 
         except Exception as e:
-            return self.deal_with_exception(url, 'Unknown Exception')
+            return self.deal_with_exception(url, 'Unknown Exception', retry=retry)
+
+        # Bodies of 304s are with the earlier crawl
+        if self.response_store and not (validators and response.status_code == 304):
+            self.response_store.put(url, response)
+        if validators:
+            return self.previous.take_over(url, response, validators)
+        return response
+
+    def get_body_limit(self, abort=None) -> GFlareBodyLimit:
+        """Returns a fresh limit for reading a single body as configured (MAX_BODY_BYTES, MAX_DOWNLOAD_SECONDS)."""
+        return GFlareBodyLimit(max_bytes=int(self.settings.get('MAX_BODY_BYTES', 0)),
+                               max_seconds=float(self.settings.get('MAX_DOWNLOAD_SECONDS', 0)), abort=abort)
+
+    def is_overloaded(self, response) -> bool:
+        """Returns True if the fetch result of crawl_url hints at an overloaded site: failed requests, 5xx and 429."""
+        if isinstance(response, str):
+            # Failed requests are retried later
+            return True
+        if isinstance(response, dict):
+            # Taken over from the previous crawl or out of retries
+            return not response.get('unchanged')
+        return response.status_code == 429 or response.status_code >= 500
+
+    def record_fetch(self, url: str, response, latency: float) -> None:
+        """Feeds the metrics and the adaptive concurrency controller. Only requests to the crawled site count for the latter."""
+        self.metrics.observe('greenflare_fetch_seconds', latency)
+        if isinstance(response, str) or isinstance(response, dict) and not response.get('unchanged'):
+            self.metrics.inc('greenflare_responses_total', status_code='error')
+        elif isinstance(response, dict):
+            self.metrics.inc('greenflare_responses_total', status_code='unchanged')
+        else:
+            self.metrics.inc('greenflare_responses_total', status_code=response.status_code)
+            self.metrics.inc('greenflare_response_bytes_total', len(response.content))
 
-    def deal_with_exception(self, url: str, issue: str) -> dict:
-        """Adds URL back to the URL queue until the retry threshold has been reached. Returns mock string instead."""
+        if not self.concurrency:
+            return
         with self.lock:
-            attempts = self.url_attempts.get(url, 0)
-
-        if attempts >= self.retries:
+            if self.gf.is_external(url):
+                return
+        self.concurrency.record(latency, self.is_overloaded(response))
+
+    def discard_body(self, response) -> None:
+        """Drops the body of a streamed response. Small bodies are drained so the connection can be reused, otherwise the connection is closed."""
+        length = response.headers.get('content-length', '')
+        if length.isdigit() and int(length) <= self.drain_limit:
+            for _ in response.iter_content(chunk_size=self.drain_limit):
+                pass
+        response.close()
+
+    def deal_with_exception(self, url: str, issue: str, retry=True) -> dict:
+        """Schedules a delayed retry of URL until the retry threshold has been reached. Returns mock string instead."""
+        if not retry:
+            # Requested outside of the URL queue, e.g. robots.txt
+            return 'SKIP_ME'
+        attempts = self.count_attempt(url)
+
+        if attempts is None:
+            with self.lock:
+                attempts = self.url_attempts.get(url, 0)
             print(f"{url} {issue} after {attempts} attempts.")
             return {'url': url, 'data': [tuple([url, issue.lower(), '0', ''] + [''] * (len(self.columns) - 4))], 'links': []}
 
-        with self.lock:
-            self.url_attempts[url] = self.url_attempts.get(url, 0) + 1
+        self.scheduler.schedule_retry(url, self.get_retry_delay(attempts))
+        self.metrics.inc('greenflare_retries_total', reason='error')
+        return 'SKIP_ME'
 
-        self.add_to_url_queue([url], count=False)
+    def deal_with_throttling(self, url: str, response):
+        """
+        Schedules a retry of URLs answered with 429 or 503 honouring Retry-After. The whole host is paused for 429s
+        and whenever the server asked for a delay. Returns the response once out of retries, mock string otherwise.
+        """
+        if isinstance(response, (str, dict)) or response.status_code not in (429, 503):
+            return response
+
+        attempts = self.count_attempt(url)
+        if attempts is None:
+            return response
+
+        delay = parse_retry_after(response.headers.get('retry-after', ''))
+        # A 503 without Retry-After may only concern this URL, 429 always concerns the host
+        pause_host = delay is not None or response.status_code == 429
+        if delay is None:
+            delay = self.get_retry_delay(attempts)
+        delay = min(delay, float(self.settings.get('RETRY_MAX_DELAY', 60)))
+
+        self.scheduler.schedule_retry(url, delay, pause_host=pause_host)
+        self.metrics.inc('greenflare_retries_total', reason=response.status_code)
         return 'SKIP_ME'
 
-    def add_to_url_queue(self, urls: list, count=True) -> None:
-        """Append and count (enabled by default) a list of URLs to the URL queue."""
+    def count_attempt(self, url: str):
+        """Counts a failed attempt of URL. Returns the number of attempts or None if the retry threshold has been reached."""
+        with self.lock:
+            attempts = self.url_attempts.get(url, 0)
+            if attempts >= self.retries:
+                return None
+            self.url_attempts[url] = attempts + 1
+            self.attempts_changed.add(url)
+            return attempts + 1
+
+    def get_retry_delay(self, attempts: int) -> float:
+        """Exponential backoff with jitter so retries of many URLs do not hit a host in lockstep."""
+        base = float(self.settings.get('RETRY_BACKOFF', 1))
+        delay = min(base * 2 ** (attempts - 1), float(self.settings.get('RETRY_MAX_DELAY', 60)))
+        return uniform(delay / 2, delay)
+
+    def add_to_url_queue(self, urls: list, count=True, depth=None, parent=None) -> None:
+        """Append and count (enabled by default) a list of URLs to the URL queue. URLs without depth keep their previous depth."""
         if count:
             with self.lock:
                 self.urls_total += len(urls)
+        self.tracker.add(len(urls))
         for url in urls:
-            self.url_queue.put(url)
+            self.url_queue.put(url, depth=depth, parent=parent)
 
     def add_to_gui_queue(self, data: dict) -> None:
         """Add gflare response dict data object to GUI queue."""
@@ -407,15 +806,32 @@ class GFlareCrawler:
 
         while self.crawl_running.is_set() == False:
             if not response:
-                sleep(self.rate_limit_delay)
                 self.clock_workers(False)
-                url = self.url_queue.get()
+                if self.concurrency and not self.concurrency.acquire(timeout=timeout):
+                    self.clock_workers(True)
+                    continue
+                url = self.get_url()
                 self.clock_workers(True)
 
-                if url == "END":
+                if url is None or url == "END":
+                    if self.concurrency:
+                        self.concurrency.release()
+                    if url is None:
+                        continue
                     break
 
-                response = self.crawl_url(url)
+                try:
+                    started = time()
+                    response = self.crawl_url(url)
+                    self.record_fetch(url, response, time() - started)
+                    response = self.deal_with_throttling(url, response)
+                finally:
+                    self.scheduler.release(url)
+                    if self.concurrency:
+                        self.concurrency.release()
+
+                if not isinstance(response, str):
+                    response = self.parser.submit(response)
 
             if isinstance(response, str):
                 response = None
@@ -437,67 +853,195 @@ class GFlareCrawler:
             if 'worker-' in t.name:
                 self.url_queue.put('END')
 
+    def notify_consumer_to_stop(self) -> None:
+        """Wakes up the consumer waiting for data. If the data queue is full the consumer is busy and notices crawl_running anyway."""
+        try:
+            self.data_queue.put_nowait('END')
+        except queue.Full:
+            pass
+
     def consumer_worker(self) -> None:
         """Function to be run as a _single_ consumer Thread. Extracts information from request responses and inserts data into the database."""
 
-        db = self._connect_to_db()
-        
-        while not self.crawl_running.is_set():
+        db = self._connect_to_db(autocommit=False)
+
+        # Group commit: writes are committed once COMMIT_BATCH_SIZE rows are
+        # pending or the oldest pending write is COMMIT_INTERVAL seconds old
+        batch_size = int(self.settings.get('COMMIT_BATCH_SIZE', 500))
+        interval = float(self.settings.get('COMMIT_INTERVAL', 0.25))
+        pending = 0
+        gui_rows = []
+        batch_started = 0
+
+        # Nothing to crawl at all
+        completed = self.tracker.complete(0)
+
+        while not completed and not self.crawl_running.is_set():
+            # Only wait for the commit window, completion and stop requests are signalled through the queue
+            timeout = None
+            if pending:
+                timeout = max(interval - (time() - batch_started), 0)
+
             try:
-                response = self.data_queue.get(timeout=1)
+                response = self.data_queue.get(timeout=timeout)
             except queue.Empty:
-                if self.get_buys_workers() == 0 and self.url_queue.empty():
-                    # Ugly hack to ensure that ALL remaining URLs have been crawled
-                    # Otherwise, the above check is not fail safe and URLs may be overlooked
-                    remaining_urls = db.get_url_queue()
-                    if remaining_urls:
-                        self.add_to_url_queue(remaining_urls, count=False)
-                    else:
-                        self.crawl_running.set()
-                        self.crawl_completed.set()
-                        self.notify_crawl_workers_to_stop()
-                        break
+                pending = self.commit_batch(db, gui_rows)
                 continue
 
-            if isinstance(response, dict):
-                data = response
-            else:
-                data = self.response_to_data(response)
+            if response == 'END':
+                # Completion may also be signalled by another process sharing the tracker
+                completed = self.tracker.is_finished()
+                break
 
-            crawl_data = data['data']
-            new, updated = db.insert_new_data(crawl_data)
-
-            with self.lock:
-                self.urls_crawled += len(updated) + len(new)
-                self.urls_total += len(new)
-            if self.gui_mode:
-                if new or updated:
-                    self.add_to_gui_queue(new + updated)
+            data = self.parser.get_data(response)
+            if not pending:
+                batch_started = time()
 
-            extracted_links = data.get('links', [])
+            started = time()
+            rows, completed = self.store_data(db, data, gui_rows)
+            self.metrics.observe('greenflare_db_write_seconds', time() - started, operation='store')
+            pending += rows
 
-            if len(extracted_links) > 0:
-                new_urls = db.get_new_urls(extracted_links)
-                if len(new_urls) > 0:
-                    db.insert_new_urls(new_urls)
-                    self.add_to_url_queue(new_urls)
-
-                if 'unique_inlinks' in self.settings.get('CRAWL_ITEMS', ''):
-                    db.insert_inlinks(extracted_links, data['url'])
+            if pending >= batch_size or time() - batch_started >= interval:
+                pending = self.commit_batch(db, gui_rows)
 
         # Outside while loop, wrap things up
+        self.commit_batch(db, gui_rows)
+        if self.concurrency:
+            db.insert_concurrency(self.concurrency.get_history())
+        if completed:
+            self.crawl_completed.set()
         self.crawl_running.set()
 
-        if not self.crawl_completed.is_set():
+        if completed:
+            # Releases the on-disk segment of the frontier
+            self.url_queue.clear()
+            self.notify_crawl_workers_to_stop()
+        else:
             # Empty our URL Queue first
-            with self.url_queue.mutex:
-                self.url_queue.queue.clear()
+            self.url_queue.clear()
+            self.scheduler.clear()
             self.notify_crawl_workers_to_stop()
 
         db.close()
+        self.parser.close()
         self.session.close()
+        if self.replay:
+            self.replay.close()
+            self.replay = None
+        if self.response_store:
+            # Responses of workers still busy are dropped, they are requested again on resume
+            self.response_store.close()
+        if self.warc:
+            self.warc.close()
+        self.metrics.close()
+        if profiler.enabled:
+            self.write_profile()
         print('Consumer thread finished')
 
+    @profiled
+    def store_data(self, db: GFlareDB, data: dict, gui_rows: list) -> tuple:
+        """Writes the parsed data of a single response and queues its new links. Returns the number of written rows and whether the crawl is complete."""
+        depth = self.url_queue.done(data.get('request_url', data['url']))
+        rows = self.store_rows(db, self.set_depth(data['data'], depth, db.columns), gui_rows)
+
+        extracted_links = data.get('links', [])
+
+        if data.get('validators'):
+            db.insert_validators([(data['url'], *data['validators'], '\n'.join(extracted_links))])
+        if data.get('unchanged'):
+            with self.lock:
+                self.urls_unchanged += 1
+        if self.warc:
+            with self.lock:
+                records = self.warc_records.pop(data.get('request_url', data['url']), None)
+            if records:
+                db.insert_warc_records(records)
+
+        if len(extracted_links) > 0:
+            rows += self.queue_links(db, extracted_links, depth + 1, data['url'])
+
+            if 'unique_inlinks' in self.settings.get('CRAWL_ITEMS', ''):
+                db.insert_inlinks(extracted_links, data['url'])
+
+        # Links have been queued (and counted) before, so this only completes once no work is left
+        return rows, self.tracker.complete()
+
+    def store_rows(self, db: GFlareDB, crawl_data: list, gui_rows: list) -> int:
+        """Writes crawl data rows (the requested URL and its redirects) and counts them. Returns the number of written rows."""
+        new_rows = set(self.seen.add_new([row[0] for row in crawl_data]))
+        if len(new_rows) < len(crawl_data) and 'depth' in db.columns:
+            # Queued redirect targets have been reached with the depth of the redirecting URL
+            i = db.columns.index('depth')
+            for row in crawl_data:
+                if row[0] not in new_rows and isinstance(row[i], int):
+                    self.lower_depth(db, [row[0]], row[i], None)
+        new, updated = db.insert_new_data(
+            crawl_data, new_urls=new_rows, verify=not self.seen.is_exact())
+        if updated and self.url_queue.backlog is not None:
+            # URLs of the not yet paged backlog of a resumed crawl would never be paged and completed
+            skipped = self.url_queue.skip_backlog(db.get_ids([row[0] for row in updated]))
+            if skipped:
+                self.tracker.complete(skipped)
+
+        with self.lock:
+            self.urls_crawled += len(updated) + len(new)
+            self.urls_total += len(new)
+        if self.gui_mode:
+            gui_rows += new + updated
+        return len(crawl_data)
+
+    def queue_links(self, db: GFlareDB, links: list, depth: int, parent: str) -> int:
+        """
+        Queues the unseen links found on parent as far as the crawl budgets allow. Returns the number of URLs written.
+        Links that are already waiting to be crawled get the lower depth if parent is a shorter path to them.
+        """
+        # Links beyond max depth are not marked as seen, a shorter path may still reach them
+        if self.url_queue.is_too_deep(depth):
+            return 0
+        new = self.seen.add_new(links)
+        if len(new) < len(links):
+            new_set = set(new)
+            self.lower_depth(db, [url for url in links if url and url not in new_set], depth, parent)
+
+        new_urls = self.url_queue.admit(new, depth)
+        if len(new_urls) > 0:
+            db.insert_new_urls(new_urls, depth=depth)
+            self.add_to_url_queue(new_urls, depth=depth, parent=parent)
+        return len(new_urls)
+
+    def lower_depth(self, db: GFlareDB, urls: list, depth: int, parent: str) -> None:
+        """Lowers the depth of not yet crawled URLs that have been found on a shorter path."""
+        lowered = self.url_queue.lower_depth(urls, depth, parent)
+        if self.url_queue.backlog is not None:
+            # URLs in the not yet paged backlog of a resumed crawl are only known to the crawl table
+            lowered = urls
+        if lowered:
+            db.lower_depth(lowered, depth)
+
+    @profiled
+    def commit_batch(self, db: GFlareDB, gui_rows: list) -> int:
+        """Commits all pending writes and only then hands their rows to the GUI. Returns the new number of pending rows (0)."""
+        with self.lock:
+            attempts = {url: self.url_attempts[url] for url in self.attempts_changed}
+            self.attempts_changed = set()
+        started = time()
+        if attempts:
+            db.insert_attempts(attempts)
+        db.flush()
+        self.metrics.observe('greenflare_db_write_seconds', time() - started, operation='commit')
+        if gui_rows:
+            self.add_to_gui_queue(gui_rows[:])
+            del gui_rows[:]
+        return 0
+
+    def set_depth(self, rows: list, depth: int, columns: list) -> list:
+        """Sets the depth column of crawl data rows (if the crawl records depth)."""
+        if 'depth' not in columns:
+            return rows
+        i = columns.index('depth')
+        return [row[:i] + (depth,) + row[i + 1:] for row in rows]
+
     def get_crawl_data(self, filters: list, table: str, columns=None):
         """Requests data from a db table based on optional filters and columns.
 
@@ -506,11 +1050,10 @@ class GFlareCrawler:
                 empty list (list): empty list if no db_file has been defined yet.
         """
         if self.db_file:
-            db = self._connect_to_db()
-            data = db.query(filters, table, columns=columns)
-            if columns == '*' or not columns:
-                columns = db.get_table_columns(table=table)
-            db.close()
+            with self.get_readers().reader() as db:
+                data = db.query(filters, table, columns=columns)
+                if columns == '*' or not columns:
+                    columns = db.get_table_columns(table=table)
             return columns, data
         return []
 
@@ -524,25 +1067,22 @@ class GFlareCrawler:
     def get_columns(self, table='crawl') -> list:
         """Retrieve columns from database table. Return empty list if no db file is known."""
         if self.db_file:
-            db = self._connect_to_db()
-            columns = db.get_table_columns(table=table)
-            db.close()
-            return columns
+            with self.get_readers().reader() as db:
+                return db.get_table_columns(table=table)
         return []
 
     def get_inlinks(self, url: str) -> list:
         """Returns a list of URLs linking to input url."""
         if self.db_file:
-            db = self._connect_to_db()
-            inlinks = db.get_inlinks(url)
-            db.close()
-            return inlinks
+            with self.get_readers().reader() as db:
+                return db.get_inlinks(url)
         return []
 
     def end_crawl_gracefully(self) -> None:
         """End all crawl workers and save config before exit."""
         print('Ending all worker threads gracefully ...')
         self.crawl_running.set()
+        self.notify_consumer_to_stop()
         self.wait_for_workers()
         try:
             self.save_config(self.settings)
@@ -22,15 +22,30 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+from greenflare.core.gflareprofiler import profiled
+from contextlib import contextmanager
+from threading import Lock
 import sqlite3 as sqlite
 import functools
+import queue
 import re
 
 
 class GFlareDB:
 
-    def __init__(self, db_name, crawl_items=None, extractions=None, exclusions=None):
+    # Applied to every connection. WAL lets readers (GUI, exports) run
+    # alongside the consumer's writes without blocking each other.
+    pragmas = {
+        'synchronous': 'NORMAL',
+        'cache_size': -64000,
+        'mmap_size': 268435456,
+        'temp_store': 'MEMORY'
+    }
+
+    def __init__(self, db_name, crawl_items=None, extractions=None, exclusions=None, check_same_thread=True, autocommit=True, read_only=False):
         self.db_name = db_name
+        # Without autocommit writes are only committed by flush() (or close())
+        self.autocommit = autocommit
 
         self.columns_map = {
             "url": "TEXT type UNIQUE",
@@ -46,13 +61,17 @@ class GFlareDB:
             "redirect_url": "TEXT",
             "meta_robots": "TEXT",
             "x_robots_tag": "TEXT",
+            "depth": "INT",
         }
 
         self.crawl_items = crawl_items
         self.extractions = extractions
 
-        self.con = sqlite.connect(self.db_name)
+        self.read_only = read_only
+
+        self.con = sqlite.connect(self.db_name, check_same_thread=check_same_thread)
         self.con.create_function("REGEXP", 2, self.regexp)
+        self.tune()
         self.columns = self.get_columns()
         self.columns_total = len(self.columns)
 
@@ -68,6 +87,20 @@ class GFlareDB:
                 print(e)
         return wrapper
 
+    def tune(self):
+        cur = self.con.cursor()
+        if not self.read_only:
+            try:
+                # Persistent, only needs to succeed once per database file
+                cur.execute('PRAGMA journal_mode=WAL')
+            except sqlite.OperationalError:
+                pass
+        for pragma, value in self.pragmas.items():
+            cur.execute(f'PRAGMA {pragma}={value}')
+        if self.read_only:
+            cur.execute('PRAGMA query_only=ON')
+        cur.close()
+
     @exception_handler
     def check_if_table_exists(self, table_name):
         cur = self.con.cursor()
@@ -123,6 +156,10 @@ class GFlareDB:
         self.create_data_table()
         self.create_config_table()
         self.create_inlinks_table()
+        self.create_attempts_table()
+        self.create_validators_table()
+        self.create_warc_table()
+        self.create_concurrency_table()
         self.create_exclusions_table()
         self.create_extractions_table()
         self.create_views()
@@ -158,6 +195,97 @@ class GFlareDB:
             "CREATE TABLE IF NOT EXISTS inlinks(id INTEGER PRIMARY KEY, url_from_id INTEGER, url_to_id INTEGER, UNIQUE(url_from_id, url_to_id))")
         cur.close()
 
+    @exception_handler
+    def create_attempts_table(self):
+        cur = self.con.cursor()
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS attempts(url TEXT PRIMARY KEY, attempts INT)")
+        cur.close()
+
+    @exception_handler
+    def insert_attempts(self, attempts):
+        cur = self.con.cursor()
+        cur.executemany(
+            "INSERT OR REPLACE INTO attempts VALUES(?, ?)", attempts.items())
+        cur.close()
+        self.commit()
+
+    @exception_handler
+    def get_attempts(self):
+        cur = self.con.cursor()
+        cur.execute("SELECT url, attempts FROM attempts")
+        attempts = dict(cur.fetchall())
+        cur.close()
+        return attempts
+
+    @exception_handler
+    def create_validators_table(self):
+        # Outlinks are kept so unchanged pages do not need to be parsed again
+        cur = self.con.cursor()
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS validators(url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, content_hash TEXT, links TEXT)")
+        cur.close()
+
+    @exception_handler
+    def insert_validators(self, rows):
+        cur = self.con.cursor()
+        cur.executemany(
+            "INSERT OR REPLACE INTO validators VALUES(?, ?, ?, ?, ?)", rows)
+        cur.close()
+        self.commit()
+
+    @exception_handler
+    def get_validators(self, url):
+        cur = self.con.cursor()
+        cur.execute(
+            "SELECT etag, last_modified, content_hash, links FROM validators WHERE url = ?", (url,))
+        result = cur.fetchone()
+        cur.close()
+        return result
+
+    @exception_handler
+    def get_row(self, url):
+        cur = self.con.cursor()
+        cur.execute(
+            f"SELECT {', '.join(self.columns)} FROM crawl WHERE url = ? AND status_code != ''", (url,))
+        result = cur.fetchone()
+        cur.close()
+        if result is None:
+            return None
+        return dict(zip(self.columns, result))
+
+    @exception_handler
+    def create_warc_table(self):
+        cur = self.con.cursor()
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS warc(record_id TEXT PRIMARY KEY, url_id INTEGER)")
+        cur.close()
+
+    @exception_handler
+    def insert_warc_records(self, records):
+        # records are (url, WARC-Record-ID) of crawled URLs
+        cur = self.con.cursor()
+        cur.executemany(
+            "INSERT OR REPLACE INTO warc SELECT ?, id FROM crawl WHERE url = ?", [(rid, url) for url, rid in records if rid])
+        cur.close()
+        self.commit()
+
+    @exception_handler
+    def create_concurrency_table(self):
+        # Limits chosen by the adaptive concurrency controller over time
+        cur = self.con.cursor()
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS concurrency(time REAL, concurrency INT, p95_latency REAL, error_rate REAL)")
+        cur.close()
+
+    @exception_handler
+    def insert_concurrency(self, history):
+        cur = self.con.cursor()
+        cur.executemany(
+            "INSERT INTO concurrency VALUES(?, ?, ?, ?)", history)
+        cur.close()
+        self.commit()
+
     @exception_handler
     def create_extractions_table(self):
         cur = self.con.cursor()
@@ -240,6 +368,12 @@ class GFlareDB:
 
     @exception_handler
     def commit(self):
+        if self.autocommit:
+            self.con.commit()
+
+    @profiled
+    @exception_handler
+    def flush(self):
         self.con.commit()
 
     @exception_handler
@@ -274,6 +408,8 @@ class GFlareDB:
 
     @exception_handler
     def close(self):
+        if not self.autocommit:
+            self.con.commit()
         self.con.close()
 
     @exception_handler
@@ -285,12 +421,28 @@ class GFlareDB:
         [print(row) for row in rows]
 
     @exception_handler
-    def get_url_queue(self):
+    def get_max_id(self):
         cur = self.con.cursor()
-        cur.row_factory = lambda cursor, row: row[0]
-        cur.execute("SELECT url from crawl where status_code = ''")
+        cur.execute("SELECT max(id) FROM crawl")
+        result = cur.fetchone()[0]
+        cur.close()
+        return result or 0
+
+    @exception_handler
+    def get_url_queue_size(self):
+        cur = self.con.cursor()
+        cur.execute("SELECT count(*) FROM crawl WHERE status_code = ''")
+        result = cur.fetchone()[0]
+        cur.close()
+        return result
+
+    @exception_handler
+    def get_url_queue_page(self, after_id, max_id, limit):
+        depth = 'depth' if 'depth' in self.columns else '0'
+        cur = self.con.cursor()
+        cur.execute(
+            f"SELECT id, url, {depth} FROM crawl WHERE status_code = '' AND id > ? AND id <= ? ORDER BY id LIMIT ?", (after_id, max_id, limit))
         rows = cur.fetchall()
-        cur.row_factory = None
         cur.close()
         return rows
 
@@ -401,6 +553,7 @@ class GFlareDB:
     def chunk_list(self, l: list, chunk_size=100) -> list:
         return [l[i * chunk_size:(i + 1) * chunk_size] for i in range((len(l) + chunk_size - 1) // chunk_size)]
 
+    @profiled
     def get_new_urls(self, links, chunk_size=999, check_crawled=False):
         cur = self.con.cursor()
         cur.row_factory = lambda cursor, row: row[0]
@@ -428,16 +581,31 @@ class GFlareDB:
             return []
         return urls_not_in_db
 
+    @profiled
     @exception_handler
-    def insert_new_urls(self, urls):
+    def insert_new_urls(self, urls, depth=None):
         urls = list(set(urls))
-        rows = [tuple([url] + [""] * (self.columns_total - 1)) for url in urls]
+        row = [""] * (self.columns_total - 1)
+        if depth is not None and 'depth' in self.columns:
+            row[self.columns.index('depth') - 1] = depth
+        rows = [tuple([url] + row) for url in urls]
         query = f"INSERT OR IGNORE INTO crawl VALUES(NULL, {','.join(['?'] * self.columns_total)})"
         cur = self.con.cursor()
         cur.executemany(query, rows)
         cur.close()
         self.commit()
 
+    @exception_handler
+    def lower_depth(self, urls, depth):
+        """Lowers the depth of not yet crawled URLs that have been found on a shorter path."""
+        if 'depth' not in self.columns:
+            return
+        cur = self.con.cursor()
+        cur.executemany("UPDATE crawl SET depth = ? WHERE url = ? AND status_code = '' AND depth > ?",
+                        [(depth, url, depth) for url in urls])
+        cur.close()
+        self.commit()
+
     @exception_handler
     def get_ids(self, urls):
         chunks = self.chunk_list(urls, chunk_size=999)
@@ -454,6 +622,7 @@ class GFlareDB:
         cur.close()
         return results
 
+    @profiled
     @exception_handler
     def insert_inlinks(self, urls, from_url):
         from_id = self.get_ids([from_url])
@@ -489,11 +658,52 @@ class GFlareDB:
         self.commit()
 
     @exception_handler
-    def insert_new_data(self, redirects):
+    def iter_urls(self, chunk_size=10000):
+        cur = self.con.cursor()
+        cur.row_factory = lambda cursor, row: row[0]
+        cur.execute("SELECT url FROM crawl")
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+        cur.close()
+
+    @exception_handler
+    def update_uncrawled_data(self, data, verify=False):
+        # Per row updates tell us which URLs had not been crawled yet
+        # without having to query them first
+        cur = self.con.cursor()
+        query = f"UPDATE crawl SET {self.items_to_sql(self.columns, op='= ?', remove='url')} WHERE url = ? AND status_code = ''"
+        updated = []
+        for row in data:
+            cur.execute(query, self.tuple_front_to_end(row))
+            if cur.rowcount == 1:
+                updated.append(row)
+            elif verify and not self.url_in_db(row[0]):
+                # Seen filter false positive, the URL is actually new
+                self.insert_crawl_data([row], new=True)
+        cur.close()
+        self.commit()
+        return updated
+
+    @profiled
+    @exception_handler
+    def insert_new_data(self, redirects, new_urls=None, verify=False):
         new_data = []
         updated_data = []
 
         all_urls = [u[0] for u in redirects]
+
+        if new_urls is not None:
+            # The caller already knows which URLs are new (seen filter)
+            new_data = [d for d in redirects if d[0] in new_urls]
+            if new_data:
+                self.insert_crawl_data(new_data, new=True)
+            updated_data = self.update_uncrawled_data(
+                [d for d in redirects if d[0] not in new_urls], verify=verify)
+            return (new_data, updated_data)
+
         new_urls = self.get_new_urls(all_urls)
 
         # Redirect URLs that were unknown before will be added immediately to
@@ -516,6 +726,50 @@ class GFlareDB:
 
         return (new_data, updated_data)
 
+    @exception_handler
+    def merge_crawl(self, db_file, crawled=True):
+        # Copies crawled (or still uncrawled) rows of a database with the
+        # same columns, URLs already in this database are kept
+        columns = ', '.join(self.columns)
+        condition = "!= ''" if crawled else "= ''"
+        self.con.commit()
+        cur = self.con.cursor()
+        cur.execute("ATTACH DATABASE ? AS other", (db_file,))
+        try:
+            cur.execute(
+                f"INSERT OR IGNORE INTO main.crawl ({columns}) SELECT {columns} FROM other.crawl WHERE status_code {condition} ORDER BY id")
+            self.con.commit()
+        finally:
+            cur.execute("DETACH DATABASE other")
+            cur.close()
+
+    @exception_handler
+    def merge_inlinks(self, db_file):
+        # Inlinks and attempts refer to URLs, so all crawl rows need to be
+        # merged first
+        self.con.commit()
+        cur = self.con.cursor()
+        cur.execute("ATTACH DATABASE ? AS other", (db_file,))
+        try:
+            cur.execute("""INSERT OR IGNORE INTO main.inlinks (url_from_id, url_to_id)
+                SELECT f.id, t.id FROM other.inlinks AS i
+                INNER JOIN other.crawl AS of ON of.id = i.url_from_id
+                INNER JOIN other.crawl AS ot ON ot.id = i.url_to_id
+                INNER JOIN main.crawl AS f ON f.url = of.url
+                INNER JOIN main.crawl AS t ON t.url = ot.url""")
+            cur.execute(
+                "INSERT OR REPLACE INTO main.attempts SELECT url, attempts FROM other.attempts")
+            cur.execute(
+                "INSERT OR REPLACE INTO main.validators SELECT * FROM other.validators")
+            cur.execute("""INSERT OR REPLACE INTO main.warc (record_id, url_id)
+                SELECT w.record_id, c.id FROM other.warc AS w
+                INNER JOIN other.crawl AS oc ON oc.id = w.url_id
+                INNER JOIN main.crawl AS c ON c.url = oc.url""")
+            self.con.commit()
+        finally:
+            cur.execute("DETACH DATABASE other")
+            cur.close()
+
     def create_view_non_ok_inlinks(self, table_name):
         query = f"CREATE VIEW IF NOT EXISTS {table_name} AS SELECT crawl.url as url_from, url_to, sc as status_code FROM (SELECT url_from_id, url as url_to, status_code as sc FROM crawl INNER JOIN inlinks ON inlinks.url_to_id = crawl.id WHERE status_code != 200) INNER JOIN crawl ON crawl.id = url_from_id"
         cur = self.con.cursor()
@@ -584,3 +838,75 @@ class GFlareDB:
         self.create_view_crawl_status(
             'crawl_status_blocked_by_robots', 'blocked')
         self.create_view_crawl_status('crawl_status_noindex', 'noindex')
+
+
+class GFlareDBPool:
+    """
+    Small pool of read-only connections to a crawl database so GUI and export queries do not open a new connection every time.
+    Connections lent out while the pool is closed are closed once they are returned.
+    """
+
+    def __init__(self, db_name, crawl_items=None, extractions=None, size=2):
+        self.db_name = db_name
+        self.crawl_items = crawl_items
+        self.extractions = extractions
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.closed = False
+        self.lock = Lock()
+
+    @contextmanager
+    def reader(self):
+        """Lends out a connection, waits for one to be returned if all of them are busy."""
+        db = self.acquire()
+        try:
+            yield db
+        finally:
+            self.release(db)
+
+    def acquire(self):
+        while True:
+            try:
+                return self.idle.get_nowait()
+            except queue.Empty:
+                pass
+            with self.lock:
+                # A closed pool does not keep connections, every reader gets its own
+                create = self.closed or self.created < self.size
+                if create:
+                    self.created += 1
+            if create:
+                try:
+                    return GFlareDB(self.db_name, crawl_items=self.crawl_items, extractions=self.extractions,
+                                    check_same_thread=False, read_only=True)
+                except Exception:
+                    with self.lock:
+                        self.created -= 1
+                    raise
+            try:
+                # Polls so a reader waiting while the pool is closed gets its own connection
+                return self.idle.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+    def release(self, db):
+        with self.lock:
+            if not self.closed:
+                self.idle.put(db)
+                return
+            self.created -= 1
+        db.close()
+
+    def close(self):
+        """Closes idle connections now and busy ones once they are returned."""
+        with self.lock:
+            self.closed = True
+        while True:
+            try:
+                db = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            with self.lock:
+                self.created -= 1
+            db.close()
@@ -0,0 +1,435 @@
+"""
+@author Benjamin Görler <ben@greenflare.io>
+
+@section LICENSE
+
+Greenflare SEO Web Crawler (https://greenflare.io)
+Copyright (C) 2020-2021 Benjamin Görler. This file is part of
+Greenflare, an open-source project dedicated to delivering
+high quality SEO insights and analysis solutions to the world.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# Protocol (JSON over HTTP). With a token every request needs an "Authorization: Bearer <token>" header (401 otherwise),
+# the coordinator only listens on other than loopback addresses with a token.
+#   GET  /config   settings, columns and robots.txt of the crawl, 503 until the crawl has been started
+#                  credentials (see GFlareCoordinator.credentials) are only included with a token
+#   POST /lease    {worker, n} -> {leases: [[lease, url, attempts], ...], done}, also renews all leases of worker
+#   POST /results  {worker, results: [{lease, data} or {lease, retry, pause_host, attempts}]} -> {accepted, done}
+
+from greenflare.core.gflarecrawler import GFlareCrawler
+from greenflare.core.gflareresponse import GFlareResponse as gf
+from greenflare.core.gflareparser import GFlareParser
+from greenflare.core.defaults import Defaults
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from requests import Session, exceptions
+from threading import Thread, Event, Lock
+from itertools import count
+from time import sleep, time
+import ipaddress
+import socket
+import queue
+import hmac
+import json
+import os
+
+
+class GFlareLeases:
+    """URLs handed out to workers. A lease is held until its result arrives or it expires, results of expired leases are dropped."""
+
+    def __init__(self):
+        self.leases = {}
+        self.counter = count(1)
+        self.lock = Lock()
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.leases)
+
+    def add(self, url: str, worker: str, expires: float) -> int:
+        with self.lock:
+            lease_id = next(self.counter)
+            self.leases[lease_id] = [url, worker, expires]
+            return lease_id
+
+    def renew(self, worker: str, expires: float) -> None:
+        with self.lock:
+            for lease in self.leases.values():
+                if lease[1] == worker:
+                    lease[2] = expires
+
+    def release(self, lease_id: int):
+        """Returns the URL of a held lease, None if the lease has expired (or is unknown)."""
+        with self.lock:
+            lease = self.leases.pop(lease_id, None)
+        return lease[0] if lease else None
+
+    def expire(self, now: float) -> list:
+        """Drops all leases expired by now and returns their URLs."""
+        with self.lock:
+            expired = [lease_id for lease_id, lease in self.leases.items() if lease[2] <= now]
+            return [self.leases.pop(lease_id)[0] for lease_id in expired]
+
+    def clear(self) -> list:
+        with self.lock:
+            urls = [lease[0] for lease in self.leases.values()]
+            self.leases = {}
+            return urls
+
+
+class GFlareCoordinatorHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, Nagle would delay every reply on a kept-alive connection
+    disable_nagle_algorithm = True
+
+    def authorized(self) -> bool:
+        token = self.server.coordinator.token
+        if not token:
+            return True
+        return hmac.compare_digest(self.headers.get('Authorization', '').encode('utf-8'), f'Bearer {token}'.encode('utf-8'))
+
+    def do_GET(self):
+        coordinator = self.server.coordinator
+        if not self.authorized():
+            return self.send_json(401, {'error': 'unauthorized'})
+        if self.path != '/config':
+            return self.send_json(404, {'error': 'not found'})
+        if not coordinator.ready.is_set():
+            return self.send_json(503, {'error': 'crawl not started'})
+        self.send_json(200, coordinator.get_config())
+
+    def do_POST(self):
+        coordinator = self.server.coordinator
+        if not self.authorized():
+            # The request body is not read
+            self.close_connection = True
+            return self.send_json(401, {'error': 'unauthorized'})
+        try:
+            length = int(self.headers.get('content-length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+            worker = str(request['worker'])
+            if self.path == '/lease':
+                return self.send_json(200, coordinator.lease(worker, int(request.get('n', 1))))
+            if self.path == '/results':
+                return self.send_json(200, coordinator.receive_results(worker, request.get('results', [])))
+        except (ValueError, KeyError, TypeError) as e:
+            return self.send_json(400, {'error': str(e)})
+        self.send_json(404, {'error': 'not found'})
+
+    def send_json(self, status: int, payload: dict) -> None:
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class GFlareCoordinator(GFlareCrawler):
+    """
+    Owns the frontier, seen set, scheduler and database of a crawl but does not fetch anything itself
+    (apart from the start URL and robots.txt). URLs are leased to remote workers, which fetch and parse
+    them and stream the results back. Leases of workers that stop renewing them expire after
+    LEASE_TIMEOUT seconds and their URLs are queued again. Host limits apply across all workers.
+    Workers authenticate with a shared token, which is required unless the coordinator only listens on loopback.
+    """
+
+    # Settings only sent to workers that authenticated with the token
+    credentials = ('AUTH_USER', 'AUTH_PASSWORD', 'PROXY_USER', 'PROXY_PASSWORD')
+    # Only applied by crawlers fetching locally, remote workers would silently ignore them
+    local_only = ('RECRAWL_FROM', 'STORE_RESPONSES', 'WARC')
+
+    def __init__(self, settings=None, address=('127.0.0.1', 8701), lock=None, token=''):
+        super().__init__(settings=settings, gui_mode=False, lock=lock or Lock())
+        self.address = address
+        self.token = token or ''
+        self.leases = GFlareLeases()
+        self.ready = Event()
+        self.server = None
+
+    def listen(self) -> None:
+        """Starts accepting workers, they wait for the crawl to be started. Raises ValueError for a public address without token."""
+        self.server = ThreadingHTTPServer(self.address, GFlareCoordinatorHandler)
+        if not self.token and not ipaddress.ip_address(self.server.server_address[0]).is_loopback:
+            self.server.server_close()
+            self.server = None
+            raise ValueError(f'A token is required to listen on {self.address[0]}')
+        self.server.daemon_threads = True
+        self.server.coordinator = self
+        self.address = self.server.server_address
+        Thread(target=self.server.serve_forever, name='coordinator').start()
+
+    def check_settings(self) -> None:
+        """Raises ValueError if settings are enabled that remote workers do not support."""
+        enabled = [key for key in self.local_only if self.settings.get(key) not in ('', 0, '0', None)]
+        if enabled:
+            raise ValueError(f'{", ".join(enabled)} cannot be used with remote workers')
+
+    def close(self) -> None:
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def spawn_threads(self) -> None:
+        """Lets workers lease URLs instead of starting local crawl workers."""
+        if self.crawl_running.is_set() == False:
+            self.ready.set()
+            Thread(target=self.expire_leases, name='leases').start()
+        if self.stats:
+            Thread(target=self.urls_per_second_stats, name='stats').start()
+
+    def get_lease_timeout(self) -> float:
+        return float(self.settings.get('LEASE_TIMEOUT', 60))
+
+    def get_config(self) -> dict:
+        settings = self.settings
+        if not self.token:
+            settings = {k: v for k, v in settings.items() if k not in self.credentials}
+        return {'settings': settings, 'columns': self.columns,
+                'robots_txt': getattr(self.gf, 'robots_txt', '')}
+
+    def lease(self, worker: str, n: int) -> dict:
+        """Renews the leases of worker and leases up to n more URLs. Waits briefly for the first URL."""
+        expires = time() + self.get_lease_timeout()
+        self.leases.renew(worker, expires)
+
+        leases = []
+        while len(leases) < n and not self.crawl_running.is_set():
+            url = self.get_url(timeout=0.01 if leases else 0.5)
+            if url is None:
+                break
+            if url == 'END':
+                continue
+            with self.lock:
+                attempts = self.url_attempts.get(url, 0)
+            leases.append([self.leases.add(url, worker, expires), url, attempts])
+        return {'leases': leases, 'done': self.crawl_running.is_set()}
+
+    def receive_results(self, worker: str, results: list) -> dict:
+        """Hands the results of held leases to the consumer and schedules requested retries."""
+        accepted = 0
+        for result in results:
+            url = self.leases.release(result['lease'])
+            if url is None:
+                # Expired, the URL has been queued again
+                continue
+            self.scheduler.release(url)
+            accepted += 1
+
+            if 'retry' in result:
+                with self.lock:
+                    self.url_attempts[url] = int(result.get('attempts', 0))
+                    self.attempts_changed.add(url)
+                self.scheduler.schedule_retry(url, float(result['retry']), pause_host=bool(result.get('pause_host')))
+                continue
+
+            data = result['data']
+            data['data'] = [tuple(row) for row in data['data']]
+            while not self.crawl_running.is_set():
+                try:
+                    self.data_queue.put(data, timeout=0.25)
+                    break
+                except queue.Full:
+                    continue
+        return {'accepted': accepted, 'done': self.crawl_running.is_set()}
+
+    def expire_leases(self) -> None:
+        """Queues the URLs of expired leases again. URLs stay outstanding the whole time."""
+        while not self.crawl_running.wait(1):
+            for url in self.leases.expire(time()):
+                self.scheduler.release(url)
+                self.url_queue.put(url)
+        self.leases.clear()
+
+
+class GFlareRetryLog:
+    """Stands in for the scheduler of a remote worker: retries are reported to the coordinator, which schedules them."""
+
+    def __init__(self):
+        self.retries = {}
+        self.lock = Lock()
+
+    def schedule_retry(self, url: str, delay: float, pause_host=False) -> None:
+        with self.lock:
+            self.retries[url] = (delay, pause_host)
+
+    def pop(self, url: str) -> tuple:
+        with self.lock:
+            return self.retries.pop(url, (0, False))
+
+    def clear(self) -> None:
+        with self.lock:
+            self.retries = {}
+
+
+class GFlareRemoteWorker(GFlareCrawler):
+    """
+    Fetches and parses URLs leased from a GFlareCoordinator using the crawl settings of the coordinator.
+    Runs until the coordinator reports the crawl as done or cannot be reached for a while.
+    """
+
+    def __init__(self, coordinator: str, threads=0, name=None, token=''):
+        # Replaced by the settings of the coordinator
+        super().__init__(settings=Defaults.settings.copy(), gui_mode=False, lock=Lock(), stats=False)
+        self.coordinator = coordinator.rstrip('/')
+        if '://' not in self.coordinator:
+            self.coordinator = 'http://' + self.coordinator
+        self.threads = int(threads or 0)
+        self.name = name or f'{socket.gethostname()}-{os.getpid()}'
+        self.client = Session()
+        if token:
+            self.client.headers['Authorization'] = f'Bearer {token}'
+        self.leased = queue.Queue()
+        self.results = queue.Queue()
+        self.scheduler = GFlareRetryLog()
+        self.running_low = Event()
+        # Seconds between lease renewals while there is enough to do, at most a third of LEASE_TIMEOUT
+        self.heartbeat = 5
+        self.max_errors = 10
+        self.urls_sent = 0
+
+    def call(self, method: str, path: str, payload=None) -> dict:
+        response = self.client.request(method, self.coordinator + path, json=payload, timeout=30)
+        response.raise_for_status()
+        return response.json()
+
+    def call_with_retries(self, method: str, path: str, payload=None):
+        """Returns None once the coordinator has not been reachable max_errors times in a row."""
+        for _ in range(self.max_errors):
+            try:
+                return self.call(method, path, payload)
+            except (exceptions.RequestException, ValueError):
+                sleep(1)
+        return None
+
+    def configure(self) -> bool:
+        """Loads the crawl configuration, waits for the crawl to be started. Returns False if the coordinator cannot be reached."""
+        errors = 0
+        while True:
+            try:
+                config = self.call('GET', '/config')
+                break
+            except exceptions.HTTPError as e:
+                if e.response.status_code == 401:
+                    print(f'{self.coordinator} rejected the token')
+                if e.response.status_code != 503:
+                    return False
+            except (exceptions.RequestException, ValueError):
+                errors += 1
+                if errors >= self.max_errors:
+                    return False
+            sleep(1)
+        self.settings = config['settings']
+        self.columns = config['columns']
+        if not self.threads:
+            self.threads = int(self.settings.get('THREADS', 5))
+        self.heartbeat = min(self.heartbeat, float(self.settings.get('LEASE_TIMEOUT', 60)) / 3)
+        self.init_crawl_headers()
+        self.init_session()
+        self.gf = gf(self.settings, columns=self.columns)
+        # Without a consumer inline parsing would happen on the single sender thread
+        mode = self.settings.get('PARSE_MODE', 'inline')
+        self.parser = GFlareParser(self.settings, self.columns, robots_txt=config.get('robots_txt', ''),
+                                   mode='threads' if mode == 'inline' else mode,
+                                   workers=int(self.settings.get('PARSE_WORKERS', 0)))
+        return True
+
+    def run(self) -> None:
+        if not self.configure():
+            print(f'No crawl configuration could be loaded from {self.coordinator}')
+            return
+
+        workers = [Thread(target=self.fetch_worker, name=f'worker-{i}') for i in range(self.threads)]
+        sender = Thread(target=self.send_results, name='sender')
+        for t in workers + [sender]:
+            t.start()
+
+        self.lease_urls()
+
+        # Leases not started yet are simply left to expire (or the crawl is over anyway)
+        self.crawl_running.set()
+        while True:
+            try:
+                self.leased.get_nowait()
+            except queue.Empty:
+                break
+        for _ in workers:
+            self.leased.put(None)
+        for t in workers:
+            t.join()
+        self.results.put(None)
+        sender.join()
+
+        self.parser.close()
+        self.session.close()
+        print(f'Worker {self.name} finished, {self.urls_sent} results sent')
+
+    def lease_urls(self) -> None:
+        """Tops the leased URLs up to two per fetch thread whenever they run low. Every request also renews the leases already held."""
+        while not self.crawl_running.is_set():
+            self.running_low.clear()
+            wanted = max(self.threads * 2 - self.leased.qsize(), 0)
+            if wanted < self.threads and self.running_low.wait(self.heartbeat):
+                continue
+            reply = self.call_with_retries('POST', '/lease', {'worker': self.name, 'n': wanted})
+            if reply is None or reply['done']:
+                break
+            for lease in reply['leases']:
+                self.leased.put(lease)
+
+    def fetch_worker(self) -> None:
+        while True:
+            lease = self.leased.get()
+            if lease is None:
+                break
+            lease_id, url, attempts = lease
+            if self.leased.qsize() < self.threads:
+                self.running_low.set()
+
+            with self.lock:
+                self.url_attempts[url] = attempts
+            response = self.deal_with_throttling(url, self.crawl_url(url))
+            with self.lock:
+                attempts = self.url_attempts.pop(url, attempts)
+                self.attempts_changed.discard(url)
+
+            if isinstance(response, str):
+                delay, pause_host = self.scheduler.pop(url)
+                self.results.put({'lease': lease_id, 'retry': delay, 'pause_host': pause_host, 'attempts': attempts})
+            else:
+                self.results.put({'lease': lease_id, 'data': self.parser.submit(response)})
+
+    def send_results(self) -> None:
+        """Streams results back in batches."""
+        finished = False
+        while not finished:
+            batch = [self.results.get()]
+            while batch[-1] is not None and len(batch) < 100:
+                try:
+                    batch.append(self.results.get_nowait())
+                except queue.Empty:
+                    break
+
+            finished = batch[-1] is None
+            results = [r for r in batch if r is not None]
+            for result in results:
+                if 'data' in result:
+                    result['data'] = self.parser.get_data(result['data'])
+            if results and self.call_with_retries('POST', '/results', {'worker': self.name, 'results': results}):
+                self.urls_sent += len(results)
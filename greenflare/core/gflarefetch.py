@@ -0,0 +1,263 @@
+"""
+@author Benjamin Görler <ben@greenflare.io>
+
+@section LICENSE
+
+Greenflare SEO Web Crawler (https://greenflare.io)
+Copyright (C) 2020-2021 Benjamin Görler. This file is part of
+Greenflare, an open-source project dedicated to delivering
+high quality SEO insights and analysis solutions to the world.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from collections import namedtuple
+from threading import Condition, Lock, Thread
+from itertools import count
+from time import time, monotonic
+import asyncio
+import socket
+import heapq
+
+# A single redirect hop
+GFlareHop = namedtuple('GFlareHop', ['url', 'status_code', 'headers'])
+
+# Only headers GFlareResponse (or the fetch logic) ever looks at are kept, keys are lowercase
+header_names = ('content-type', 'content-length', 'content-encoding', 'link', 'location',
+                'x-robots-tag', 'retry-after', 'etag', 'last-modified')
+
+
+def select_headers(headers) -> dict:
+    """Copies the relevant headers out of any case-insensitive mapping, repeated headers are joined like requests does."""
+    selected = {}
+    getall = getattr(headers, 'getall', None)
+    for name in header_names:
+        if name not in headers:
+            continue
+        if getall:
+            selected[name] = ', '.join(getall(name))
+        else:
+            selected[name] = headers[name]
+    return selected
+
+
+class GFlareFetchResult:
+    """
+    Slim result of a single fetch as put into the data queue. Holds the final URL, status code,
+    selected headers, the body and compact redirect hops but no connection or request objects,
+    so it is cheap to keep in memory and to pickle to parse processes.
+    Offers the subset of the requests.Response interface GFlareResponse relies on.
+    """
+
+    __slots__ = ('url', 'status_code', 'headers', 'content', 'encoding', 'history', 'truncated')
+
+    def __init__(self, url: str, status_code: int, headers: dict, content=b'', encoding=None, history=(), truncated=''):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding
+        self.history = tuple(history)
+        # Why content is only a prefix of the body (see GFlareBodyLimit)
+        self.truncated = truncated
+
+    @classmethod
+    def from_requests(cls, response, content=b'', truncated=''):
+        """Converts a requests.Response, content needs to be read by the caller."""
+        history = [GFlareHop(str(r.url), r.status_code, select_headers(r.headers)) for r in response.history]
+        return cls(str(response.url), response.status_code, select_headers(response.headers),
+                   content=content or b'', encoding=response.encoding, history=history, truncated=truncated)
+
+    @classmethod
+    def from_aiohttp(cls, response, content=b'', truncated=''):
+        """Converts an aiohttp.ClientResponse, content needs to be read by the caller."""
+        history = [GFlareHop(str(r.url), r.status, select_headers(r.headers)) for r in response.history]
+        return cls(str(response.url), response.status, select_headers(response.headers),
+                   content=content or b'', encoding=response.charset, history=history, truncated=truncated)
+
+    @property
+    def body(self) -> memoryview:
+        """Zero-copy view of the body."""
+        return memoryview(self.content)
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    @property
+    def text(self) -> str:
+        try:
+            return self.content.decode(self.encoding or 'utf-8', errors='replace')
+        except LookupError:
+            return self.content.decode('utf-8', errors='replace')
+
+
+def abort_requests(response) -> None:
+    """Shuts down the connection of a streamed requests.Response, a read blocked on it fails immediately."""
+    # http.client drops the socket from the connection once the server closes it, the body keeps reading from it
+    fp = getattr(getattr(response.raw, '_fp', None), 'fp', None)
+    sock = getattr(getattr(fp, 'raw', None), '_sock', None)
+    if sock is None:
+        sock = getattr(getattr(response.raw, '_connection', None), 'sock', None)
+    if sock is not None:
+        sock.shutdown(socket.SHUT_RDWR)
+
+
+class GFlareWatchdog:
+    """Calls functions once their deadline has passed. A single daemon thread serves all pending deadlines."""
+
+    def __init__(self):
+        # Heap of [deadline, counter, function], cancelled entries have their function set to None
+        self.heap = []
+        self.counter = count()
+        self.cancelled = 0
+        self.condition = Condition()
+        self.thread = None
+
+    def call_at(self, deadline: float, function) -> list:
+        """Calls function from the watchdog thread once monotonic() reaches deadline. Returns a handle for cancel()."""
+        entry = [deadline, next(self.counter), function]
+        with self.condition:
+            heapq.heappush(self.heap, entry)
+            if self.thread is None:
+                self.thread = Thread(target=self.run, name='watchdog', daemon=True)
+                self.thread.start()
+            if self.heap[0] is entry:
+                self.condition.notify()
+        return entry
+
+    def cancel(self, entry: list) -> None:
+        with self.condition:
+            if entry[2] is None:
+                return
+            entry[2] = None
+            self.cancelled += 1
+            # Most deadlines are cancelled long before they are due
+            if self.cancelled > 1000 and self.cancelled > len(self.heap) // 2:
+                self.heap = [e for e in self.heap if e[2] is not None]
+                heapq.heapify(self.heap)
+                self.cancelled = 0
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                while True:
+                    while self.heap and self.heap[0][2] is None:
+                        heapq.heappop(self.heap)
+                        self.cancelled -= 1
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+                    wait = self.heap[0][0] - monotonic()
+                    if wait <= 0:
+                        function = heapq.heappop(self.heap)[2]
+                        break
+                    self.condition.wait(wait)
+            try:
+                function()
+            except Exception:
+                pass
+
+
+watchdog = GFlareWatchdog()
+
+
+class GFlareBodyLimit:
+    """
+    Caps the size and the download time of a single streamed body. Reading stops once max_bytes have been
+    read ('too large') or max_seconds have passed ('truncated'), the prefix read so far is kept.
+    A read waiting on a trickling body is interrupted once the time is up, by calling abort from the shared watchdog
+    thread for blocking iterators (the partial chunk in flight is lost) and by a timeout for async ones. 0 disables a limit.
+    """
+
+    chunk_size = 16 * 1024
+
+    def __init__(self, max_bytes=0, max_seconds=0, abort=None):
+        self.max_bytes = int(max_bytes or 0)
+        self.max_seconds = float(max_seconds or 0)
+        self.abort = abort
+        self.truncated = ''
+        # Set once reading has ended, an abort after that does not truncate anything
+        self.finished = False
+        self.aborted = False
+        self.lock = Lock()
+
+    def expire(self) -> None:
+        with self.lock:
+            if self.finished:
+                return
+            self.aborted = True
+        try:
+            self.abort()
+        except Exception:
+            pass
+
+    def iter(self, chunks):
+        size = 0
+        deadline = time() + self.max_seconds if self.max_seconds else None
+        timer = None
+        if deadline and self.abort:
+            timer = watchdog.call_at(monotonic() + self.max_seconds, self.expire)
+        try:
+            for chunk in chunks:
+                if self.max_bytes and size + len(chunk) > self.max_bytes:
+                    self.truncated = 'too large'
+                    yield chunk[:self.max_bytes - size]
+                    return
+                size += len(chunk)
+                yield chunk
+                if deadline and time() >= deadline:
+                    self.truncated = 'truncated'
+                    return
+        except Exception:
+            if not self.aborted:
+                raise
+            # The read has been interrupted by abort
+            self.truncated = 'truncated'
+        finally:
+            with self.lock:
+                self.finished = True
+            if timer:
+                watchdog.cancel(timer)
+
+    async def aiter(self, chunks):
+        size = 0
+        deadline = time() + self.max_seconds if self.max_seconds else None
+        chunks = chunks.__aiter__()
+        while True:
+            try:
+                if deadline:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), max(deadline - time(), 0))
+                else:
+                    chunk = await chunks.__anext__()
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                self.truncated = 'truncated'
+                return
+            if self.max_bytes and size + len(chunk) > self.max_bytes:
+                self.truncated = 'too large'
+                yield chunk[:self.max_bytes - size]
+                return
+            size += len(chunk)
+            yield chunk
+            if deadline and time() >= deadline:
+                self.truncated = 'truncated'
+                return
+
+    def read(self, chunks) -> bytes:
+        return b''.join(self.iter(chunks))
+
+    async def aread(self, chunks) -> bytes:
+        return b''.join([chunk async for chunk in self.aiter(chunks)])
@@ -0,0 +1,449 @@
+"""
+@author Benjamin Görler <ben@greenflare.io>
+
+@section LICENSE
+
+Greenflare SEO Web Crawler (https://greenflare.io)
+Copyright (C) 2020-2021 Benjamin Görler. This file is part of
+Greenflare, an open-source project dedicated to delivering
+high quality SEO insights and analysis solutions to the world.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from urllib.parse import urlsplit
+from threading import Condition, Lock
+from tempfile import mkstemp
+from itertools import count
+from time import monotonic
+import sqlite3 as sqlite
+import heapq
+import queue
+import os
+
+
+class GFlareSpillStore:
+    """On-disk overflow segment of the frontier. An indexed SQLite table in a temporary file, not thread-safe on its own."""
+
+    def __init__(self, directory=None):
+        fd, self.path = mkstemp(prefix='gflare-', suffix='.frontier', dir=directory)
+        os.close(fd)
+        self.con = sqlite.connect(self.path, check_same_thread=False)
+        # The segment is throw-away, a crash only loses what is in the crawl table anyway
+        self.con.execute('PRAGMA journal_mode=OFF')
+        self.con.execute('PRAGMA synchronous=OFF')
+        self.con.execute(
+            'CREATE TABLE spill(id INTEGER PRIMARY KEY, priority TEXT, url TEXT, depth INTEGER, parent TEXT)')
+        self.con.execute('CREATE INDEX spill_index ON spill (priority, id)')
+        self.con.execute('CREATE INDEX spill_url_index ON spill (url)')
+        self.count = 0
+
+    def encode_priority(self, key: tuple) -> str:
+        """Encodes a priority tuple of non-negative ints into a string that sorts the same way."""
+        return '.'.join(f'{k:08d}' for k in key)
+
+    def push(self, items: list) -> None:
+        rows = [(self.encode_priority(key), url, depth, parent)
+                for key, _, url, depth, parent in items]
+        self.con.executemany(
+            'INSERT INTO spill (priority, url, depth, parent) VALUES (?, ?, ?, ?)', rows)
+        self.con.commit()
+        self.count += len(rows)
+
+    def pop(self, n: int) -> list:
+        """Removes and returns up to n (url, depth, parent) tuples with the highest priority."""
+        rows = self.con.execute(
+            'SELECT id, url, depth, parent FROM spill ORDER BY priority, id LIMIT ?', (n,)).fetchall()
+        self.con.executemany('DELETE FROM spill WHERE id = ?',
+                             [(r[0],) for r in rows])
+        self.con.commit()
+        self.count -= len(rows)
+        return [r[1:] for r in rows]
+
+    def lower_depth(self, urls: list, depth: int, parent, get_priority) -> list:
+        """Lowers the depth of spilled URLs found on a shorter path and returns them. get_priority(url, depth) returns the new key."""
+        lowered = []
+        for i in range(0, len(urls), 500):
+            chunk = urls[i:i + 500]
+            rows = self.con.execute(
+                f"SELECT url FROM spill WHERE depth > ? AND url IN ({','.join(['?'] * len(chunk))})", [depth] + chunk)
+            lowered += [row[0] for row in rows]
+        if lowered:
+            self.con.executemany('UPDATE spill SET priority = ?, depth = ?, parent = ? WHERE url = ?',
+                                 [(self.encode_priority(get_priority(url, depth)), depth, parent, url) for url in lowered])
+            self.con.commit()
+        return lowered
+
+    def close(self) -> None:
+        self.con.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class GFlareFrontier:
+    """
+    Thread-safe priority queue of URLs waiting to be crawled.
+    Every URL carries the depth it has been discovered at and its parent URL. URLs are dequeued by
+    the configured priorities (depth, content_type, host) and in insertion order within the same priority.
+    Drop-in replacement for the queue.Queue previously used as url_queue.
+
+    URLs are kept per host. get() can be given an acquire callback (see GFlareScheduler.acquire) and then
+    only hands out URLs of hosts that may be requested now, URLs of throttled hosts keep their place.
+
+    Memory is bounded by memory_limit: URLs beyond it are spilled into an on-disk segment and
+    paged back in once the in-memory window runs low. A resumed crawl pages its backlog straight
+    from the crawl table instead of loading it at once.
+    """
+
+    html_extensions = ('', '.html', '.htm', '.php', '.asp', '.aspx', '.jsp', '.shtml', '.xhtml')
+
+    def __init__(self, priority='depth', max_depth=0, max_urls=0, is_external=None, memory_limit=0, spill_dir=None):
+        # host -> heap of (priority, counter, url, depth, parent)
+        self.hosts = {}
+        # Heap of (priority, counter, host) of the first URL of every host, entries not matching self.head_of are stale
+        self.heads = []
+        self.head_of = {}
+        # url -> (counter, depth) of queued URLs, entries of URLs queued again with a lower depth are stale
+        self.queued = {}
+        # Number of queued stop signals
+        self.stops = 0
+        self.counter = count()
+        self.mutex = Lock()
+        self.not_empty = Condition(self.mutex)
+
+        # Depth and parent of URLs that have been handed out but not completed yet
+        self.in_flight = {}
+        self.admitted = 0
+
+        self.spill = None
+        self.spill_buffer = []
+        self.spill_batch = 1000
+
+        # Reader for URLs still waiting in the crawl table of a resumed crawl
+        self.backlog = None
+        self.backlog_close = None
+        self.backlog_cursor = 0
+        self.backlog_max_id = 0
+        # ids of backlog rows that have been crawled before they were paged
+        self.backlog_skipped = set()
+
+        self.priority = []
+        self.max_depth = 0
+        self.max_urls = 0
+        self.is_external = None
+        self.memory_limit = 0
+        self.window = 0
+        self.spill_dir = None
+        self.configure(priority=priority, max_depth=max_depth, max_urls=max_urls,
+                       is_external=is_external, memory_limit=memory_limit, spill_dir=spill_dir)
+
+    def configure(self, priority='depth', max_depth=0, max_urls=0, is_external=None, memory_limit=0, spill_dir=None) -> None:
+        """Sets priorities, budgets and the in-memory limit. A max_depth, max_urls or memory_limit of 0 disables the limit."""
+        if isinstance(priority, str):
+            priority = [p.strip() for p in priority.split(',') if p.strip()]
+        self.priority = priority or []
+        self.max_depth = int(max_depth or 0)
+        self.max_urls = int(max_urls or 0)
+        self.is_external = is_external
+        self.memory_limit = int(memory_limit or 0)
+        # Number of URLs paged in from disk at once
+        self.window = self.memory_limit or 100000
+        self.spill_dir = spill_dir
+
+    def guess_is_html(self, url: str) -> bool:
+        """Guesses if a URL points to an HTML page by looking at its file extension."""
+        try:
+            path = urlsplit(url).path
+        except ValueError:
+            return False
+        name = path.rsplit('/', 1)[-1]
+        if '.' not in name:
+            return True
+        return name[name.rfind('.'):].lower() in self.html_extensions
+
+    def get_priority(self, url: str, depth: int) -> tuple:
+        # Leading 0 sorts all URLs behind stop signals
+        key = [0]
+        for p in self.priority:
+            if p == 'depth':
+                key.append(depth)
+            elif p == 'content_type':
+                key.append(0 if self.guess_is_html(url) else 1)
+            elif p == 'host':
+                key.append(1 if self.is_external and self.is_external(url) else 0)
+        return tuple(key)
+
+    def get_host(self, url: str) -> str:
+        try:
+            return urlsplit(url).netloc.lower()
+        except ValueError:
+            return ''
+
+    def is_too_deep(self, depth: int) -> bool:
+        return bool(self.max_depth) and depth > self.max_depth
+
+    def admit(self, urls: list, depth: int) -> list:
+        """Applies the depth and URL budgets to newly discovered URLs and returns the ones that may be crawled."""
+        if self.is_too_deep(depth):
+            return []
+        with self.mutex:
+            if self.max_urls:
+                urls = urls[:max(self.max_urls - self.admitted, 0)]
+            self.admitted += len(urls)
+        return urls
+
+    def set_admitted(self, admitted: int) -> None:
+        """Sets the number of URLs already counted against the URL budget, e.g. when resuming a crawl."""
+        with self.mutex:
+            self.admitted = admitted
+
+    def attach_backlog(self, reader, max_id: int, close=None) -> None:
+        """
+        Pages URLs from the crawl table of a resumed crawl. reader(after_id, max_id, limit) returns
+        (id, url, depth) rows of uncrawled URLs ordered by id, max_id excludes URLs discovered after the resume.
+        """
+        with self.mutex:
+            self.backlog = reader
+            self.backlog_close = close
+            self.backlog_cursor = 0
+            self.backlog_max_id = max_id or 0
+            self.backlog_skipped = set()
+            self.refill()
+            self.not_empty.notify_all()
+
+    def close_backlog(self) -> None:
+        if self.backlog_close:
+            self.backlog_close()
+        self.backlog = None
+        self.backlog_close = None
+        self.backlog_skipped = set()
+
+    def skip_backlog(self, ids: list) -> int:
+        """
+        Drops rows of the backlog that have been crawled already, e.g. as the target of a redirect, so they are not paged.
+        Returns the number of ids that had not been paged yet, rows paged before are crawled (and completed) as usual.
+        """
+        with self.mutex:
+            if self.backlog is None:
+                return 0
+            skipped = {i for i in ids if self.backlog_cursor < i <= self.backlog_max_id} - self.backlog_skipped
+            self.backlog_skipped |= skipped
+            return len(skipped)
+
+    def on_disk(self) -> int:
+        spilled = len(self.spill_buffer)
+        if self.spill:
+            spilled += self.spill.count
+        return spilled
+
+    def spill_items(self, items: list) -> None:
+        self.spill_buffer += items
+        if len(self.spill_buffer) >= self.spill_batch:
+            self.flush_spill()
+
+    def flush_spill(self) -> None:
+        if not self.spill_buffer:
+            return
+        if not self.spill:
+            self.spill = GFlareSpillStore(directory=self.spill_dir)
+        self.spill.push(self.spill_buffer)
+        self.spill_buffer = []
+
+    def refill(self) -> None:
+        """Pages URLs from the backlog and the spill segment back into memory. Needs to be called with self.mutex held."""
+        space = self.window - len(self.queued)
+
+        if self.backlog and space > 0:
+            rows = self.backlog(self.backlog_cursor, self.backlog_max_id, space)
+            if rows:
+                self.backlog_cursor = rows[-1][0]
+            if len(rows) < space:
+                self.close_backlog()
+            for i, url, depth in rows:
+                if i in self.backlog_skipped:
+                    self.backlog_skipped.discard(i)
+                    continue
+                depth = depth if depth not in ('', None) else 0
+                self.push(url, depth, None)
+            space -= len(rows)
+
+        if self.on_disk() and space > 0:
+            self.flush_spill()
+            for url, depth, parent in self.spill.pop(space):
+                self.push(url, depth, parent)
+
+    def has_backlog(self) -> bool:
+        return self.backlog is not None or self.on_disk() > 0
+
+    def push(self, url: str, depth: int, parent) -> None:
+        """Queues a URL in memory, an already queued entry of the same URL becomes stale. Needs self.mutex."""
+        item = (self.get_priority(url, depth), next(self.counter), url, depth, parent)
+        host = self.get_host(url)
+        self.hosts.setdefault(host, [])
+        heapq.heappush(self.hosts[host], item)
+        self.queued[url] = (item[1], depth)
+        self.update_head(host)
+
+    def update_head(self, host: str) -> None:
+        """Drops stale URLs from the top of a host and makes sure its first URL is in self.heads. Needs self.mutex."""
+        heap = self.hosts.get(host)
+        while heap and self.queued.get(heap[0][2], (None,))[0] != heap[0][1]:
+            heapq.heappop(heap)
+        if not heap:
+            self.hosts.pop(host, None)
+            self.head_of.pop(host, None)
+            return
+        key, counter = heap[0][:2]
+        if self.head_of.get(host) != counter:
+            self.head_of[host] = counter
+            heapq.heappush(self.heads, (key, counter, host))
+
+    def pop(self, acquire=None) -> tuple:
+        """
+        Removes the URL with the highest priority whose host acquire(url) lets through. Needs self.mutex.
+        Returns:
+            (item, None) if a URL has been found
+            (None, wait) with wait being the seconds until the next throttled host may be ready, None if nothing is queued
+        """
+        skipped = []
+        found = None
+        wait = None
+        while self.heads:
+            entry = heapq.heappop(self.heads)
+            _, counter, host = entry
+            if self.head_of.get(host) != counter:
+                continue
+            heap = self.hosts[host]
+            host_wait = acquire(heap[0][2]) if acquire else 0
+            if host_wait > 0:
+                skipped.append(entry)
+                wait = host_wait if wait is None else min(wait, host_wait)
+                continue
+            found = heapq.heappop(heap)
+            del self.queued[found[2]]
+            del self.head_of[host]
+            self.update_head(host)
+            break
+
+        for entry in skipped:
+            heapq.heappush(self.heads, entry)
+        return found, None if found else wait
+
+    def lower_depth(self, urls: list, depth: int, parent=None) -> list:
+        """
+        Lowers the depth (and sets the parent) of queued, spilled and handed out URLs that have been found on a shorter path.
+        Returns the URLs whose depth has been lowered.
+        """
+        lowered = []
+        with self.mutex:
+            rest = []
+            for url in urls:
+                if url in self.queued:
+                    if depth < self.queued[url][1]:
+                        self.push(url, depth, parent)
+                        lowered.append(url)
+                elif url in self.in_flight:
+                    if depth < self.in_flight[url][0]:
+                        self.in_flight[url] = (depth, parent)
+                        lowered.append(url)
+                else:
+                    rest.append(url)
+
+            if rest and self.on_disk():
+                self.flush_spill()
+                lowered += self.spill.lower_depth(rest, depth, parent, self.get_priority)
+        return lowered
+
+    def put(self, url: str, depth=None, parent=None) -> None:
+        """Queues a URL. URLs without depth keep the depth they have been handed out with (retries)."""
+        with self.mutex:
+            if url == 'END':
+                # Stop signals jump the queue
+                self.stops += 1
+            else:
+                if depth is None:
+                    depth, parent = self.in_flight.get(url, (0, None))
+                if self.memory_limit and len(self.queued) >= self.memory_limit and url not in self.queued:
+                    self.spill_items([(self.get_priority(url, depth), next(self.counter), url, depth, parent)])
+                else:
+                    self.push(url, depth, parent)
+            self.not_empty.notify()
+
+    def get(self, block=True, timeout=None, acquire=None) -> str:
+        """
+        Removes and returns the URL with the highest priority. Raises queue.Empty like queue.Queue.get().
+        acquire(url) reserves a request slot for the host of url and returns 0, or returns the seconds until the host
+        may be ready. URLs of hosts without a free slot are skipped, the call blocks while all hosts are throttled.
+        """
+        with self.not_empty:
+            deadline = None if timeout is None else monotonic() + timeout
+            while True:
+                if self.stops:
+                    self.stops -= 1
+                    return 'END'
+
+                if len(self.queued) < self.window // 2 and self.has_backlog():
+                    self.refill()
+
+                item, wait = self.pop(acquire)
+                if item:
+                    _, _, url, depth, parent = item
+                    self.in_flight[url] = (depth, parent)
+                    return url
+
+                if not block:
+                    raise queue.Empty
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        raise queue.Empty
+                if wait is not None:
+                    remaining = wait if remaining is None else min(remaining, wait)
+                self.not_empty.wait(remaining)
+
+    def done(self, url: str) -> int:
+        """Marks a handed out URL as completed and returns its depth (0 if unknown)."""
+        with self.mutex:
+            depth, _ = self.in_flight.pop(url, (0, None))
+        return depth
+
+    def get_parent(self, url: str):
+        """Returns the parent URL of a handed out URL."""
+        with self.mutex:
+            return self.in_flight.get(url, (0, None))[1]
+
+    def empty(self) -> bool:
+        with self.mutex:
+            return not self.queued and not self.stops and not self.has_backlog()
+
+    def qsize(self) -> int:
+        """Number of queued URLs in memory and spilled to disk, excluding the not yet paged backlog of a resumed crawl."""
+        with self.mutex:
+            return len(self.queued) + self.stops + self.on_disk()
+
+    def clear(self) -> None:
+        with self.mutex:
+            self.hosts = {}
+            self.heads = []
+            self.head_of = {}
+            self.queued = {}
+            self.stops = 0
+            self.spill_buffer = []
+            if self.spill:
+                self.spill.close()
+                self.spill = None
+            self.close_backlog()
@@ -0,0 +1,183 @@
+"""
+@author Benjamin Görler <ben@greenflare.io>
+
+@section LICENSE
+
+Greenflare SEO Web Crawler (https://greenflare.io)
+Copyright (C) 2020-2021 Benjamin Görler. This file is part of
+Greenflare, an open-source project dedicated to delivering
+high quality SEO insights and analysis solutions to the world.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Lock, Thread
+from bisect import bisect_left
+
+# Seconds, from cheap in-process steps to slow requests
+default_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def label_key(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels) + '}'
+
+
+def format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class GFlareHistogram:
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class GFlareMetrics:
+    """
+    In-process registry of counters, gauges and histograms, rendered in the Prometheus text format.
+    Gauges are callables evaluated on every render, e.g. queue sizes. Thread-safe.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        # name -> (type, help, buckets)
+        self.descriptions = {}
+        # name -> {labels: value or GFlareHistogram}
+        self.values = {}
+        self.gauges = {}
+        self.server = None
+
+    def describe(self, name: str, metric_type: str, help_text: str, buckets=default_buckets) -> None:
+        with self.lock:
+            self.descriptions[name] = (metric_type, help_text, buckets)
+            self.values.setdefault(name, {})
+
+    def inc(self, name: str, value=1, **labels) -> None:
+        key = label_key(labels)
+        with self.lock:
+            series = self.values.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = label_key(labels)
+        with self.lock:
+            series = self.values.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                buckets = self.descriptions.get(name, (None, None, default_buckets))[2]
+                histogram = series[key] = GFlareHistogram(buckets)
+            histogram.observe(value)
+
+    def gauge(self, name: str, help_text: str, func) -> None:
+        """Registers a gauge whose value is func() at render time."""
+        with self.lock:
+            self.descriptions[name] = ('gauge', help_text, None)
+            self.gauges[name] = func
+
+    def get(self, name: str, **labels):
+        """Returns the value of a counter or the (count, sum) of a histogram, 0 if nothing has been recorded."""
+        with self.lock:
+            value = self.values.get(name, {}).get(label_key(labels), 0)
+            if isinstance(value, GFlareHistogram):
+                return value.count, value.sum
+            return value
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            names = list(self.descriptions) + [name for name in self.values if name not in self.descriptions]
+            snapshot = {name: {labels: (value.buckets, list(value.counts), value.sum, value.count)
+                               if isinstance(value, GFlareHistogram) else value
+                               for labels, value in self.values.get(name, {}).items()} for name in names}
+            gauges = dict(self.gauges)
+            descriptions = dict(self.descriptions)
+
+        for name in names:
+            metric_type, help_text, _ = descriptions.get(name, ('untyped', '', None))
+            if help_text:
+                lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+
+            if name in gauges:
+                try:
+                    value = gauges[name]()
+                except Exception:
+                    continue
+                lines.append(f'{name} {format_value(value)}')
+                continue
+
+            for labels, value in sorted(snapshot[name].items()):
+                if not isinstance(value, tuple):
+                    lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+                    continue
+                buckets, counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", format_value(bound)),))} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(labels)} {format_value(float(total))}')
+                lines.append(f'{name}_count{format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, address: tuple) -> tuple:
+        """Serves render() at http://host:port/metrics from a background thread. Returns the bound address."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(address, Handler)
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever, name='metrics', daemon=True).start()
+        return self.server.server_address
+
+    def close(self) -> None:
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,154 @@
+"""
+@author Benjamin Görler <ben@greenflare.io>
+
+@section LICENSE
+
+Greenflare SEO Web Crawler (https://greenflare.io)
+Copyright (C) 2020-2021 Benjamin Görler. This file is part of
+Greenflare, an open-source project dedicated to delivering
+high quality SEO insights and analysis solutions to the world.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from greenflare.core.gflareresponse import GFlareResponse
+from greenflare.core.gflareprofiler import profiled
+from concurrent.futures import Future, ProcessPoolExecutor
+from threading import local
+from time import time
+import multiprocessing
+import os
+
+# GFlareResponse of a parse process, set up once by init_worker
+worker_gf = None
+
+
+def new_response_parser(settings: dict, columns: list, robots_txt: str) -> GFlareResponse:
+    gf = GFlareResponse(settings, columns)
+    if robots_txt:
+        gf.load_robots_txt(robots_txt)
+    return gf
+
+
+def init_worker(settings: dict, columns: list, robots_txt: str) -> None:
+    global worker_gf
+    worker_gf = new_response_parser(settings, columns, robots_txt)
+
+
+def parse_response(response) -> dict:
+    started = time()
+    worker_gf.set_response(response)
+    data = worker_gf.get_data()
+    # Reported back to the metrics of the crawler
+    data['parse_seconds'] = time() - started
+    return data
+
+
+def get_urls(response) -> tuple:
+    """Returns the final and the requested URL of a response."""
+    url = str(response.url).strip()
+    history = getattr(response, 'history', None)
+    return url, str(history[0].url).strip() if history else url
+
+
+class GFlareParser:
+    """
+    Parse stage turning fetched responses into crawl data (rows and links).
+    Modes:
+        inline: the consumer parses (single core)
+        threads: every fetch worker parses its own responses
+        processes: responses are parsed by a pool of processes, fetch workers pass Futures to the consumer
+    Responses that cannot be parsed are recorded with the crawl status 'parse error' instead of stopping the crawl.
+    """
+
+    modes = ('inline', 'threads', 'processes')
+
+    def __init__(self, settings: dict, columns: list, robots_txt='', mode='inline', workers=0, metrics=None):
+        self.settings = settings
+        self.columns = columns
+        self.robots_txt = robots_txt or ''
+        self.mode = mode if mode in self.modes else 'inline'
+        self.workers = int(workers or 0) or os.cpu_count() or 1
+        self.local = local()
+        self.executor = None
+        self.metrics = metrics
+
+        if self.mode == 'processes':
+            # spawn avoids forking a process full of running threads
+            self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=init_worker,
+                                                initargs=(settings.copy(), columns, self.robots_txt))
+
+    def parse(self, response) -> dict:
+        """Parses a response on the calling thread."""
+        gf = getattr(self.local, 'gf', None)
+        if gf is None:
+            gf = self.local.gf = new_response_parser(
+                self.settings, self.columns, self.robots_txt)
+        started = time()
+        try:
+            gf.set_response(response)
+            data = gf.get_data()
+        except Exception as e:
+            return self.get_error_data(*get_urls(response), getattr(response, 'status_code', ''), e)
+        if self.metrics:
+            self.metrics.observe('greenflare_parse_seconds', time() - started)
+        return data
+
+    def submit(self, response):
+        """
+        Hands a fetched response to the parse stage. Called by fetch workers.
+        Returns the parsed dict (threads), a Future (processes) or the response itself (inline).
+        """
+        if isinstance(response, dict) or self.mode == 'inline':
+            return response
+        if self.mode == 'threads':
+            return self.parse(response)
+        try:
+            future = self.executor.submit(parse_response, response)
+        except RuntimeError:
+            # Pool has been shut down, leave it to the consumer
+            return response
+        # Recorded if the response cannot be parsed
+        future.fallback = get_urls(response) + (getattr(response, 'status_code', ''),)
+        return future
+
+    @profiled
+    def get_data(self, item) -> dict:
+        """Returns the parsed dict of anything submit() returned. Called by the consumer."""
+        if isinstance(item, dict):
+            return item
+        if isinstance(item, Future):
+            try:
+                data = item.result()
+            except Exception as e:
+                return self.get_error_data(*item.fallback, e)
+            seconds = data.pop('parse_seconds', None)
+            if self.metrics and seconds is not None:
+                self.metrics.observe('greenflare_parse_seconds', seconds)
+            return data
+        return self.parse(item)
+
+    def get_error_data(self, url: str, request_url: str, status_code, error: Exception) -> dict:
+        """Crawl data of a response that could not be parsed, its URL is completed like any other."""
+        print(f'{url} could not be parsed: {error!r}')
+        values = {'url': url, 'crawl_status': 'parse error', 'status_code': status_code}
+        row = [values.get(column, '') for column in self.columns]
+        return {'url': url, 'request_url': request_url, 'data': [tuple(row)], 'links': []}
+
+    def close(self) -> None:
+        if self.executor:
+            self.executor.shutdown(wait=False)
+            self.executor = None
@@ -0,0 +1,122 @@
+"""
+@author Benjamin Görler <ben@greenflare.io>
+
+@section LICENSE
+
+Greenflare SEO Web Crawler (https://greenflare.io)
+Copyright (C) 2020-2021 Benjamin Görler. This file is part of
+Greenflare, an open-source project dedicated to delivering
+high quality SEO insights and analysis solutions to the world.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+from random import randrange
+import json
+
+
+class GFlareTimings:
+    """Durations of a single function. Percentiles are computed from a bounded reservoir sample."""
+
+    def __init__(self, max_samples: int):
+        self.max_samples = max_samples
+        self.count = 0
+        self.total = 0
+        self.samples = []
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        if len(self.samples) < self.max_samples:
+            self.samples.append(seconds)
+        else:
+            i = randrange(self.count)
+            if i < self.max_samples:
+                self.samples[i] = seconds
+
+    def percentile(self, p: float) -> float:
+        samples = sorted(self.samples)
+        return samples[min(int(len(samples) * p), len(samples) - 1)] if samples else 0
+
+
+class GFlareProfiler:
+    """
+    Aggregates the timings of functions decorated with @profiled while enabled. Disabled it costs a single
+    attribute check per call. Thread-safe, timings are inclusive of nested profiled calls.
+    """
+
+    def __init__(self, max_samples=100000):
+        self.max_samples = max_samples
+        self.enabled = False
+        self.timings = {}
+        self.lock = Lock()
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def reset(self) -> None:
+        with self.lock:
+            self.timings = {}
+
+    def record(self, name: str, seconds: float) -> None:
+        with self.lock:
+            timings = self.timings.get(name)
+            if timings is None:
+                timings = self.timings[name] = GFlareTimings(self.max_samples)
+            timings.add(seconds)
+
+    def report(self) -> dict:
+        """Returns count, total, mean, p50 and p99 (in seconds) per function, slowest total first."""
+        with self.lock:
+            report = {name: {'count': t.count, 'total': t.total, 'mean': t.total / t.count,
+                             'p50': t.percentile(0.5), 'p99': t.percentile(0.99)}
+                      for name, t in self.timings.items()}
+        return dict(sorted(report.items(), key=lambda item: item[1]['total'], reverse=True))
+
+    def format_report(self) -> str:
+        lines = [f'{"function":<40} {"count":>10} {"total s":>10} {"mean ms":>10} {"p50 ms":>10} {"p99 ms":>10}']
+        for name, r in self.report().items():
+            lines.append(f'{name:<40} {r["count"]:>10} {r["total"]:>10.3f} {r["mean"] * 1000:>10.3f} '
+                         f'{r["p50"] * 1000:>10.3f} {r["p99"] * 1000:>10.3f}')
+        return '\n'.join(lines)
+
+    def dump(self, file_name: str) -> None:
+        with open(file_name, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+# All crawls of a process share the profiler, see GFlareCrawler.init_profiler
+profiler = GFlareProfiler()
+
+
+def profiled(f):
+    """Records the duration of every call of f with the profiler while it is enabled."""
+    name = f.__qualname__
+
+    @wraps(f)
+    def wrap(*args, **kwargs):
+        if not profiler.enabled:
+            return f(*args, **kwargs)
+        started = perf_counter()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            profiler.record(name, perf_counter() - started)
+    return wrap
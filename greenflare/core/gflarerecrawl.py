@@ -0,0 +1,98 @@
+"""
+@author Benjamin Görler <ben@greenflare.io>
+
+@section LICENSE
+
+Greenflare SEO Web Crawler (https://greenflare.io)
+Copyright (C) 2020-2021 Benjamin Görler. This file is part of
+Greenflare, an open-source project dedicated to delivering
+high quality SEO insights and analysis solutions to the world.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from greenflare.core.gflaredb import GFlareDBPool
+import hashlib
+
+
+def content_hash(content) -> str:
+    """Fingerprint of a response body, empty bodies have none."""
+    if not content:
+        return ''
+    return hashlib.sha1(content).hexdigest()
+
+
+class GFlarePreviousCrawl:
+    """
+    Read-only access to an earlier crawl of the same site. Its validators (ETag, Last-Modified, content hash)
+    make requests conditional. Pages answered with 304 or with an unchanged body are taken over with their
+    previous row and outlinks instead of being parsed again.
+    Thread-safe, lookups use a pool of connections.
+    """
+
+    def __init__(self, db_file: str, columns: list, size=5):
+        self.db_file = db_file
+        self.columns = columns
+        self.readers = GFlareDBPool(db_file, size=size)
+
+    def has_validators(self) -> bool:
+        """Crawls made before validators were stored cannot be used."""
+        with self.readers.reader() as db:
+            return bool(db.check_if_table_exists('validators'))
+
+    def get_validators(self, url: str):
+        """Returns (etag, last_modified, content_hash, links) of url or None if it has not been crawled before."""
+        with self.readers.reader() as db:
+            return db.get_validators(url)
+
+    def get_headers(self, validators) -> dict:
+        etag, last_modified = validators[0], validators[1]
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def is_unchanged(self, response, validators) -> bool:
+        # Validators are only stored for URLs that answered without redirecting
+        if isinstance(response, (str, dict)) or response.history:
+            return False
+        if response.status_code == 304:
+            return True
+        return response.status_code == 200 and bool(validators[2]) and content_hash(response.content) == validators[2]
+
+    def take_over(self, url: str, response, validators):
+        """Returns the crawl data of the previous crawl if response shows that url is unchanged, response otherwise."""
+        if not self.is_unchanged(response, validators):
+            return response
+
+        with self.readers.reader() as db:
+            row = db.get_row(url)
+        if not row:
+            return response
+
+        # A 304 may come with updated validators
+        etag = response.headers.get('etag', '') or validators[0]
+        last_modified = response.headers.get('last-modified', '') or validators[1]
+        links = validators[3].split('\n') if validators[3] else []
+
+        return {'url': url, 'request_url': url,
+                'data': [tuple(row.get(column, '') for column in self.columns)],
+                'links': links,
+                'validators': (etag, last_modified, validators[2]),
+                'unchanged': True}
+
+    def close(self) -> None:
+        self.readers.close()
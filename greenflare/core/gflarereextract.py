@@ -0,0 +1,63 @@
+"""
+@author Benjamin Görler <ben@greenflare.io>
+
+@section LICENSE
+
+Greenflare SEO Web Crawler (https://greenflare.io)
+Copyright (C) 2020-2021 Benjamin Görler. This file is part of
+Greenflare, an open-source project dedicated to delivering
+high quality SEO insights and analysis solutions to the world.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from greenflare.core.gflarecrawler import GFlareCrawler
+from greenflare.core.gflarestore import GFlareResponseStore
+
+
+class GFlareReextractCrawler(GFlareCrawler):
+    """
+    Crawls the responses stored by an earlier crawl instead of the network, so changed extractions or
+    crawl items can be applied without requesting a single URL. Links are followed as in a normal crawl,
+    URLs that have not been stored are reported with the crawl status 'not stored'.
+    """
+
+    def __init__(self, store_file: str, settings=None, lock=None, stats=True):
+        super().__init__(settings=settings, gui_mode=False, lock=lock, stats=stats)
+        self.source = GFlareResponseStore(store_file, read_only=True)
+
+    def crawl_url(self, url, header_only=False, retry=True, conditional=True):
+        response = self.source.get(url)
+        if response is not None:
+            return response
+        if not retry or url == self.settings.get('STARTING_URL'):
+            return 'SKIP_ME'
+        return {'url': url, 'data': [tuple([url, 'not stored', '0', ''] + [''] * (len(self.columns) - 4))], 'links': []}
+
+    def use_async_engine(self) -> bool:
+        # The asyncio engine fetches through aiohttp, only crawl_url reads the stored responses
+        return False
+
+    def deal_with_throttling(self, url: str, response):
+        # A stored 429 or 503 is the final answer of the original crawl
+        return response
+
+    def get_host_limits(self, url: str) -> tuple:
+        return 0, 0
+
+    def set_crawl_delay(self, url: str) -> None:
+        pass
+
+    def close(self) -> None:
+        self.source.close()
@@ -0,0 +1,186 @@
+"""
+@author Benjamin Görler <ben@greenflare.io>
+
+@section LICENSE
+
+Greenflare SEO Web Crawler (https://greenflare.io)
+Copyright (C) 2020-2021 Benjamin Görler. This file is part of
+Greenflare, an open-source project dedicated to delivering
+high quality SEO insights and analysis solutions to the world.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from greenflare.core.gflarefetch import GFlareFetchResult, GFlareHop
+from greenflare.core.gflarestore import GFlareResponseStore, get_store_file
+from greenflare.core.defaults import Defaults
+from requests.adapters import BaseAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from urllib3.response import HTTPResponse
+from http.client import responses as reasons
+from threading import Lock, local
+from random import uniform
+from time import sleep
+from os import path, makedirs
+import mimetypes
+import hashlib
+import json
+import io
+
+
+class GFlareFixtures:
+    """
+    Directory of recorded responses. index.json maps requested URLs to their response:
+        {"https://example.com/": {"status_code": 200, "headers": {"content-type": "text/html"}, "body": "home.html",
+                                  "url": final URL, "history": [[url, status_code, headers], ...]}}
+    Everything but the URL is optional, the content type is guessed from the body file name if not given.
+    Bodies are read when requested.
+    """
+
+    index_file = 'index.json'
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.index = {}
+        self.lock = Lock()
+        index_file = path.join(directory, self.index_file)
+        if path.isfile(index_file):
+            with open(index_file, 'r', encoding='utf-8') as f:
+                self.index = json.load(f)
+
+    def get(self, url: str):
+        """Returns the recorded fetch result of url or None."""
+        entry = self.index.get(url)
+        if entry is None:
+            return None
+
+        content = b''
+        headers = {k.lower(): v for k, v in entry.get('headers', {}).items()}
+        if entry.get('body'):
+            with open(path.join(self.directory, entry['body']), 'rb') as f:
+                content = f.read()
+            if 'content-type' not in headers:
+                headers['content-type'] = mimetypes.guess_type(entry['body'])[0] or 'application/octet-stream'
+        history = [GFlareHop(*hop) for hop in entry.get('history', [])]
+        return GFlareFetchResult(entry.get('url', url), int(entry.get('status_code', 200)), headers, content=content,
+                                 encoding=entry.get('encoding'), history=history, truncated=entry.get('truncated', ''))
+
+    def get_urls(self) -> list:
+        return list(self.index)
+
+    def add(self, url: str, response) -> None:
+        """Records the fetch result of url, identical bodies are written once. Call save() afterwards."""
+        body = ''
+        if response.content:
+            body = hashlib.sha1(response.content).hexdigest() + '.body'
+            makedirs(self.directory, exist_ok=True)
+            body_file = path.join(self.directory, body)
+            if not path.isfile(body_file):
+                with open(body_file, 'wb') as f:
+                    f.write(response.content)
+        entry = {'url': response.url, 'status_code': response.status_code, 'headers': response.headers,
+                 'encoding': response.encoding, 'body': body,
+                 'history': [[hop.url, hop.status_code, hop.headers] for hop in response.history]}
+        if response.truncated:
+            entry['truncated'] = response.truncated
+        with self.lock:
+            self.index[url] = entry
+
+    def save(self) -> None:
+        makedirs(self.directory, exist_ok=True)
+        with self.lock, open(path.join(self.directory, self.index_file), 'w', encoding='utf-8') as f:
+            json.dump(self.index, f, indent=1)
+
+    def close(self) -> None:
+        pass
+
+
+def open_replay_source(source: str):
+    """Opens recorded responses: a fixture directory, a response store or the store of a crawl database."""
+    if path.isdir(source):
+        return GFlareFixtures(source)
+    if source.endswith(Defaults.file_extension):
+        source = get_store_file(source)
+    if not path.isfile(source):
+        raise FileNotFoundError(f'No recorded responses found at {source}')
+    return GFlareResponseStore(source, read_only=True)
+
+
+class GFlareReplayAdapter(BaseAdapter):
+    """
+    requests transport adapter answering every request with a recorded response instead of the network.
+    Mounted on the crawl session, the complete fetch path (redirects, streaming, body limits, WARC) runs as usual.
+    Redirect chains are replayed hop by hop. URLs that have not been recorded are answered with a 404
+    carrying an X-Greenflare-Replay: not recorded header.
+    Every response is delayed by latency plus up to jitter seconds.
+    """
+
+    def __init__(self, source, latency=0, jitter=0):
+        super().__init__()
+        self.source = source
+        self.latency = float(latency or 0)
+        self.jitter = float(jitter or 0)
+        # Remaining hops of the chain being replayed as (url, status_code, headers, content, encoding).
+        # requests follows redirects on the calling thread, so every thread replays its own chain
+        self.local = local()
+
+    def get_response(self, url: str) -> tuple:
+        chain = getattr(self.local, 'chain', None)
+        if chain and chain[0][0] == url:
+            return chain.pop(0)[1:]
+        # Not the next hop, a chain that has not been followed to its end is dropped
+        self.local.chain = None
+
+        result = self.source.get(url)
+        if result is None:
+            return 404, {'content-type': 'text/plain', 'x-greenflare-replay': 'not recorded'}, b'', None
+
+        chain = [(hop.url, hop.status_code, dict(hop.headers), b'', None) for hop in result.history]
+        chain.append((result.url, result.status_code, result.headers, result.content, result.encoding))
+        for i, (hop_url, status_code, headers, _, _) in enumerate(chain[:-1]):
+            # Follows the recorded chain even if the location header has not been kept
+            headers.setdefault('location', chain[i + 1][0])
+        self.local.chain = chain[1:]
+        return chain[0][1:]
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        delay = self.latency + (uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            sleep(delay)
+
+        status_code, headers, content, encoding = self.get_response(request.url)
+        if request.method == 'HEAD':
+            content = b''
+        headers = {k: v for k, v in headers.items() if k not in ('content-encoding', 'content-length')}
+        headers['content-length'] = str(len(content))
+
+        response = Response()
+        response.status_code = status_code
+        response.reason = reasons.get(status_code, '')
+        response.headers = CaseInsensitiveDict(headers)
+        response.encoding = encoding or get_encoding_from_headers(response.headers)
+        response.raw = HTTPResponse(body=io.BytesIO(content), headers=headers, status=status_code,
+                                    reason=response.reason, preload_content=False, decode_content=False)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        if not stream:
+            response.content
+        return response
+
+    def close(self) -> None:
+        # The source is owned by whoever opened it, sessions are closed and replaced between crawls
+        pass
@@ -24,14 +24,14 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from lxml.html import fromstring
 from greenflare.core.gflarerobots import GFlareRobots
+from greenflare.core.gflarerecrawl import content_hash
+from greenflare.core.gflareprofiler import profiled
 from requests import status_codes
 from requests.utils import requote_uri
 from requests.compat import urlunparse
 from urllib.parse import urljoin
 from urllib3.util import parse_url
 from re import match, escape
-from functools import wraps
-from time import time
 
 
 class GFlareResponse:
@@ -74,16 +74,6 @@ class GFlareResponse:
 
         self.crawlable_schemes = ('http', 'https', '')
 
-    def timing(f):
-        @wraps(f)
-        def wrap(*args, **kw):
-            ts = time()
-            result = f(*args, **kw)
-            te = time()
-            print(f'func:{f.__name__} took: {te - ts}')
-            return result
-        return wrap
-
     def set_response(self, response):
         self.response = response
         self.url = self.response.url
@@ -98,11 +88,14 @@ class GFlareResponse:
 
     def response_to_robots_txt(self):
         if self.response.status_code == 200:
-            self.robots_txt = self.response.text
-            self.gfrobots.set_robots_txt(
-                self.robots_txt, user_agent=self.settings.get("USER_AGENT", ''))
-            self.robots_txt_ua = self.gfrobots.get_short_ua(
-                self.settings.get("USER_AGENT", ''))
+            self.load_robots_txt(self.response.text)
+
+    def load_robots_txt(self, robots_txt):
+        self.robots_txt = robots_txt
+        self.gfrobots.set_robots_txt(
+            self.robots_txt, user_agent=self.settings.get("USER_AGENT", ''))
+        self.robots_txt_ua = self.gfrobots.get_short_ua(
+            self.settings.get("USER_AGENT", ''))
 
     def get_initial_url(self):
         if len(self.response.history) == 0:
@@ -134,9 +127,10 @@ class GFlareResponse:
 
         return '|'.join(xpaths)
 
+    @profiled
     def get_data(self):
 
-        d = {'url': self.url}
+        d = {'url': self.url, 'request_url': self.get_initial_url()}
         d['data'] = self.get_header_info()
 
         if len(self.response.content) > 0:
@@ -149,13 +143,35 @@ class GFlareResponse:
 
         d['data'] = {**d['data'], **{'crawl_status': self.get_full_status(self.url, d['data'])}}
 
+        # Only a prefix of the body has been downloaded and parsed
+        truncated = getattr(self.response, 'truncated', '')
+        if truncated:
+            status = d['data']['crawl_status']
+            d['data']['crawl_status'] = truncated if status == 'ok' else f'{status}, {truncated}'
+
         d['data'] = [self.dict_to_row(d['data'])]
 
         if self.has_redirected():
             d['data'] += self.get_redirects()
+        elif int(self.settings.get('STORE_VALIDATORS', 1)) and not truncated:
+            validators = self.get_validators()
+            if validators:
+                d['validators'] = validators
 
         return d
 
+    def get_validators(self):
+        """Returns (etag, last_modified, content_hash) of a 200 response or None if there is nothing to revalidate."""
+        if self.response.status_code != 200:
+            return None
+        validators = (self.response.headers.get('etag', ''),
+                      self.response.headers.get('last-modified', ''),
+                      content_hash(self.response.content))
+        if any(validators):
+            return validators
+        return None
+
+    @profiled
     def get_tree(self):
         try:
             # We need to use page.content rather than page.text because
@@ -181,7 +197,7 @@ class GFlareResponse:
 
     def get_robots_txt_url(self, url):
         comps = parse_url(url)
-        url = requote_uri(urlunparse([comps.scheme, comps.host, 'robots.txt', None, comps.query, comps.fragment]))
+        url = requote_uri(urlunparse([comps.scheme, comps.netloc, 'robots.txt', None, comps.query, comps.fragment]))
         return url
 
     def is_external(self, url):
@@ -247,11 +263,12 @@ class GFlareResponse:
         return self.response.text
 
     def get_canonical_http_header(self):
-        header = self.response.headers.get("Link", "")
+        header = self.response.headers.get("link", "")
         if "rel=" in header:
             return header.split(";")[0].replace("<", "").replace(">", "")
         return ""
 
+    @profiled
     def get_header_info(self):
         header = {
             'url': self.url,
@@ -263,6 +280,7 @@ class GFlareResponse:
         }
         return header
 
+    @profiled
     def valid_url(self, url):
         try:
             cmps = parse_url(url)
@@ -289,6 +307,7 @@ class GFlareResponse:
             return False
         return True
 
+    @profiled
     def sanitise_url(self, url: str, base_url='') -> str:
         """Cleans a given input URL and returns a RFC compliant URL as a string."""
 
@@ -333,6 +352,7 @@ class GFlareResponse:
 
         return url
 
+    @profiled
     def extract_links(self):
         links = [self.sanitise_url(url, base_url=self.base_url) for url in self.extract_xpath(self.xpath_link_extraction) if self.valid_url(url)]
         return list(set(links))
@@ -427,6 +447,7 @@ class GFlareResponse:
 
         return {}
 
+    @profiled
     def get_crawl_data(self):
         return {**self.extract_onpage_elements(), **self.extract_directives(), **self.custom_extractions()}
 
@@ -437,6 +458,7 @@ class GFlareResponse:
             return True
         return False
 
+    @profiled
     def get_full_status(self, url, seo_items):
         status = []
 
@@ -499,6 +521,7 @@ class GFlareResponse:
     def has_redirected(self):
         return len(self.response.history) > 0
 
+    @profiled
     def get_redirects(self):
         data = []
         hist = self.response.history
@@ -520,8 +543,8 @@ class GFlareResponse:
             else:
                 redirect_to_url = self.get_final_url()
 
-            hob_data = {"url": hob_url, "content_type": hist[i].headers.get('Content-Type', ""), 'status_code': hist[i].status_code, 'x_robots_tag': hist[
-                i].headers.get('X-Robots-Tag', ''), 'redirect_url': redirect_to_url, 'robots_txt': robots_status}
+            hob_data = {"url": hob_url, "content_type": hist[i].headers.get('content-type', ""), 'status_code': hist[i].status_code, 'x_robots_tag': hist[
+                i].headers.get('x-robots-tag', ''), 'redirect_url': redirect_to_url, 'robots_txt': robots_status}
 
             hob_data['crawl_status'] = self.get_full_status(
                 hob_url, hob_data)
@@ -26,6 +26,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import re
 import urllib.parse
 from ua_parser import user_agent_parser
+from greenflare.core.gflareprofiler import profiled
 
 
 class GFlareRobots:
@@ -37,6 +38,7 @@ class GFlareRobots:
         self.allows = []
         self.allow_lines = None
         self.disallow_lines = None
+        self.crawl_delay = None
         if self.robots_txt:
             if self.user_agent:
                 self.robots_txt = self.get_ua_rules(
@@ -112,6 +114,7 @@ class GFlareRobots:
     def parse_rules(self):
         exp_disallow_rule = re.compile(r"\s*Disallow:\s*(.*)", re.IGNORECASE)
         exp_allow_rule = re.compile(r"\s*Allow:\s*(.*)", re.IGNORECASE)
+        exp_crawl_delay = re.compile(r"\s*Crawl-delay:\s*([0-9.]+)", re.IGNORECASE)
 
         for row in self.robots_txt.splitlines():
             row = self.remove_spaces(row)
@@ -132,6 +135,13 @@ class GFlareRobots:
                 if path:
                     self.allows.append(path)
 
+            c_match = re.match(exp_crawl_delay, row)
+            if c_match:
+                try:
+                    self.crawl_delay = float(c_match.group(1))
+                except ValueError:
+                    pass
+
         self.allow_lines = sorted(self.allows.copy(), key=len, reverse=True)
         self.disallow_lines = sorted(
             self.disallows.copy(), key=len, reverse=True)
@@ -146,6 +156,7 @@ class GFlareRobots:
                 rules[i] = f"{r}.*"
         return re.compile("|".join([f"({r})" for r in rules]))
 
+    @profiled
     def is_allowed(self, url):
         scheme, netloc, path, query, frag = urllib.parse.urlsplit(url)
         url = str(urllib.parse.urlunsplit(("", "", path, query, "")))
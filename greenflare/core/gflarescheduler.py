@@ -0,0 +1,271 @@
+"""
+@author Benjamin Görler <ben@greenflare.io>
+
+@section LICENSE
+
+Greenflare SEO Web Crawler (https://greenflare.io)
+Copyright (C) 2020-2021 Benjamin Görler. This file is part of
+Greenflare, an open-source project dedicated to delivering
+high quality SEO insights and analysis solutions to the world.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from urllib.parse import urlsplit
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from collections import deque
+from itertools import count
+from threading import Lock
+from time import monotonic
+import heapq
+
+
+def parse_retry_after(value: str):
+    """Returns the seconds to wait according to a Retry-After header (delay-seconds or HTTP-date), None if it cannot be parsed."""
+    value = (value or '').strip()
+    if not value:
+        return None
+    if value.isdigit():
+        return float(value)
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if date is None:
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max((date - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+class TokenBucket:
+    """Classic token bucket. A rate of 0 disables the limit."""
+
+    def __init__(self, rate=0, burst=1):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = self.capacity
+        self.updated = monotonic()
+
+    def set_rate(self, rate) -> None:
+        self.rate = rate
+
+    def refill(self, now: float) -> None:
+        if self.rate > 0:
+            self.tokens = min(self.capacity, self.tokens +
+                              (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until a token is available, 0 if one is available now."""
+        if self.rate <= 0:
+            return 0
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self) -> None:
+        if self.rate > 0:
+            self.tokens -= 1
+
+
+class GFlareHost:
+
+    def __init__(self, rate=0, max_connections=0):
+        self.bucket = TokenBucket(rate)
+        self.max_connections = max_connections
+        self.active = 0
+        self.requests = 0
+        self.last_requests = 0
+        self.crawl_delay = None
+        # Set by 429/503 responses, no request is made before
+        self.paused_until = 0
+        self.deferred = deque()
+
+
+class GFlareScheduler:
+    """
+    Per-host politeness scheduler. Every host gets its own token bucket and concurrency cap.
+    Queued URLs stay in the frontier until their host has a free slot (see acquire()), only retries that are due
+    are handed off here (deferred), at most max_handoff per host.
+    """
+
+    def __init__(self, host_limits=None, max_handoff=4):
+        # host_limits(url) returns a (rate, max_connections) tuple for the host of url
+        self.host_limits = host_limits
+        self.max_handoff = max_handoff
+        self.hosts = {}
+        self.deferred_count = 0
+        # Heap of (due, counter, url) of failed URLs waiting for their next attempt
+        self.retries = []
+        self.retry_counter = count()
+        self.rates = {}
+        self.rates_updated = monotonic()
+        self.lock = Lock()
+
+        # Used as retry interval for hosts that are capped by concurrency
+        self.poll_interval = 0.01
+
+    def get_host(self, url: str) -> str:
+        try:
+            return urlsplit(url).netloc.lower()
+        except ValueError:
+            return ''
+
+    def _get_host(self, url: str) -> GFlareHost:
+        name = self.get_host(url)
+        host = self.hosts.get(name)
+        if host is None:
+            rate, max_connections = self.host_limits(url) if self.host_limits else (0, 0)
+            host = self.hosts[name] = GFlareHost(rate, max_connections)
+        return host
+
+    def set_crawl_delay(self, url: str, delay: float) -> None:
+        """Honours a robots.txt Crawl-delay for the host of url by capping its request rate."""
+        if not delay or delay <= 0:
+            return
+        with self.lock:
+            host = self._get_host(url)
+            host.crawl_delay = delay
+            rate = 1 / delay
+            if host.bucket.rate <= 0 or rate < host.bucket.rate:
+                host.bucket.set_rate(rate)
+
+    def _wait_time(self, host: GFlareHost, now: float) -> float:
+        if host.paused_until > now:
+            return host.paused_until - now
+        if host.max_connections and host.active >= host.max_connections:
+            return self.poll_interval
+        return host.bucket.wait_time(now)
+
+    def _take(self, host: GFlareHost) -> None:
+        host.bucket.consume()
+        host.active += 1
+        host.requests += 1
+
+    def acquire(self, url: str) -> float:
+        """Reserves a request slot for the host of url and returns 0, or returns the seconds until the host may be ready."""
+        with self.lock:
+            host = self._get_host(url)
+            wait = self._wait_time(host, monotonic())
+            if wait <= 0:
+                self._take(host)
+                return 0
+            return wait
+
+    def try_acquire(self, url: str) -> bool:
+        """Reserves a request slot for the host of url if its rate and concurrency limits allow it."""
+        return self.acquire(url) == 0
+
+    def release(self, url: str) -> None:
+        """Frees the concurrency slot taken by try_acquire or pop_ready."""
+        with self.lock:
+            host = self.hosts.get(self.get_host(url))
+            if host and host.active > 0:
+                host.active -= 1
+
+    def defer(self, url: str) -> bool:
+        """Parks a URL until its host may be requested again. Returns False if max_handoff URLs of its host are parked already."""
+        with self.lock:
+            host = self._get_host(url)
+            if len(host.deferred) >= self.max_handoff:
+                return False
+            host.deferred.append(url)
+            self.deferred_count += 1
+            return True
+
+    def schedule_retry(self, url: str, delay: float, pause_host=False) -> None:
+        """Parks a failed URL for delay seconds. pause_host holds back all other URLs of its host as well (429/503)."""
+        with self.lock:
+            now = monotonic()
+            heapq.heappush(self.retries, (now + delay, next(self.retry_counter), url))
+            if pause_host:
+                host = self._get_host(url)
+                host.paused_until = max(host.paused_until, now + delay)
+
+    def _release_retries(self, now: float) -> None:
+        """
+        Moves retries that are due to the deferred URLs of their host so host limits still apply.
+        Retries of hosts with max_handoff deferred URLs are held back until the host may be requested again.
+        """
+        held = []
+        while self.retries and self.retries[0][0] <= now:
+            _, counter, url = heapq.heappop(self.retries)
+            host = self._get_host(url)
+            if len(host.deferred) >= self.max_handoff:
+                held.append((now + max(self._wait_time(host, now), self.poll_interval), counter, url))
+                continue
+            host.deferred.append(url)
+            self.deferred_count += 1
+        for item in held:
+            heapq.heappush(self.retries, item)
+
+    def pending(self) -> int:
+        """Number of deferred URLs and URLs waiting to be retried."""
+        return self.deferred_count + len(self.retries)
+
+    def pop_ready(self) -> tuple:
+        """
+        Returns a deferred URL (a retry) whose host can be requested now (with its slot already reserved).
+        Returns:
+            (url, None) if a URL is ready
+            (None, wait) with wait being the seconds until the next deferred host may be ready, None if nothing is deferred
+        """
+        if self.deferred_count == 0 and not self.retries:
+            return None, None
+
+        with self.lock:
+            now = monotonic()
+            self._release_retries(now)
+            wait = self.retries[0][0] - now if self.retries else None
+            for host in self.hosts.values():
+                if not host.deferred:
+                    continue
+                host_wait = self._wait_time(host, now)
+                if host_wait == 0:
+                    self._take(host)
+                    self.deferred_count -= 1
+                    return host.deferred.popleft(), None
+                if wait is None or host_wait < wait:
+                    wait = host_wait
+            return None, wait
+
+    def clear(self) -> None:
+        with self.lock:
+            for host in self.hosts.values():
+                host.deferred.clear()
+                host.paused_until = 0
+            self.deferred_count = 0
+            self.retries = []
+
+    def update_rates(self) -> dict:
+        """Computes the achieved requests per second for every host since the last call."""
+        with self.lock:
+            now = monotonic()
+            elapsed = now - self.rates_updated
+            if elapsed <= 0:
+                return self.rates
+            self.rates = {name: round((host.requests - host.last_requests) / elapsed, 2)
+                          for name, host in self.hosts.items()}
+            for host in self.hosts.values():
+                host.last_requests = host.requests
+            self.rates_updated = now
+            return self.rates
+
+    def get_host_rates(self) -> dict:
+        """Returns the achieved requests per second per host as calculated by the last update_rates() call."""
+        with self.lock:
+            return self.rates.copy()
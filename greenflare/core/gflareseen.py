@@ -0,0 +1,120 @@
+"""
+@author Benjamin Görler <ben@greenflare.io>
+
+@section LICENSE
+
+Greenflare SEO Web Crawler (https://greenflare.io)
+Copyright (C) 2020-2021 Benjamin Görler. This file is part of
+Greenflare, an open-source project dedicated to delivering
+high quality SEO insights and analysis solutions to the world.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from hashlib import blake2b
+from math import ceil, log
+
+
+class GFlareBloomFilter:
+    """Fixed size Bloom filter over strings using double hashing of a single blake2b digest."""
+
+    def __init__(self, capacity: int, error_rate=0.001):
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = float(error_rate)
+        self.size = int(ceil(-self.capacity * log(self.error_rate) / (log(2) ** 2)))
+        self.hashes = max(int(round(self.size / self.capacity * log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def get_indexes(self, item: str):
+        digest = blake2b(item.encode('utf8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, item: str) -> bool:
+        bits = self.bits
+        return all(bits[i >> 3] & (1 << (i & 7)) for i in self.get_indexes(item))
+
+    def add(self, item: str) -> bool:
+        """Adds item and returns True if it has (probably) not been added before."""
+        bits = self.bits
+        new = False
+        for i in self.get_indexes(item):
+            mask = 1 << (i & 7)
+            if not bits[i >> 3] & mask:
+                bits[i >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+    def __len__(self) -> int:
+        return self.count
+
+
+class GFlareSeenSet:
+    """
+    Set of all URLs known to a crawl so the consumer can tell new URLs apart without querying the database.
+    The exact mode is a plain set, the bloom mode trades a small rate of false positives (URLs wrongly
+    considered known and therefore skipped) for a fixed memory footprint on huge crawls.
+    Not thread-safe, owned by the consumer thread.
+    """
+
+    def __init__(self, mode='exact', capacity=20000000, error_rate=0.001):
+        self.mode = mode
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.urls = None
+        self.clear()
+
+    def clear(self) -> None:
+        if self.mode == 'bloom':
+            self.urls = GFlareBloomFilter(self.capacity, self.error_rate)
+        else:
+            self.urls = set()
+
+    def is_exact(self) -> bool:
+        return self.mode != 'bloom'
+
+    def __contains__(self, url: str) -> bool:
+        return url in self.urls
+
+    def __len__(self) -> int:
+        return len(self.urls)
+
+    def add(self, urls: list) -> None:
+        for url in urls:
+            self.urls.add(url)
+
+    def add_new(self, urls: list) -> list:
+        """Marks urls as seen and returns the ones that have not been seen before, in order and without duplicates. Empty URLs are skipped."""
+        new = []
+        seen = self.urls
+        if self.is_exact():
+            for url in urls:
+                if url and url not in seen:
+                    seen.add(url)
+                    new.append(url)
+        else:
+            for url in urls:
+                if url and seen.add(url):
+                    new.append(url)
+        return new
+
+    def rebuild(self, urls) -> None:
+        """Replaces the content with urls, e.g. all URLs of a loaded crawl. urls may be any iterable of URL batches."""
+        self.clear()
+        for batch in urls:
+            self.add(batch)
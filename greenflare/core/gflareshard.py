@@ -0,0 +1,387 @@
+"""
+@author Benjamin Görler <ben@greenflare.io>
+
+@section LICENSE
+
+Greenflare SEO Web Crawler (https://greenflare.io)
+Copyright (C) 2020-2021 Benjamin Görler. This file is part of
+Greenflare, an open-source project dedicated to delivering
+high quality SEO insights and analysis solutions to the world.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from greenflare.core.gflarecrawler import GFlareCrawler
+from greenflare.core.gflaredb import GFlareDB
+from greenflare.core.gflarescheduler import GFlareScheduler
+from greenflare.core.gflaretracker import GFlareSharedTracker
+from greenflare.core.gflarestore import GFlareResponseStore, get_store_file
+from greenflare.core.gflareresponse import GFlareResponse as gf
+from urllib.parse import urlsplit
+from threading import Thread, Lock
+from copy import deepcopy
+from zlib import crc32
+from os import path, remove
+import multiprocessing
+import signal
+import queue
+import os
+
+affinities = ('url', 'host')
+
+
+def shard_of(url: str, shards: int, affinity='url') -> int:
+    """Returns the index of the shard owning url. With host affinity all URLs of a host belong to the same shard."""
+    if shards <= 1:
+        return 0
+    key = urlsplit(url).netloc.lower() if affinity == 'host' else url
+    # crc32 instead of hash(), which differs between processes
+    return crc32(key.encode('utf-8', 'surrogatepass')) % shards
+
+
+class GFlareShardCrawler(GFlareCrawler):
+    """
+    Crawler of a single shard. Only crawls and stores the URLs it owns, links and redirect targets owned by
+    other shards are forwarded to their inbox. Forwarded URLs are added as placeholders to the shard database
+    as well so inlinks can be resolved and a paused crawl does not lose them once the databases are merged.
+    """
+
+    def __init__(self, settings: dict, index: int, shards: int, affinity: str, inboxes: list, tracker: GFlareSharedTracker, admitted):
+        super().__init__(settings=settings, gui_mode=False, lock=Lock())
+        self.index = index
+        self.shards = shards
+        self.affinity = affinity
+        self.inboxes = inboxes
+        self.tracker = tracker
+        # The URL budget is shared by all shards, the frontier only applies the depth budget
+        self.admitted = admitted
+        self.max_urls = int(settings.get('MAX_URLS', 0))
+        self.settings['MAX_URLS'] = 0
+        # Every shard serves its own metrics, on consecutive ports
+        if int(settings.get('METRICS_PORT', 0)):
+            self.settings['METRICS_PORT'] = int(settings['METRICS_PORT']) + index
+        self.inbox_thread = None
+        # Lowest depth each URL owned by another shard has been forwarded with
+        self.sent_depth = {}
+
+    def start_crawl(self) -> None:
+        """Starts the shard. Seed URLs arrive through the inbox like any other forwarded URL."""
+        self.init_crawl_headers()
+        self.init_session()
+        self.scheduler = GFlareScheduler(host_limits=self.get_host_limits)
+        self.gf = gf(self.settings, columns=None)
+        self.init_frontier()
+        self.init_seen()
+
+        db = self._connect_to_db()
+        db.create()
+        db.insert_config(self.settings)
+        self.columns = self.gf.all_items = db.get_columns()
+        db.close()
+        self.init_previous_crawl()
+        self.init_response_store()
+        self.init_warc()
+        self.init_concurrency()
+        self.init_metrics()
+        self.init_profiler()
+
+        if self.settings['MODE'] == 'Spider':
+            self.settings['ROOT_DOMAIN'] = self.gf.get_domain(
+                self.settings['STARTING_URL'])
+            self.request_robots_txt(self.settings['STARTING_URL'])
+            self.set_crawl_delay(self.settings['STARTING_URL'])
+
+        self.start_consumer()
+        self.inbox_thread = Thread(target=self.receive_urls, name='inbox')
+        self.inbox_thread.start()
+        Thread(target=self.spawn_threads).start()
+
+    def receive_urls(self) -> None:
+        """Hands forwarded URLs to the consumer, which owns the seen set and the database."""
+        inbox = self.inboxes[self.index]
+        while True:
+            messages = [inbox.get()]
+            while messages[-1] is not None and len(messages) < 100:
+                try:
+                    messages.append(inbox.get_nowait())
+                except queue.Empty:
+                    break
+
+            forwarded = [m for m in messages if m is not None]
+            while forwarded and not self.crawl_running.is_set():
+                try:
+                    self.data_queue.put({'forwarded': forwarded}, timeout=0.25)
+                    break
+                except queue.Full:
+                    continue
+
+            if messages[-1] is None:
+                break
+
+    def store_data(self, db: GFlareDB, data: dict, gui_rows: list) -> tuple:
+        if 'forwarded' not in data:
+            return super().store_data(db, data, gui_rows)
+
+        rows = 0
+        received = 0
+        for message in data['forwarded']:
+            if message[0] == 'rows':
+                rows += self.store_rows(db, message[1], gui_rows)
+                received += 1
+                continue
+            if message[0] == 'depth':
+                _, depth, parent, urls = message
+                self.lower_depth(db, urls, depth, parent)
+                received += 1
+                continue
+            # Other shards may have found the same URL, budgets have been applied by the sender
+            _, depth, parent, urls = message
+            new_urls = self.seen.add_new(urls)
+            if len(new_urls) < len(urls):
+                new_set = set(new_urls)
+                self.lower_depth(db, [url for url in urls if url not in new_set], depth, parent)
+            rows += self.enqueue(db, new_urls, depth, parent)
+            received += len(urls)
+            self.refund(len(urls) - len(new_urls))
+        # Forwarded work has been counted by the sender, queued URLs have just been counted again
+        return rows, self.tracker.complete(received)
+
+    def store_rows(self, db: GFlareDB, crawl_data: list, gui_rows: list) -> int:
+        own, foreign = self.split(crawl_data, key=lambda row: row[0])
+        for owner, rows in foreign.items():
+            # Redirect targets of other shards are stored by their owner so they are not requested again
+            db.insert_new_urls([row[0] for row in rows])
+            self.forward(owner, ('rows', rows), 1)
+        return super().store_rows(db, own, gui_rows) + sum(len(rows) for rows in foreign.values())
+
+    def queue_links(self, db: GFlareDB, links: list, depth: int, parent: str) -> int:
+        if self.url_queue.is_too_deep(depth):
+            return 0
+        # Only admitted URLs are marked as seen, another shard may still forward a URL this shard could not admit
+        urls = []
+        known = []
+        for url in dict.fromkeys(links):
+            if url:
+                (known if url in self.seen else urls).append(url)
+        admitted = self.admit(self.url_queue.admit(urls, depth))
+        self.seen.add(admitted)
+        self.lower_known_depth(db, known, depth, parent)
+
+        own, foreign = self.split(admitted)
+        rows = self.enqueue(db, own, depth, parent)
+        for owner, urls in foreign.items():
+            db.insert_new_urls(urls, depth=depth)
+            self.sent_depth.update(dict.fromkeys(urls, depth))
+            self.forward(owner, ('urls', depth, parent, urls), len(urls))
+            rows += len(urls)
+        return rows
+
+    def lower_known_depth(self, db: GFlareDB, urls: list, depth: int, parent: str) -> None:
+        """Lowers the depth of seen URLs found on a shorter path, URLs of other shards are lowered by their owner."""
+        own, foreign = self.split(urls)
+        if own:
+            self.lower_depth(db, own, depth, parent)
+        for owner, urls in foreign.items():
+            # Only URLs that have not been forwarded with this depth or less before
+            urls = [url for url in urls if depth < self.sent_depth.get(url, depth)]
+            if urls:
+                self.sent_depth.update(dict.fromkeys(urls, depth))
+                self.forward(owner, ('depth', depth, parent, urls), 1)
+
+    def admit(self, urls: list) -> list:
+        if not self.max_urls:
+            return urls
+        with self.admitted.get_lock():
+            urls = urls[:max(self.max_urls - self.admitted.value, 0)]
+            self.admitted.value += len(urls)
+        return urls
+
+    def refund(self, n: int) -> None:
+        """Returns budget of URLs that have been admitted by more than one shard."""
+        if self.max_urls and n > 0:
+            with self.admitted.get_lock():
+                self.admitted.value -= n
+
+    def split(self, items: list, key=None) -> tuple:
+        """Returns the items owned by this shard and a dict of the items owned by other shards."""
+        own = []
+        foreign = {}
+        for item in items:
+            owner = shard_of(key(item) if key else item, self.shards, self.affinity)
+            if owner == self.index:
+                own.append(item)
+            else:
+                foreign.setdefault(owner, []).append(item)
+        return own, foreign
+
+    def forward(self, owner: int, message: tuple, work: int) -> None:
+        # Counted before it is sent so the crawl cannot complete while the message is in transit
+        self.tracker.add(work)
+        self.inboxes[owner].put(message)
+
+    def enqueue(self, db: GFlareDB, urls: list, depth: int, parent: str) -> int:
+        if len(urls) > 0:
+            db.insert_new_urls(urls, depth=depth)
+            self.add_to_url_queue(urls, depth=depth, parent=parent)
+        return len(urls)
+
+    def stop(self) -> None:
+        """Stops the shard once the tracker has been finished (or stopped)."""
+        self.crawl_running.set()
+        self.notify_consumer_to_stop()
+        if self.consumer_thread:
+            self.consumer_thread.join()
+        self.wait_for_workers()
+        self.inboxes[self.index].put(None)
+        self.inbox_thread.join()
+
+
+def run_shard(index: int, shards: int, affinity: str, settings: dict, db_file: str, inboxes: list, tracker: GFlareSharedTracker, admitted, status) -> None:
+    """Entry point of a shard process. Reports (crawled, total, URLs/s) to status until the crawl has been finished or stopped."""
+    # Ctrl+C is handled by the coordinating process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    crawler = GFlareShardCrawler(settings, index, shards, affinity, inboxes, tracker, admitted)
+    crawler.db_file = db_file
+    crawler.start_crawl()
+
+    def report():
+        with crawler.lock:
+            status[index * 3:index * 3 + 3] = [crawler.urls_crawled, crawler.urls_total,
+                                               crawler.current_urls_per_second]
+
+    while not tracker.wait(0.5):
+        report()
+    crawler.stop()
+    report()
+
+    # Do not block the exit on URLs sent to shards that are gone already
+    for inbox in inboxes:
+        inbox.cancel_join_thread()
+
+
+class GFlareShardedCrawl:
+    """
+    Spreads a crawl over several processes. Every shard runs its own GFlareShardCrawler on a hash
+    partition of the URL space (by URL or by host) and writes to its own database, links are exchanged
+    through queues. Outstanding URLs are counted across all shards, the shard databases are merged
+    into db_file once the crawl has been completed or stopped.
+    With URL affinity every shard requests from the same hosts, so request limits are split evenly between shards.
+    """
+
+    def __init__(self, settings: dict, db_file: str, shards=0, affinity='url', list_mode_urls=None):
+        self.settings = settings
+        self.db_file = db_file
+        self.shards = int(shards or 0) or os.cpu_count() or 1
+        self.affinity = affinity if affinity in affinities else 'url'
+        self.list_mode_urls = list_mode_urls or []
+        self.context = multiprocessing.get_context('spawn')
+        self.tracker = None
+        self.admitted = None
+        self.status = None
+        self.inboxes = []
+        self.processes = []
+
+    def get_shard_files(self) -> list:
+        return [f'{self.db_file}.shard{i}' for i in range(self.shards)]
+
+    def get_shard_settings(self) -> dict:
+        settings = deepcopy(self.settings)
+        if self.affinity == 'url':
+            for key in ('URLS_PER_SECOND', 'EXTERNAL_URLS_PER_SECOND'):
+                settings[key] = float(settings.get(key, 0)) / self.shards
+            connections = int(settings.get('MAX_CONNECTIONS_PER_HOST', 0))
+            if connections:
+                settings['MAX_CONNECTIONS_PER_HOST'] = max(connections // self.shards, 1)
+        return settings
+
+    def get_seeds(self) -> list:
+        if self.settings['MODE'] == 'List':
+            return self.list_mode_urls
+        return [self.settings['STARTING_URL']]
+
+    def start(self) -> None:
+        if self.settings['MODE'] == 'Spider':
+            self.settings['ROOT_DOMAIN'] = gf(self.settings, columns=None).get_domain(
+                self.settings['STARTING_URL'])
+        self.tracker = GFlareSharedTracker(self.context)
+        self.status = self.context.Array('q', self.shards * 3, lock=False)
+        self.admitted = self.context.Value('q', 0)
+        # Kept referenced until the shards are gone, they are only unpickled once a shard has started
+        self.inboxes = [self.context.Queue() for _ in range(self.shards)]
+
+        seeds = {}
+        for url in self.get_seeds():
+            seeds.setdefault(shard_of(url, self.shards, self.affinity), []).append(url)
+        self.tracker.add(sum(len(urls) for urls in seeds.values()))
+        self.admitted.value = self.tracker.pending()
+        for owner, urls in seeds.items():
+            self.inboxes[owner].put(('urls', 0, None, urls))
+
+        settings = self.get_shard_settings()
+        for i, db_file in enumerate(self.get_shard_files()):
+            if path.isfile(db_file):
+                remove(db_file)
+            p = self.context.Process(target=run_shard, name=f'shard-{i}',
+                                     args=(i, self.shards, self.affinity, settings, db_file,
+                                           self.inboxes, self.tracker, self.admitted, self.status))
+            p.start()
+            self.processes.append(p)
+
+    def is_running(self) -> bool:
+        """Returns False once all shards have exited. A failed shard stops all others."""
+        if any(p.exitcode not in (None, 0) for p in self.processes):
+            self.tracker.stop()
+        return any(p.is_alive() for p in self.processes)
+
+    def get_progress(self) -> tuple:
+        """Returns crawled URLs, total URLs and URLs per second of all shards."""
+        values = list(self.status)
+        return sum(values[0::3]), sum(values[1::3]), sum(values[2::3])
+
+    def stop(self) -> None:
+        self.tracker.stop()
+
+    def join(self) -> bool:
+        """Waits for all shards to exit. Returns True if the crawl has been completed."""
+        while self.is_running():
+            for p in self.processes:
+                p.join(0.25)
+        return self.tracker.is_finished()
+
+    def merge(self) -> None:
+        """Merges all shard databases into db_file and deletes them. Crawled rows take precedence over placeholders of the same URL."""
+        files = [f for f in self.get_shard_files() if path.isfile(f)]
+        db = GFlareDB(self.db_file, crawl_items=self.settings.get('CRAWL_ITEMS'),
+                      extractions=self.settings.get('EXTRACTIONS', []), autocommit=False)
+        db.create()
+        db.insert_config(self.settings)
+        for crawled in (True, False):
+            for f in files:
+                db.merge_crawl(f, crawled=crawled)
+        for f in files:
+            db.merge_inlinks(f)
+        db.close()
+
+        stores = [get_store_file(f) for f in files if path.isfile(get_store_file(f))]
+        if stores:
+            store = GFlareResponseStore(get_store_file(self.db_file))
+            for f in stores:
+                store.merge(f)
+            store.close()
+
+        for f in files + stores:
+            for suffix in ('', '-wal', '-shm'):
+                if path.isfile(f + suffix):
+                    remove(f + suffix)
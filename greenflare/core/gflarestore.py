@@ -0,0 +1,185 @@
+"""
+@author Benjamin Görler <ben@greenflare.io>
+
+@section LICENSE
+
+Greenflare SEO Web Crawler (https://greenflare.io)
+Copyright (C) 2020-2021 Benjamin Görler. This file is part of
+Greenflare, an open-source project dedicated to delivering
+high quality SEO insights and analysis solutions to the world.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from greenflare.core.gflarefetch import GFlareFetchResult, GFlareHop
+from threading import Thread, Lock
+from urllib.request import pathname2url
+import sqlite3 as sqlite
+import hashlib
+import json
+import queue
+import zlib
+import os
+
+# zstandard is an optional dependency, bodies are compressed with zlib without it
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def get_store_file(db_file: str) -> str:
+    """Raw responses of a crawl live next to its database."""
+    return db_file + '.bodies'
+
+
+class GFlareResponseStore:
+    """
+    Compressed store of the raw responses of a crawl. Bodies are content-addressed (identical bodies are kept
+    once), responses are indexed by the requested URL and keep status, headers and redirect hops so they can
+    be parsed again exactly like the original fetch result.
+    Fetch workers compress, a single writer thread batches the inserts.
+    """
+
+    codecs = ('zlib', 'zstd')
+
+    def __init__(self, file_name: str, codec='zlib', level=None, read_only=False, batch_size=200):
+        if codec == 'zstd' and zstandard is None:
+            print('WARNING: zstandard is not installed, compressing responses with zlib')
+            codec = 'zlib'
+        self.file_name = file_name
+        self.codec = codec if codec in self.codecs else 'zlib'
+        self.level = level
+        self.read_only = read_only
+        self.batch_size = batch_size
+
+        if read_only:
+            # Readers neither create nor change anything, the store may belong to a finished crawl
+            self.con = sqlite.connect(f'file:{pathname2url(os.path.abspath(file_name))}?mode=ro', uri=True, check_same_thread=False)
+        else:
+            self.con = sqlite.connect(file_name, check_same_thread=False)
+            self.con.execute('PRAGMA journal_mode=WAL')
+            self.con.execute('PRAGMA synchronous=NORMAL')
+            self.con.execute('CREATE TABLE IF NOT EXISTS blobs(digest TEXT PRIMARY KEY, codec TEXT, size INT, data BLOB)')
+            self.con.execute('CREATE TABLE IF NOT EXISTS responses(url TEXT PRIMARY KEY, final_url TEXT, status_code INT, headers TEXT, encoding TEXT, history TEXT, digest TEXT, truncated TEXT)')
+            self.con.commit()
+        self.lock = Lock()
+
+        self.pending = queue.Queue(maxsize=1000)
+        self.closed = False
+        self.writer = None
+        if not read_only:
+            self.writer = Thread(target=self.write_worker, name='response-store')
+            self.writer.start()
+
+    def compress(self, content: bytes) -> bytes:
+        if self.codec == 'zstd':
+            return zstandard.ZstdCompressor(level=self.level or 3).compress(content)
+        return zlib.compress(content, self.level or 6)
+
+    def decompress(self, codec: str, data: bytes) -> bytes:
+        if codec == 'zstd':
+            if zstandard is None:
+                raise RuntimeError('Reading zstd compressed responses requires the zstandard package')
+            return zstandard.ZstdDecompressor().decompress(data)
+        return zlib.decompress(data)
+
+    def put(self, url: str, response) -> None:
+        """Stores the fetch result of url. Called by fetch workers, blocks while the writer is behind."""
+        digest = ''
+        blob = None
+        if response.content:
+            digest = hashlib.sha1(response.content).hexdigest()
+            blob = (digest, self.codec, len(response.content), self.compress(response.content))
+
+        history = [[hop.url, hop.status_code, hop.headers] for hop in response.history]
+        record = (url, response.url, response.status_code, json.dumps(response.headers),
+                  response.encoding, json.dumps(history), digest, getattr(response, 'truncated', ''))
+        while True:
+            with self.lock:
+                if self.closed:
+                    return
+            try:
+                self.pending.put((record, blob), timeout=0.25)
+                return
+            except queue.Full:
+                continue
+
+    def write_worker(self) -> None:
+        finished = False
+        while not finished:
+            batch = [self.pending.get()]
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+
+            finished = batch[-1] is None
+            batch = [item for item in batch if item is not None]
+            if not batch:
+                continue
+            with self.lock:
+                self.con.executemany('INSERT OR IGNORE INTO blobs VALUES(?, ?, ?, ?)',
+                                     [blob for _, blob in batch if blob])
+                self.con.executemany('INSERT OR REPLACE INTO responses VALUES(?, ?, ?, ?, ?, ?, ?, ?)',
+                                     [record for record, _ in batch])
+                self.con.commit()
+
+    def get(self, url: str):
+        """Returns the stored fetch result of url or None."""
+        with self.lock:
+            row = self.con.execute(
+                'SELECT r.final_url, r.status_code, r.headers, r.encoding, r.history, r.truncated, b.codec, b.data FROM responses AS r '
+                'LEFT JOIN blobs AS b ON b.digest = r.digest WHERE r.url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+
+        final_url, status_code, headers, encoding, history, truncated, codec, data = row
+        content = self.decompress(codec, data) if data else b''
+        history = [GFlareHop(*hop) for hop in json.loads(history)]
+        return GFlareFetchResult(final_url, status_code, json.loads(headers), content=content,
+                                 encoding=encoding, history=history, truncated=truncated or '')
+
+    def get_urls(self) -> list:
+        """Returns the requested URLs of all stored responses."""
+        with self.lock:
+            return [row[0] for row in self.con.execute('SELECT url FROM responses ORDER BY rowid')]
+
+    def merge(self, file_name: str) -> None:
+        """Copies all responses of another store, e.g. of a shard."""
+        with self.lock:
+            self.con.commit()
+            self.con.execute('ATTACH DATABASE ? AS other', (file_name,))
+            try:
+                self.con.execute('INSERT OR IGNORE INTO main.blobs SELECT * FROM other.blobs')
+                self.con.execute('INSERT OR REPLACE INTO main.responses SELECT * FROM other.responses')
+                self.con.commit()
+            finally:
+                self.con.execute('DETACH DATABASE other')
+
+    def count(self) -> int:
+        with self.lock:
+            return self.con.execute('SELECT count(*) FROM responses').fetchone()[0]
+
+    def close(self) -> None:
+        """Writes all pending responses. Responses put afterwards are dropped."""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        if self.writer:
+            self.pending.put(None)
+            self.writer.join()
+        self.con.close()
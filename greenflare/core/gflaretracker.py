@@ -0,0 +1,101 @@
+"""
+@author Benjamin Görler <ben@greenflare.io>
+
+@section LICENSE
+
+Greenflare SEO Web Crawler (https://greenflare.io)
+Copyright (C) 2020-2021 Benjamin Görler. This file is part of
+Greenflare, an open-source project dedicated to delivering
+high quality SEO insights and analysis solutions to the world.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from threading import Event, Lock
+import multiprocessing
+
+
+class GFlareWorkTracker:
+    """
+    Counts outstanding URLs: every URL is added when it is queued and only completed once the consumer
+    has stored its data. Queued, deferred, fetching, parsing and retry-pending URLs are all outstanding.
+    The crawl is complete the moment the count drops to 0.
+    Subclasses may share the count between processes by overriding add() and complete().
+    """
+
+    def __init__(self):
+        self.outstanding = 0
+        self.lock = Lock()
+        self.finished = Event()
+
+    def add(self, n=1) -> None:
+        with self.lock:
+            self.outstanding += n
+
+    def complete(self, n=1) -> bool:
+        """Marks n URLs as done. Returns True exactly once, for the call that completed all outstanding work."""
+        with self.lock:
+            self.outstanding -= n
+            if self.outstanding > 0 or self.finished.is_set():
+                return False
+            self.finished.set()
+            return True
+
+    def pending(self) -> int:
+        with self.lock:
+            return self.outstanding
+
+    def is_finished(self) -> bool:
+        return self.finished.is_set()
+
+
+class GFlareSharedTracker(GFlareWorkTracker):
+    """
+    Outstanding URLs of a crawl spread over several processes. Needs to be created before the
+    processes are started and handed to them as an argument. finished also wakes up all processes
+    when the crawl is stopped, is_finished() tells both cases apart.
+    """
+
+    def __init__(self, context=None):
+        context = context or multiprocessing.get_context('spawn')
+        self.outstanding = context.Value('q', 0)
+        self.lock = self.outstanding.get_lock()
+        self.finished = context.Event()
+
+    def add(self, n=1) -> None:
+        with self.lock:
+            self.outstanding.value += n
+
+    def complete(self, n=1) -> bool:
+        with self.lock:
+            self.outstanding.value -= n
+            if self.outstanding.value > 0 or self.finished.is_set():
+                return False
+            self.finished.set()
+            return True
+
+    def pending(self) -> int:
+        with self.lock:
+            return self.outstanding.value
+
+    def is_finished(self) -> bool:
+        with self.lock:
+            return self.finished.is_set() and self.outstanding.value <= 0
+
+    def stop(self) -> None:
+        """Wakes up all processes without completing the crawl."""
+        self.finished.set()
+
+    def wait(self, timeout=None) -> bool:
+        return self.finished.wait(timeout)
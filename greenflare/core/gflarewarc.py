@@ -0,0 +1,279 @@
+"""
+@author Benjamin Görler <ben@greenflare.io>
+
+@section LICENSE
+
+Greenflare SEO Web Crawler (https://greenflare.io)
+Copyright (C) 2020-2021 Benjamin Görler. This file is part of
+Greenflare, an open-source project dedicated to delivering
+high quality SEO insights and analysis solutions to the world.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from greenflare.core.defaults import Defaults
+from collections import namedtuple
+from datetime import datetime
+from tempfile import SpooledTemporaryFile
+from threading import Thread, Lock
+from urllib.parse import urlsplit
+from base64 import b32encode
+from uuid import uuid4
+import asyncio
+import hashlib
+import shutil
+import queue
+import gzip
+import os
+
+# A single HTTP request/response pair as sent and received, headers are lists of (name, value) tuples
+GFlareExchange = namedtuple('GFlareExchange', ['method', 'url', 'request_headers', 'version', 'status_code', 'reason', 'headers'])
+
+# Payloads are stored decoded, so these no longer describe them
+decoded_headers = ('content-encoding', 'transfer-encoding', 'content-length')
+
+
+def exchange_from_requests(response) -> GFlareExchange:
+    raw = getattr(response, 'raw', None)
+    version = getattr(raw, 'version', 11) or 11
+    headers = raw.headers.items() if getattr(raw, 'headers', None) is not None else response.headers.items()
+    request = response.request
+    return GFlareExchange(request.method, str(response.url), list(request.headers.items()),
+                          f'{version // 10}.{version % 10}', response.status_code, response.reason or '', list(headers))
+
+
+def exchange_from_aiohttp(response) -> GFlareExchange:
+    info = response.request_info
+    headers = [(k.decode('latin-1'), v.decode('latin-1')) for k, v in response.raw_headers]
+    return GFlareExchange(info.method, str(response.url), list(info.headers.items()),
+                          f'{response.version.major}.{response.version.minor}', response.status, response.reason or '', headers)
+
+
+def record_id() -> str:
+    return f'<urn:uuid:{uuid4()}>'
+
+
+def warc_date() -> str:
+    return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def sha1_label(digest) -> str:
+    return 'sha1:' + b32encode(digest.digest()).decode('ascii')
+
+
+class GFlareWarcPayload:
+    """
+    HTTP block of a record: the head (request or status line and headers) followed by the body.
+    Bodies are spooled to a temporary file once they exceed spool_size, digests are computed while writing.
+    """
+
+    def __init__(self, head: bytes, spool_size=64 * 1024):
+        self.head = head
+        self.body = SpooledTemporaryFile(max_size=spool_size)
+        self.payload_digest = hashlib.sha1()
+        self.block_digest = hashlib.sha1(head)
+        self.length = len(head)
+
+    def write(self, chunk: bytes) -> None:
+        self.body.write(chunk)
+        self.payload_digest.update(chunk)
+        self.block_digest.update(chunk)
+        self.length += len(chunk)
+
+    def copy_to(self, f) -> None:
+        f.write(self.head)
+        self.body.seek(0)
+        shutil.copyfileobj(self.body, f, 64 * 1024)
+
+    def close(self) -> None:
+        self.body.close()
+
+
+class GFlareWarcWriter:
+    """
+    Writes request and response records into gzip compressed WARC files, one gzip member per record.
+    Files are named <prefix>-<timestamp>-<serial>.warc.gz and rotated once they exceed max_size.
+    Fetch workers build the records, a single writer thread writes them. Fetch workers only wait while
+    max_pending exchanges are queued already, which bounds the memory (and spool files) held by queued records.
+    """
+
+    def __init__(self, prefix: str, max_size=1000000000, spool_size=64 * 1024, max_pending=100):
+        self.prefix = prefix
+        self.max_size = max_size
+        self.spool_size = spool_size
+        self.started = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+        self.serial = 0
+        self.file = None
+        self.file_name = None
+        self.warcinfo_id = None
+        self.files = []
+        self.closed = False
+        self.lock = Lock()
+
+        # Items are lists of the records of an exchange, None stops the writer
+        self.records = queue.Queue(maxsize=max_pending)
+        self.writer = Thread(target=self.write_worker, name='warc-writer')
+        self.writer.start()
+
+    def get_request_head(self, exchange: GFlareExchange) -> bytes:
+        components = urlsplit(exchange.url)
+        target = components.path or '/'
+        if components.query:
+            target += '?' + components.query
+        headers = exchange.request_headers
+        if not any(name.lower() == 'host' for name, _ in headers):
+            headers = [('Host', components.netloc)] + headers
+        lines = [f'{exchange.method} {target} HTTP/{exchange.version}'] + [f'{k}: {v}' for k, v in headers]
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1', errors='replace')
+
+    def get_response_head(self, exchange: GFlareExchange, decoded: bool) -> bytes:
+        headers = exchange.headers
+        if decoded and any(name.lower() in decoded_headers[:2] for name, _ in headers):
+            headers = [(k, v) for k, v in headers if k.lower() not in decoded_headers]
+        lines = [f'HTTP/{exchange.version} {exchange.status_code} {exchange.reason}'] + [f'{k}: {v}' for k, v in headers]
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1', errors='replace')
+
+    def new_payload(self, exchange: GFlareExchange) -> GFlareWarcPayload:
+        """Returns the payload of a response record, the caller writes the (decoded) body into it."""
+        return GFlareWarcPayload(self.get_response_head(exchange, exchange.method != 'HEAD'), self.spool_size)
+
+    def write_exchange(self, exchange: GFlareExchange, payload: GFlareWarcPayload, truncated='') -> str:
+        """
+        Queues a request and a response record, blocks while the writer is behind.
+        Returns the WARC-Record-ID of the response, None once the writer has been closed.
+        """
+        date = warc_date()
+        response_id = record_id()
+        request = GFlareWarcPayload(self.get_request_head(exchange), self.spool_size)
+        fields = []
+        if truncated:
+            fields.append(('WARC-Truncated', 'length' if truncated == 'too large' else 'time'))
+        records = [('request', exchange.url, date, record_id(), request, [('WARC-Concurrent-To', response_id)]),
+                   ('response', exchange.url, date, response_id, payload, fields)]
+        while True:
+            with self.lock:
+                if self.closed:
+                    # Fetches finishing after the crawl has been stopped
+                    request.close()
+                    payload.close()
+                    return None
+                try:
+                    self.records.put(records, timeout=0.25)
+                    return response_id
+                except queue.Full:
+                    continue
+
+    def write_requests(self, response, content=None, limit=None) -> list:
+        """
+        Archives a requests.Response including its redirects. Bodies of redirects have been read by requests,
+        the final body is content or streamed from response (within limit) if content is None.
+        Returns (url, record id) of every response.
+        """
+        records = []
+        for r in list(response.history) + [response]:
+            exchange = exchange_from_requests(r)
+            payload = self.new_payload(exchange)
+            truncated = ''
+            if exchange.method == 'HEAD':
+                pass
+            elif r is not response:
+                payload.write(r.content)
+            elif content is not None:
+                payload.write(content)
+                truncated = limit.truncated if limit else ''
+            else:
+                chunks = response.iter_content(chunk_size=64 * 1024)
+                for chunk in limit.iter(chunks) if limit else chunks:
+                    payload.write(chunk)
+                truncated = limit.truncated if limit else ''
+            records.append((exchange.url, self.write_exchange(exchange, payload, truncated)))
+        return records
+
+    async def write_aiohttp(self, response, content=None, limit=None) -> list:
+        """Async counterpart of write_requests. aiohttp does not keep the bodies of redirects."""
+        records = []
+        for r in list(response.history) + [response]:
+            exchange = exchange_from_aiohttp(r)
+            payload = self.new_payload(exchange)
+            truncated = ''
+            if exchange.method == 'HEAD' or r is not response:
+                pass
+            elif content is not None:
+                payload.write(content)
+                truncated = limit.truncated if limit else ''
+            else:
+                chunks = response.content.iter_chunked(64 * 1024)
+                async for chunk in limit.aiter(chunks) if limit else chunks:
+                    payload.write(chunk)
+                truncated = limit.truncated if limit else ''
+            # Queueing blocks while the writer is behind
+            record = await asyncio.get_event_loop().run_in_executor(None, self.write_exchange, exchange, payload, truncated)
+            records.append((exchange.url, record))
+        return records
+
+    def open_file(self) -> None:
+        if self.file:
+            self.file.close()
+        self.file_name = f'{self.prefix}-{self.started}-{self.serial:05d}.warc.gz'
+        self.serial += 1
+        self.files.append(self.file_name)
+        self.file = open(self.file_name, 'ab')
+
+        self.warcinfo_id = record_id()
+        info = (f'software: {Defaults.window_title} {Defaults.version}\r\n'
+                f'format: WARC File Format 1.0\r\n').encode('utf-8')
+        payload = GFlareWarcPayload(info)
+        self.write_record('warcinfo', None, warc_date(), self.warcinfo_id, payload,
+                          [('WARC-Filename', os.path.basename(self.file_name))], 'application/warc-fields')
+
+    def write_record(self, warc_type, url, date, rid, payload, fields, content_type) -> None:
+        headers = [('WARC-Type', warc_type), ('WARC-Record-ID', rid), ('WARC-Date', date)]
+        if url:
+            headers.append(('WARC-Target-URI', url))
+        if warc_type != 'warcinfo':
+            headers.append(('WARC-Warcinfo-ID', self.warcinfo_id))
+        if warc_type == 'response':
+            headers.append(('WARC-Payload-Digest', sha1_label(payload.payload_digest)))
+        headers += fields
+        headers += [('WARC-Block-Digest', sha1_label(payload.block_digest)),
+                    ('Content-Type', content_type), ('Content-Length', str(payload.length))]
+        head = 'WARC/1.0\r\n' + ''.join(f'{k}: {v}\r\n' for k, v in headers) + '\r\n'
+
+        # Every record is a gzip member of its own so records can be read from their offset
+        with gzip.GzipFile(fileobj=self.file, mode='wb') as member:
+            member.write(head.encode('utf-8'))
+            payload.copy_to(member)
+            member.write(b'\r\n\r\n')
+        payload.close()
+
+    def write_worker(self) -> None:
+        while True:
+            records = self.records.get()
+            if records is None:
+                break
+            if self.file is None or self.file.tell() >= self.max_size:
+                self.open_file()
+            for warc_type, url, date, rid, payload, fields in records:
+                self.write_record(warc_type, url, date, rid, payload, fields, f'application/http; msgtype={warc_type}')
+        if self.file:
+            self.file.close()
+
+    def close(self) -> None:
+        """Writes all queued records and closes the current file. Later records are dropped."""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.records.put(None)
+        self.writer.join()
@@ -97,6 +97,20 @@ class SettingsTab(ttk.Frame):
         self.combobox_ua.current(0)
         self.combobox_ua.pack(**self.item_right_args)
 
+        self.group_crawler_four = ttk.Frame(self.group_crawler)
+        self.group_crawler_four.pack(expand=True, fill='x')
+
+        self.label_engine = ttk.Label(self.group_crawler_four, text='Engine')
+        self.label_engine.pack(**self.item_left_args)
+
+        self.fetch_engines = Defaults.fetch_engines
+        self.engine_names = [k for k in self.fetch_engines.keys()]
+        self.combobox_engine = ttk.Combobox(
+            self.group_crawler_four, values=self.engine_names, state='readonly')
+        self.combobox_engine.bind('<<ComboboxSelected>>', self.save_engine)
+        self.combobox_engine.current(0)
+        self.combobox_engine.pack(**self.item_right_args)
+
         # Group HTTP Auth
 
         self.group_auth = ttk.LabelFrame(self.frame_first, text='HTTP Basic Auth')
@@ -203,7 +217,7 @@ class SettingsTab(ttk.Frame):
 
         # Analysis Group
         self.checkboxgroup_misc = CheckboxGroup(self.frame_third, 'Misc', [
-            'Unique Inlinks', 'Respect nofollow'], self.crawler.settings, 'CRAWL_ITEMS')
+            'Unique Inlinks', 'Respect nofollow', 'Header Only'], self.crawler.settings, 'CRAWL_ITEMS')
         self.checkboxgroup_misc.pack(**self.group_args)
 
     def update(self):
@@ -213,6 +227,10 @@ class SettingsTab(ttk.Frame):
             self.spinbox_urls.set(urls_per_second)
             self.spinbox_urls['state'] = 'enabled'
         self.combobox_ua.current()
+        engine = self.crawler.settings.get('FETCH_ENGINE', 'threads')
+        engines = list(self.fetch_engines.values())
+        if engine in engines:
+            self.combobox_engine.current(engines.index(engine))
 
     def save_threads(self):
         self.crawler.settings['THREADS'] = int(self.spinbox_threads.get())
@@ -225,6 +243,10 @@ class SettingsTab(ttk.Frame):
         self.crawler.settings['USER_AGENT'] = self.user_agents[value]
         self.crawler.settings['UA_SHORT'] = value
 
+    def save_engine(self, e):
+        value = self.combobox_engine.get()
+        self.crawler.settings['FETCH_ENGINE'] = self.fetch_engines[value]
+
     def save_proxy(self):
         self.crawler.settings['PROXY_HOST'] = self.var_host.get()
         self.crawler.settings['PROXY_USER'] = self.var_user.get()
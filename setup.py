@@ -55,9 +55,14 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=['requests', 'lxml', 'cssselect', 'ua-parser', 'pillow', 'packaging'],
+    extras_require={
+        'async': ['aiohttp'],
+        'zstd': ['zstandard'],
+    },
     entry_points={
         'console_scripts': [
             'greenflare=greenflare.app:main',
+            'greenflare-cli=greenflare.cli:main',
         ]
     },
 )
@@ -22,12 +22,48 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import gzip
+import os
+import queue
+import sqlite3
 import sys
+import tempfile
+import time
 import unittest
+from time import sleep
+from threading import Event, Lock, Thread
+from copy import deepcopy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import Future
+from unittest.mock import patch
 
 sys.path.append('..')
 from greenflare.core.gflarerobots import GFlareRobots
 from greenflare.core.gflareresponse import GFlareResponse
+from greenflare.core.gflarescheduler import GFlareScheduler, parse_retry_after
+from greenflare.core.gflarefrontier import GFlareFrontier
+from greenflare.core.gflareseen import GFlareSeenSet
+from greenflare.core.gflareparser import GFlareParser
+from greenflare.core.gflarefetch import GFlareFetchResult, GFlareBodyLimit
+from greenflare.core.gflaretracker import GFlareWorkTracker, GFlareSharedTracker
+from greenflare.core.gflareshard import shard_of
+from greenflare.core.gflaredistributed import GFlareLeases, GFlareCoordinator
+from greenflare.core.gflarerecrawl import GFlarePreviousCrawl, content_hash
+from greenflare.core.gflaredb import GFlareDB, GFlareDBPool
+from greenflare.core.gflarestore import GFlareResponseStore
+from greenflare.core.gflarefetch import GFlareHop
+from greenflare.core.gflarewarc import GFlareWarcWriter, GFlareExchange
+from greenflare.core.gflareconcurrency import GFlareConcurrency
+from greenflare.core.gflaremetrics import GFlareMetrics
+from greenflare.core.gflareprofiler import profiler
+from greenflare.core.gflarereplay import GFlareFixtures, GFlareReplayAdapter
+from greenflare.core.gflareasync import GFlareAsyncEngine
+from greenflare.core.gflarecrawler import GFlareCrawler
+from greenflare.core.defaults import Defaults
+from greenflare.cli import get_parser, parse_value, run
+from requests import Session
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
 
 
 class TestRobotsTxt(unittest.TestCase):
@@ -154,6 +190,840 @@ class TestRobotsTxt(unittest.TestCase):
         self.assertEqual(robot.is_allowed(disallowed_url),
                          False, "Should be disallowed")
 
+    def test_crawl_delay(self):
+        robots_txt = "User-agent: *\nCrawl-delay: 2.5\nDisallow: /test/"
+        ua = "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)"
+
+        robot = GFlareRobots(robots_txt, user_agent=ua)
+        self.assertEqual(robot.crawl_delay, 2.5, "Should be 2.5")
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_host_rate_limit(self):
+        scheduler = GFlareScheduler(host_limits=lambda url: (1, 0))
+
+        self.assertTrue(scheduler.try_acquire('https://www.example.com/a'))
+        self.assertFalse(scheduler.try_acquire(
+            'https://www.example.com/b'), "Should be throttled")
+        self.assertTrue(scheduler.try_acquire(
+            'https://www.example.org/a'), "Other hosts should not be throttled")
+
+    def test_deferred_urls(self):
+        scheduler = GFlareScheduler(host_limits=lambda url: (0, 1))
+        url = 'https://www.example.com/a'
+
+        self.assertTrue(scheduler.try_acquire(url))
+        scheduler.defer('https://www.example.com/b')
+        self.assertEqual(scheduler.pop_ready()[0], None, "Host is busy")
+
+        scheduler.release(url)
+        self.assertEqual(scheduler.pop_ready()[0], 'https://www.example.com/b')
+        self.assertEqual(scheduler.pending(), 0)
+
+    def test_handoff_limit(self):
+        scheduler = GFlareScheduler(max_handoff=2)
+
+        self.assertTrue(scheduler.defer('https://www.example.com/a'))
+        self.assertTrue(scheduler.defer('https://www.example.com/b'))
+        self.assertFalse(scheduler.defer('https://www.example.com/c'), "Should be capped per host")
+        self.assertTrue(scheduler.defer('https://www.example.org/a'))
+
+    def test_retries(self):
+        scheduler = GFlareScheduler()
+        scheduler.schedule_retry('https://www.example.com/a', 0.05, pause_host=True)
+
+        self.assertEqual(scheduler.pending(), 1)
+        self.assertFalse(scheduler.try_acquire(
+            'https://www.example.com/b'), "Host should be paused")
+        url, wait = scheduler.pop_ready()
+        self.assertIsNone(url)
+        self.assertGreater(wait, 0)
+
+        sleep(0.06)
+        self.assertEqual(scheduler.pop_ready()[0], 'https://www.example.com/a')
+        self.assertEqual(scheduler.pending(), 0)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after('120'), 120)
+        self.assertEqual(parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0, "Dates in the past mean now")
+        self.assertIsNone(parse_retry_after('soon'))
+
+
+class TestFrontier(unittest.TestCase):
+
+    def test_priority(self):
+        frontier = GFlareFrontier(priority='depth,content_type')
+        frontier.put('https://www.example.com/deep', depth=2)
+        frontier.put('https://www.example.com/image.png', depth=1)
+        frontier.put('https://www.example.com/page', depth=1)
+
+        self.assertEqual(frontier.get(), 'https://www.example.com/page')
+        self.assertEqual(frontier.get(), 'https://www.example.com/image.png')
+        self.assertEqual(frontier.get(), 'https://www.example.com/deep')
+        self.assertEqual(frontier.done('https://www.example.com/deep'), 2)
+
+    def test_budgets(self):
+        frontier = GFlareFrontier(max_depth=2, max_urls=3)
+        frontier.set_admitted(1)
+
+        self.assertEqual(frontier.admit(['a', 'b'], 3), [], "Too deep")
+        self.assertEqual(frontier.admit(['a', 'b', 'c'], 1), ['a', 'b'])
+        self.assertEqual(frontier.admit(['d'], 1), [], "Budget exhausted")
+
+    def test_spill_to_disk(self):
+        frontier = GFlareFrontier(memory_limit=2)
+        urls = [f'https://www.example.com/{i}' for i in range(5)]
+        for url in urls:
+            frontier.put(url, depth=0)
+
+        self.assertEqual(len(frontier.queued), 2, "Should be bounded")
+        self.assertEqual(frontier.qsize(), 5)
+        self.assertEqual([frontier.get() for _ in urls], urls)
+        self.assertTrue(frontier.empty())
+        frontier.clear()
+
+    def test_lower_depth(self):
+        frontier = GFlareFrontier(memory_limit=2)
+        urls = [f'https://www.example.com/{i}' for i in range(4)]
+        for url in urls:
+            frontier.put(url, depth=3)
+        self.assertEqual(frontier.get(), urls[0])
+
+        lowered = frontier.lower_depth(urls + ['https://www.example.com/crawled'], 1, parent='https://www.example.com/')
+        self.assertEqual(sorted(lowered), urls, "Queued, spilled and handed out URLs should be lowered")
+        self.assertEqual(frontier.lower_depth(urls[1:], 2), [], "Depth should only be lowered")
+        self.assertEqual(frontier.qsize(), 3)
+
+        self.assertEqual(frontier.done(urls[0]), 1)
+        for url in urls[1:]:
+            self.assertEqual(frontier.get(), url)
+            self.assertEqual(frontier.get_parent(url), 'https://www.example.com/')
+            self.assertEqual(frontier.done(url), 1)
+        self.assertTrue(frontier.empty())
+        frontier.clear()
+
+    def test_throttled_hosts(self):
+        scheduler = GFlareScheduler(host_limits=lambda url: (20, 0))
+        frontier = GFlareFrontier(priority='content_type')
+        for i in range(50):
+            frontier.put(f'https://www.example.com/img{i}.png', depth=1)
+
+        self.assertEqual(frontier.get(acquire=scheduler.acquire), 'https://www.example.com/img0.png')
+        frontier.put('https://www.example.com/page.html', depth=1)
+        frontier.put('https://www.example.org/img.png', depth=1)
+
+        self.assertEqual(frontier.get(acquire=scheduler.acquire), 'https://www.example.org/img.png',
+                         "Other hosts should be served while a host is throttled")
+        self.assertEqual(frontier.qsize(), 50, "Throttled URLs should stay queued")
+        self.assertEqual(frontier.get(timeout=1, acquire=scheduler.acquire), 'https://www.example.com/page.html',
+                         "Throttled URLs should keep their priority")
+        with self.assertRaises(queue.Empty):
+            frontier.get(block=False, acquire=scheduler.acquire)
+
+
+class TestSeenSet(unittest.TestCase):
+
+    def test_add_new(self):
+        for mode in ('exact', 'bloom'):
+            seen = GFlareSeenSet(mode=mode, capacity=1000)
+            seen.add(['https://www.example.com/'])
+
+            new = seen.add_new(['https://www.example.com/', 'https://www.example.com/a',
+                                'https://www.example.com/a', None, 'https://www.example.com/b'])
+            self.assertEqual(new, ['https://www.example.com/a', 'https://www.example.com/b'], mode)
+            self.assertIn('https://www.example.com/b', seen)
+            self.assertEqual(len(seen), 3, mode)
+
+
+class TestParser(unittest.TestCase):
+
+    def test_threads(self):
+        settings = dict(Defaults.settings, ROOT_DOMAIN='www.example.com',
+                        CRAWL_ITEMS=['page_title', 'respect_robots_txt'])
+        parser = GFlareParser(settings, ['url', 'status_code', 'page_title'],
+                              robots_txt='User-agent: *\nDisallow: /private/\n', mode='threads')
+
+        response = Response()
+        response.url = 'https://www.example.com/'
+        response.status_code = 200
+        response.headers = CaseInsensitiveDict({'content-type': 'text/html'})
+        response.encoding = 'utf-8'
+        response._content = b'<html><head><title>Home</title></head><body><a href="/a">a</a><a href="/private/b">b</a></body></html>'
+
+        data = parser.get_data(parser.submit(response))
+        self.assertEqual(data['data'], [('https://www.example.com/', 200, 'Home')])
+        self.assertEqual(data['links'], ['https://www.example.com/a'], "Should respect robots.txt")
+        self.assertEqual(parser.get_data(data), data)
+
+        result = GFlareFetchResult.from_requests(response, content=response.content)
+        self.assertEqual(parser.get_data(parser.submit(result)), data)
+        self.assertEqual(result.headers, {'content-type': 'text/html'})
+
+    def test_errors(self):
+        parser = GFlareParser(dict(Defaults.settings), ['url', 'crawl_status', 'status_code'], mode='threads')
+        result = GFlareFetchResult('https://www.example.com/b', 200, {'content-type': 'text/html'}, content=b'<html></html>',
+                                   history=[GFlareHop('https://www.example.com/a', 301, {})])
+        expected = {'url': 'https://www.example.com/b', 'request_url': 'https://www.example.com/a',
+                    'data': [('https://www.example.com/b', 'parse error', 200)], 'links': []}
+
+        with patch('greenflare.core.gflareresponse.GFlareResponse.get_data', side_effect=ValueError('broken')):
+            self.assertEqual(parser.get_data(parser.submit(result)), expected)
+
+        future = Future()
+        future.fallback = ('https://www.example.com/b', 'https://www.example.com/a', 200)
+        future.set_exception(ValueError('broken'))
+        self.assertEqual(parser.get_data(future), expected, "Failures in parse processes should be recorded as well")
+
+
+class TestWorkTracker(unittest.TestCase):
+
+    def test_completes_once(self):
+        tracker = GFlareWorkTracker()
+        tracker.add(1)
+
+        # The start page discovers two links before it is completed
+        tracker.add(2)
+        self.assertFalse(tracker.complete())
+        self.assertFalse(tracker.complete())
+        self.assertTrue(tracker.complete())
+        self.assertFalse(tracker.complete(0), "Should only signal once")
+        self.assertTrue(tracker.is_finished())
+
+    def test_shared_stop(self):
+        tracker = GFlareSharedTracker()
+        tracker.add(2)
+        tracker.stop()
+        self.assertTrue(tracker.wait(0))
+        self.assertFalse(tracker.is_finished(), "A stopped crawl is not complete")
+        self.assertFalse(tracker.complete(2))
+
+
+class TestShards(unittest.TestCase):
+
+    def test_shard_of(self):
+        urls = [f'https://www.example.com/page/{i}' for i in range(100)]
+        owners = [shard_of(url, 4) for url in urls]
+        self.assertEqual(set(owners), {0, 1, 2, 3})
+        self.assertEqual(owners, [shard_of(url, 4) for url in urls], "Should be stable")
+        self.assertEqual({shard_of(url, 4, affinity='host') for url in urls}, {shard_of('https://WWW.example.com/', 4, affinity='host')})
+        self.assertEqual(shard_of(urls[0], 1), 0)
+
+
+class TestLeases(unittest.TestCase):
+
+    def test_expiry(self):
+        leases = GFlareLeases()
+        a = leases.add('https://www.example.com/a', 'worker-a', 10)
+        b = leases.add('https://www.example.com/b', 'worker-b', 10)
+        leases.renew('worker-a', 30)
+
+        self.assertEqual(leases.expire(20), ['https://www.example.com/b'])
+        self.assertIsNone(leases.release(b), "Results of expired leases should be dropped")
+        self.assertEqual(leases.release(a), 'https://www.example.com/a')
+        self.assertEqual(len(leases), 0)
+
+
+class TestCli(unittest.TestCase):
+
+    def test_parse_value(self):
+        ua = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36'
+        self.assertEqual(parse_value('USER_AGENT', ua), ua, "Commas should only split list settings")
+        self.assertEqual(parse_value('CRAWL_ITEMS', 'url, status_code'), ['url', 'status_code'])
+        self.assertEqual(parse_value('EXCLUSIONS', '[["Contain", "/private/"]]'), [['Contain', '/private/']])
+        self.assertEqual(parse_value('MAX_DEPTH', '3'), 3)
+
+
+class TestCoordinator(unittest.TestCase):
+
+    def get_config(self, coordinator, token=None):
+        headers = {'Authorization': f'Bearer {token}'} if token else {}
+        with Session() as session:
+            return session.get(f'http://127.0.0.1:{coordinator.address[1]}/config', headers=headers, timeout=5)
+
+    def test_token(self):
+        settings = Defaults.settings.copy()
+        settings['AUTH_PASSWORD'] = 'hunter2'
+        with self.assertRaises(ValueError, msg="Should refuse public addresses without token"):
+            GFlareCoordinator(settings=settings, address=('0.0.0.0', 0)).listen()
+
+        for token in ('', 'secret'):
+            coordinator = GFlareCoordinator(settings=settings, address=('127.0.0.1', 0), token=token)
+            coordinator.listen()
+            coordinator.ready.set()
+            try:
+                if token:
+                    self.assertEqual(self.get_config(coordinator).status_code, 401)
+                    self.assertEqual(self.get_config(coordinator, 'wrong').status_code, 401)
+                config = self.get_config(coordinator, token).json()
+            finally:
+                coordinator.close()
+            self.assertEqual('AUTH_PASSWORD' in config['settings'], bool(token),
+                             "Credentials should only be sent to authenticated workers")
+
+
+    def test_local_settings(self):
+        GFlareCoordinator(settings=Defaults.settings.copy()).check_settings()
+        for key, value in (('WARC', 1), ('STORE_RESPONSES', '1'), ('RECRAWL_FROM', 'previous.gflaredb')):
+            with self.assertRaises(ValueError, msg=f"Remote workers do not support {key}"):
+                GFlareCoordinator(settings={**Defaults.settings, key: value}).check_settings()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            args = get_parser().parse_args(['https://www.example.com/', '-o', os.path.join(tmp, 'crawl.gflaredb'),
+                                            '--serve', '127.0.0.1:0', '--warc', '-q'])
+            with self.assertRaises(SystemExit):
+                run(args)
+
+
+def start_consumer(db_file: str, batch_size: int, interval: float) -> tuple:
+    """Runs the consumer of a fresh crawl database in a thread, fed through crawler.data_queue."""
+    crawler = GFlareCrawler(settings=deepcopy(Defaults.settings), gui_mode=False, lock=Lock(), stats=False)
+    crawler.settings.update({'COMMIT_BATCH_SIZE': batch_size, 'COMMIT_INTERVAL': interval})
+    crawler.db_file = db_file
+    crawler.init_crawl_headers()
+    crawler.init_session()
+    db = crawler._connect_to_db()
+    db.create()
+    crawler.columns = crawler.gf.all_items = db.get_columns()
+    db.close()
+
+    crawler.init_parser()
+    crawler.data_queue = queue.Queue()
+    # More work than will be submitted, the crawl does not complete
+    crawler.tracker.add(100)
+    consumer = Thread(target=crawler.consumer_worker)
+    consumer.start()
+    return crawler, consumer
+
+
+def put_row(crawler, url: str) -> None:
+    values = {'url': url, 'crawl_status': 'ok', 'status_code': 200}
+    crawler.data_queue.put({'url': url, 'data': [tuple(values.get(c, '') for c in crawler.columns)], 'links': []})
+
+
+def count_rows(db_file: str, expected: int, timeout=0.0) -> int:
+    """Counts the committed rows as seen by another connection, waiting up to timeout seconds for expected rows."""
+    deadline = time.time() + timeout
+    con = sqlite3.connect(db_file)
+    try:
+        while True:
+            rows = con.execute("SELECT count(*) FROM crawl WHERE status_code != ''").fetchone()[0]
+            if rows >= expected or time.time() >= deadline:
+                return rows
+            sleep(0.02)
+    finally:
+        con.close()
+
+
+class TestDBPool(unittest.TestCase):
+
+    def test_close(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_file = os.path.join(tmp, 'crawl.gflaredb')
+            db = GFlareDB(db_file, crawl_items=['url', 'status_code'])
+            db.create()
+            db.close()
+
+            pool = GFlareDBPool(db_file, crawl_items=['url', 'status_code'], size=1)
+            with pool.reader() as idle:
+                pass
+            with pool.reader() as busy:
+                self.assertIs(busy, idle, "Connections should be reused")
+                pool.close()
+                busy.con.execute('SELECT 1')
+            with self.assertRaises(sqlite3.ProgrammingError, msg="Returned connections should be closed"):
+                busy.con.execute('SELECT 1')
+            self.assertEqual(pool.created, 0)
+
+    def test_readers(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_file = os.path.join(tmp, 'crawl.gflaredb')
+            crawler, consumer = start_consumer(db_file, batch_size=1, interval=60)
+            try:
+                with crawler.get_readers().reader() as db:
+                    self.assertEqual(db.con.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+                    # An open read transaction would make the commit of the consumer fail without WAL
+                    db.con.execute('BEGIN')
+                    self.assertEqual(db.con.execute('SELECT count(*) FROM crawl').fetchone()[0], 0)
+                    put_row(crawler, 'https://www.example.com/1')
+                    self.assertEqual(count_rows(db_file, 1, timeout=5), 1, "Readers should not block the consumer")
+                    self.assertEqual(db.con.execute('SELECT count(*) FROM crawl').fetchone()[0], 0,
+                                     "Readers should keep their snapshot")
+                    db.con.execute('COMMIT')
+                columns, data = crawler.get_crawl_data([], 'crawl', columns=['url', 'status_code'])
+                self.assertEqual(data, [('https://www.example.com/1', 200)])
+            finally:
+                crawler.data_queue.put('END')
+                consumer.join()
+                crawler.close_readers()
+
+
+class TestRecrawl(unittest.TestCase):
+
+    def test_take_over(self):
+        url = 'https://www.example.com/'
+        with tempfile.TemporaryDirectory() as tmp:
+            db_file = os.path.join(tmp, 'previous.gflaredb')
+            db = GFlareDB(db_file, crawl_items=['url', 'status_code', 'page_title'])
+            db.create()
+            db.insert_crawl_data([(url, 200, 'Home')], new=True)
+            db.insert_validators([(url, '"v1"', '', content_hash(b'<html></html>'), 'https://www.example.com/a')])
+            db.close()
+
+            previous = GFlarePreviousCrawl(db_file, ['url', 'page_title', 'status_code', 'depth'])
+            validators = previous.get_validators(url)
+            self.assertEqual(previous.get_headers(validators), {'If-None-Match': '"v1"'})
+
+            data = previous.take_over(url, GFlareFetchResult(url, 304, {'etag': '"v2"'}), validators)
+            self.assertEqual(data['data'], [(url, 'Home', 200, '')])
+            self.assertEqual(data['links'], ['https://www.example.com/a'])
+            self.assertEqual(data['validators'][0], '"v2"')
+
+            unchanged = GFlareFetchResult(url, 200, {}, content=b'<html></html>')
+            self.assertTrue(previous.take_over(url, unchanged, validators)['unchanged'])
+            changed = GFlareFetchResult(url, 200, {}, content=b'<html>new</html>')
+            self.assertIs(previous.take_over(url, changed, validators), changed)
+            previous.close()
+
+
+class TestResponseStore(unittest.TestCase):
+
+    def test_round_trip(self):
+        body = b'<html><body>' + b'x' * 1000 + b'</body></html>'
+        hop = GFlareHop('https://www.example.com/a', 301, {'location': '/b'})
+        with tempfile.TemporaryDirectory() as tmp:
+            file_name = os.path.join(tmp, 'crawl #1?.gflaredb.bodies')
+            store = GFlareResponseStore(file_name)
+            store.put('https://www.example.com/a', GFlareFetchResult(
+                'https://www.example.com/b', 200, {'content-type': 'text/html'}, content=body, history=[hop]))
+            store.put('https://www.example.com/c', GFlareFetchResult(
+                'https://www.example.com/c', 200, {'content-type': 'text/html'}, content=body))
+            store.close()
+
+            store = GFlareResponseStore(file_name, read_only=True)
+            response = store.get('https://www.example.com/a')
+            self.assertEqual(response.url, 'https://www.example.com/b')
+            self.assertEqual(response.content, body)
+            self.assertEqual(response.history, (hop,))
+            self.assertIsNone(store.get('https://www.example.com/b'))
+            self.assertEqual(store.con.execute('SELECT count(*) FROM blobs').fetchone()[0], 1,
+                             "Identical bodies should be stored once")
+            with self.assertRaises(sqlite3.OperationalError, msg="Should be opened read-only"):
+                store.con.execute('CREATE TABLE other(a)')
+            store.close()
+
+
+class TestReplay(unittest.TestCase):
+
+    def test_fixtures(self):
+        body = b'<html><head><title>b</title></head></html>'
+        hop = GFlareHop('https://www.example.com/a', 301, {'location': '/b'})
+        with tempfile.TemporaryDirectory() as tmp:
+            fixtures = GFlareFixtures(tmp)
+            fixtures.add('https://www.example.com/a', GFlareFetchResult(
+                'https://www.example.com/b', 200, {'content-type': 'text/html'}, content=body, history=[hop]))
+            fixtures.save()
+
+            session = Session()
+            session.mount('https://', GFlareReplayAdapter(GFlareFixtures(tmp)))
+            response = session.get('https://www.example.com/a', stream=True)
+            self.assertEqual(response.url, 'https://www.example.com/b')
+            self.assertEqual([(r.url, r.status_code) for r in response.history], [('https://www.example.com/a', 301)])
+            self.assertEqual(b''.join(response.iter_content(chunk_size=16)), body)
+
+            response = session.get('https://www.example.com/c')
+            self.assertEqual(response.status_code, 404)
+            self.assertEqual(response.headers['x-greenflare-replay'], 'not recorded')
+
+    def test_concurrent_chains(self):
+        hop = GFlareHop('https://www.example.com/a', 301, {'location': '/b'})
+        with tempfile.TemporaryDirectory() as tmp:
+            fixtures = GFlareFixtures(tmp)
+            fixtures.add('https://www.example.com/a', GFlareFetchResult(
+                'https://www.example.com/b', 200, {'content-type': 'text/html'}, content=b'<html></html>', history=[hop]))
+            adapter = GFlareReplayAdapter(fixtures)
+
+            statuses = []
+            started, finished = Event(), Event()
+
+            def follow():
+                statuses.append(adapter.get_response('https://www.example.com/a')[0])
+                started.set()
+                finished.wait(5)
+                statuses.append(adapter.get_response('https://www.example.com/b')[0])
+
+            other = Thread(target=follow)
+            other.start()
+            started.wait(5)
+            # The same chain replayed on another thread in between
+            self.assertEqual(adapter.get_response('https://www.example.com/a')[0], 301)
+            self.assertEqual(adapter.get_response('https://www.example.com/b')[0], 200)
+            finished.set()
+            other.join()
+            self.assertEqual(statuses, [301, 200], "Chains of different threads should not share their hops")
+
+            self.assertEqual(adapter.get_response('https://www.example.com/a')[0], 301)
+            adapter.get_response('https://www.example.com/c')
+            self.assertEqual(adapter.get_response('https://www.example.com/b')[0], 404,
+                             "Hops of chains that have not been followed should be dropped")
+
+
+class TestBodyLimit(unittest.TestCase):
+
+    def test_limits(self):
+        chunks = [b'x' * 10] * 5
+        limit = GFlareBodyLimit(max_bytes=25)
+        self.assertEqual(limit.read(chunks), b'x' * 25)
+        self.assertEqual(limit.truncated, 'too large')
+
+        limit = GFlareBodyLimit(max_bytes=50)
+        self.assertEqual(limit.read(chunks), b'x' * 50)
+        self.assertEqual(limit.truncated, '')
+
+        limit = GFlareBodyLimit(max_seconds=0.01)
+
+        def slow():
+            for chunk in chunks:
+                time.sleep(0.01)
+                yield chunk
+        self.assertEqual(limit.read(slow()), b'x' * 10)
+        self.assertEqual(limit.truncated, 'truncated')
+
+    def test_abort(self):
+        aborted = Event()
+
+        def blocking():
+            yield b'x'
+            aborted.wait(5)
+            raise ConnectionError('Connection aborted')
+        limit = GFlareBodyLimit(max_seconds=0.05, abort=aborted.set)
+        self.assertEqual(limit.read(blocking()), b'x')
+        self.assertEqual(limit.truncated, 'truncated', "Interrupted reads should be truncated")
+
+        aborted.clear()
+        limit = GFlareBodyLimit(max_seconds=0.05, abort=aborted.set)
+        self.assertEqual(limit.read([b'x']), b'x')
+        limit.expire()
+        self.assertEqual(limit.truncated, '', "Deadlines passing after the body has been read should not truncate it")
+        self.assertFalse(aborted.is_set())
+
+
+class TestConcurrency(unittest.TestCase):
+
+    def test_aimd(self):
+        concurrency = GFlareConcurrency(4, floor=2, ceiling=6, window=0, min_samples=2)
+        for _ in range(6):
+            concurrency.record(0.1, False)
+        self.assertEqual(concurrency.get_limit(), 6, "Healthy windows should grow the limit up to the ceiling")
+
+        concurrency.record(0.5, False)
+        concurrency.record(0.5, False)
+        self.assertEqual(concurrency.get_limit(), 3, "Inflated latencies should halve the limit")
+
+        concurrency.record(10, True)
+        self.assertEqual(len(concurrency.latencies), 0, "Requests started before a decrease should be ignored")
+        concurrency.record(0, True)
+        concurrency.record(0, False)
+        self.assertEqual(concurrency.get_limit(), 2, "Failures should shrink the limit down to the floor")
+        self.assertEqual([limit for _, limit, _, _ in concurrency.get_history()], [4, 5, 6, 3, 2])
+
+        self.assertTrue(concurrency.acquire(timeout=0))
+        self.assertTrue(concurrency.acquire(timeout=0))
+        self.assertFalse(concurrency.acquire(timeout=0))
+        concurrency.release()
+        self.assertTrue(concurrency.acquire(timeout=0))
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_render(self):
+        metrics = GFlareMetrics()
+        metrics.describe('fetch_seconds', 'histogram', 'Fetch time', buckets=(0.1, 1))
+        metrics.describe('responses_total', 'counter', 'Responses')
+        metrics.gauge('queue_size', 'Queue size', lambda: 3)
+        metrics.observe('fetch_seconds', 0.05)
+        metrics.observe('fetch_seconds', 0.5)
+        metrics.observe('fetch_seconds', 5)
+        metrics.inc('responses_total', status_code=200)
+        metrics.inc('responses_total', status_code=200)
+        metrics.inc('responses_total', status_code='a"b')
+
+        self.assertEqual(metrics.get('fetch_seconds'), (3, 5.55))
+        lines = metrics.render().splitlines()
+        self.assertIn('# TYPE fetch_seconds histogram', lines)
+        self.assertIn('fetch_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('fetch_seconds_bucket{le="1"} 2', lines)
+        self.assertIn('fetch_seconds_bucket{le="+Inf"} 3', lines)
+        self.assertIn('fetch_seconds_count 3', lines)
+        self.assertIn('responses_total{status_code="200"} 2', lines)
+        self.assertIn('responses_total{status_code="a\\"b"} 1', lines)
+        self.assertIn('queue_size 3', lines)
+
+
+class TestProfiler(unittest.TestCase):
+
+    def tearDown(self):
+        profiler.disable()
+        profiler.reset()
+
+    def test_report(self):
+        gf = GFlareResponse({'MODE': 'Spider', 'CRAWL_ITEMS': []}, columns=None)
+        gf.sanitise_url('https://www.example.com/a')
+        self.assertEqual(profiler.report(), {}, "Nothing should be recorded while disabled")
+
+        profiler.enable()
+        for _ in range(10):
+            gf.sanitise_url('https://www.example.com/a')
+        report = profiler.report()
+        self.assertEqual(report['GFlareResponse.sanitise_url']['count'], 10)
+        self.assertLessEqual(report['GFlareResponse.sanitise_url']['p50'], report['GFlareResponse.sanitise_url']['p99'])
+
+
+class TestWarc(unittest.TestCase):
+
+    def test_records(self):
+        exchange = GFlareExchange('GET', 'https://www.example.com/a?b=1', [('User-Agent', 'Greenflare')], '1.1', 200, 'OK',
+                                  [('Content-Type', 'text/html'), ('Content-Encoding', 'gzip'), ('Content-Length', '30')])
+        with tempfile.TemporaryDirectory() as tmp:
+            warc = GFlareWarcWriter(os.path.join(tmp, 'crawl'))
+            payload = warc.new_payload(exchange)
+            payload.write(b'<html></html>')
+            response_id = warc.write_exchange(exchange, payload)
+            warc.close()
+
+            late = warc.new_payload(exchange)
+            self.assertIsNone(warc.write_exchange(exchange, late), "Records after close should be dropped")
+            self.assertTrue(late.body.closed)
+
+            with gzip.open(warc.files[0], 'rb') as f:
+                records = f.read().split(b'WARC/1.0\r\n')[1:]
+
+        self.assertEqual(len(records), 3, "warcinfo, request and response")
+        self.assertIn(b'GET /a?b=1 HTTP/1.1\r\nHost: www.example.com\r\n', records[1])
+        self.assertIn(f'WARC-Concurrent-To: {response_id}'.encode(), records[1])
+        self.assertIn(b'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n\r\n<html></html>', records[2],
+                      "Decoded payloads should not keep their encoding headers")
+
+
+class GFlareTestSite:
+    """Serves a few pages on a free local port and records the method and path of every request."""
+
+    def __init__(self, pages: dict):
+        self.pages = pages
+        self.requests = []
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self.respond(body=True)
+
+            def do_HEAD(self):
+                self.respond(body=False)
+
+            def respond(self, body):
+                site.requests.append((self.command, self.path))
+                status, content_type, content = site.pages.get(self.path, (404, 'text/html', b'Not Found'))
+                self.send_response(status)
+                if status in (301, 302):
+                    self.send_header('Location', content)
+                    content = b''
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                if body:
+                    self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def url(self, path: str, host='127.0.0.1') -> str:
+        return f'http://{host}:{self.server.server_address[1]}{path}'
+
+    def methods(self, path: str) -> list:
+        return [method for method, requested in self.requests if requested == path]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestCrawl(unittest.TestCase):
+
+    def setUp(self):
+        # localhost is another host than 127.0.0.1 and therefore external
+        self.external = GFlareTestSite({'/page': (200, 'text/html', b'<html><title>External</title></html>')})
+        self.site = GFlareTestSite({
+            '/': (200, 'text/html', (
+                '<html><head><title>Home</title></head><body><a href="/a">a</a><a href="/old">old</a>'
+                f'<img src="/image.png"><a href="{self.external.url("/page", host="localhost")}">external</a>'
+                '</body></html>').encode()),
+            '/a': (200, 'text/html', b'<html><head><title>A</title></head><body><h1>A</h1><a href="/b">b</a></body></html>'),
+            '/b': (200, 'text/html', b'<html><head><title>B</title></head><body><h1>B</h1><a href="/">home</a></body></html>'),
+            '/old': (301, 'text/html', '/b'),
+            '/image.png': (200, 'image/png', b'\x89PNG' + b'\x00' * 200000),
+        })
+        self.crawl_items = Defaults.crawl_items + ['images', 'external_links']
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.site.close()
+        self.external.close()
+        self.tmp.cleanup()
+
+    def crawl(self, name: str, *args) -> str:
+        db_file = os.path.join(self.tmp.name, name)
+        crawl_items = ','.join(self.crawl_items)
+        self.assertEqual(run(get_parser().parse_args([*args, '-o', db_file, '-q', '--set', f'CRAWL_ITEMS={crawl_items}'])), 0)
+        return db_file
+
+    def run_cli(self, *args, timeout=60):
+        """Runs greenflare-cli in a thread and returns its exit code, None if it has not finished within timeout seconds."""
+        result = []
+        cli = Thread(target=lambda: result.append(run(get_parser().parse_args(args))), daemon=True)
+        cli.start()
+        cli.join(timeout)
+        return result[0] if result else None
+
+    def get_rows(self, db_file: str, columns='status_code, content_type, page_title') -> dict:
+        con = sqlite3.connect(db_file)
+        try:
+            return {row[0]: row[1:] for row in con.execute(f'SELECT url, {columns} FROM crawl')}
+        finally:
+            con.close()
+
+    def test_async_engine(self):
+        threads = self.get_rows(self.crawl('threads.gflaredb', self.site.url('/')))
+        self.assertEqual(threads[self.site.url('/b')], (200, 'text/html', 'B'))
+        self.assertEqual(threads[self.site.url('/image.png')][:2], (200, 'image/png'))
+
+        with patch.object(GFlareAsyncEngine, 'fetch', autospec=True, side_effect=GFlareAsyncEngine.fetch) as fetch:
+            engine = self.get_rows(self.crawl('asyncio.gflaredb', self.site.url('/'), '--engine', 'asyncio'))
+        self.assertGreater(fetch.call_count, 0, "Should be crawled by the asyncio engine")
+        self.assertEqual(engine, threads)
+
+    def test_async_errors(self):
+        record_fetch = GFlareCrawler.record_fetch
+
+        def fail(crawler, url, response, latency):
+            if url == self.site.url('/a'):
+                raise RuntimeError('broken')
+            record_fetch(crawler, url, response, latency)
+
+        db_file = os.path.join(self.tmp.name, 'errors.gflaredb')
+        with patch.object(GFlareCrawler, 'record_fetch', autospec=True, side_effect=fail):
+            self.assertEqual(self.run_cli(self.site.url('/'), '-o', db_file, '-q', '--engine', 'asyncio',
+                                          '--set', 'RETRY_BACKOFF=0.01'), 0, "Should complete despite the error")
+        rows = self.get_rows(db_file, 'crawl_status')
+        self.assertEqual(rows[self.site.url('/a')], ('unknown exception',))
+        self.assertEqual(rows[self.site.url('/')], ('ok',))
+        self.assertGreater(len(self.site.methods('/a')), 1, "Should be retried")
+
+    def test_cli(self):
+        ua = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36'
+        db_file = self.crawl('cli.gflaredb', self.site.url('/'), '--max-depth', '1', '--user-agent', ua)
+        rows = self.get_rows(db_file, 'depth, crawl_status')
+        self.assertEqual(rows[self.site.url('/')], (0, 'ok'))
+        self.assertEqual(rows[self.site.url('/a')], (1, 'ok'))
+        self.assertEqual(rows[self.site.url('/old')], (1, 'moved permanently'))
+        self.assertEqual(rows[self.external.url('/page', host='localhost')], (1, 'ok'))
+        self.assertLessEqual(max(depth for depth, _ in rows.values()), 1)
+        con = sqlite3.connect(db_file)
+        try:
+            self.assertEqual(con.execute("SELECT value FROM config WHERE setting = 'USER_AGENT'").fetchone()[0], ua)
+        finally:
+            con.close()
+
+        unreachable = self.external.url('/page')
+        self.external.close()
+        args = get_parser().parse_args([unreachable, '-o', os.path.join(self.tmp.name, 'failed.gflaredb'), '-q'])
+        self.assertEqual(run(args), 1, "Should fail if the starting URL cannot be reached")
+
+    def test_resume_backlog(self):
+        self.site.pages['/redirect'] = (301, 'text/html', '/p299')
+        self.site.pages['/p299'] = (200, 'text/html', b'<html><head><title>Last</title></head></html>')
+        settings = deepcopy(Defaults.settings)
+        settings.update({'MODE': 'List', 'FRONTIER_MEMORY_LIMIT': 4, 'CRAWL_ITEMS': self.crawl_items})
+        db_file = os.path.join(self.tmp.name, 'paused.gflaredb')
+        db = GFlareDB(db_file, crawl_items=self.crawl_items)
+        db.create()
+        db.insert_config(settings)
+        db.insert_new_urls([self.site.url('/redirect')], depth=0)
+        db.insert_new_urls([self.site.url(f'/p{i}') for i in range(299)], depth=0)
+        db.insert_new_urls([self.site.url('/p299')], depth=0)
+        db.close()
+
+        # The redirect reaches the last URL long before the backlog is paged that far
+        self.assertEqual(self.run_cli('--resume', db_file, '-q'), 0, "Should complete the resumed crawl")
+        rows = self.get_rows(db_file, 'status_code')
+        self.assertEqual(rows[self.site.url('/p299')], (200,))
+        self.assertNotIn(('',), rows.values())
+        self.assertEqual(self.site.methods('/p299'), ['GET'], "Should not request the redirect target again")
+
+    def test_reextract(self):
+        for engine in ('threads', 'asyncio'):
+            self.crawl_items.remove('h1')
+            crawled = self.crawl(f'{engine}.gflaredb', self.site.url('/'), '--store-responses', '--engine', engine)
+            self.site.requests.clear()
+            self.external.requests.clear()
+
+            self.crawl_items.append('h1')
+            reextracted = self.crawl(f'{engine}-reextracted.gflaredb', '--reextract', crawled)
+            self.assertEqual(self.site.requests + self.external.requests, [], "Should not request the site")
+            columns = 'status_code, content_type, page_title, crawl_status'
+            self.assertEqual(self.get_rows(reextracted, columns), self.get_rows(crawled, columns))
+            rows = self.get_rows(reextracted, 'h1')
+            self.assertEqual((rows[self.site.url('/a')], rows[self.site.url('/b')]), (('A',), ('B',)),
+                             "New crawl items should be extracted from the stored responses")
+
+    def test_methods(self):
+        rows = self.get_rows(self.crawl('spider.gflaredb', self.site.url('/')))
+        self.assertEqual(rows[self.site.url('/image.png')][:2], (200, 'image/png'))
+        self.assertEqual(rows[self.external.url('/page', host='localhost')][0], 200)
+        for path in ('/', '/a', '/image.png'):
+            self.assertEqual(self.site.methods(path), ['GET'], "Internal URLs should be requested once with GET")
+        self.assertEqual(self.external.methods('/page'), ['HEAD'], "External URLs should only be requested with HEAD")
+
+        self.site.requests.clear()
+        url_list = os.path.join(self.tmp.name, 'urls.txt')
+        with open(url_list, 'w') as f:
+            f.write(f"{self.site.url('/a')}\n{self.site.url('/image.png')}\n")
+        self.crawl_items.append('header_only')
+        rows = self.get_rows(self.crawl('header_only.gflaredb', '-l', url_list))
+        self.assertEqual(rows[self.site.url('/a')][:2], (200, 'text/html'))
+        self.assertEqual(rows[self.site.url('/image.png')][:2], (200, 'image/png'))
+        self.assertEqual({method for method, path in self.site.requests if path != '/robots.txt'}, {'HEAD'},
+                         "Header Only should not request any body")
+
+
+class TestGroupCommit(unittest.TestCase):
+
+    def test_flush_window(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_file = os.path.join(tmp, 'batch.gflaredb')
+            crawler, consumer = start_consumer(db_file, batch_size=2, interval=60)
+            put_row(crawler, 'https://www.example.com/1')
+            sleep(0.3)
+            self.assertEqual(count_rows(db_file, 1), 0, "Should not commit before the batch is full")
+            put_row(crawler, 'https://www.example.com/2')
+            self.assertEqual(count_rows(db_file, 2, timeout=5), 2, "Should commit a full batch")
+            crawler.data_queue.put('END')
+            consumer.join()
+            self.assertFalse(crawler.crawl_completed.is_set())
+
+            db_file = os.path.join(tmp, 'interval.gflaredb')
+            crawler, consumer = start_consumer(db_file, batch_size=1000, interval=0.1)
+            put_row(crawler, 'https://www.example.com/1')
+            self.assertEqual(count_rows(db_file, 1, timeout=5), 1, "Should commit once the window has passed")
+            self.assertTrue(consumer.is_alive(), "Should commit while waiting for more data")
+            crawler.data_queue.put('END')
+            consumer.join()
+
 
 class TestFullStatus(unittest.TestCase):
 